@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import emulator
+from emulator import Emulator
+
+
+# Manifest: JSON list of jobs, for instance
+# [
+#     {
+#         "rom": "rom_2_6.bin",                   ROM file, relative to the manifest
+#         "chip": "SNC7001A",                     (optional) chip profile
+#         "aot": false,                           (optional) run compiled routines
+#         "checkpoint": "init.ckpt",              (optional) checkpoint file to start from, instead of reset
+#         "pc": "0x000080",                       (optional) start address, instead of 0x000000
+#         "flash": "flash.bin",                   (optional) SPI flash image, written by the firmware
+#         "adc_wav": "input.wav",                 (optional) WAV file feeding the ADC
+#         "dac_wav": "output.wav",                (optional) WAV file capturing the DAC output
+#         "stimulus": {                           (optional) state set before running
+#             "registers": {"X0": 1},
+#             "io": {"P0": "0xfffe"},
+#             "data": {"0x0100": [1, 2, "0x0003"]}
+#         },
+#         "until": "0x0004e5",                    (optional) stop when PC reaches this address
+#         "max_instructions": 1000000,            (optional) stop after this many instructions
+#         "collect": ["pc", "instructions", "cycles", "time", "registers", "io:SSF", "data:0x0100:16"],
+#         "save": "test.ckpt"                     (optional) checkpoint file to save the final state to
+#     }
+# ]
+# Every job produces one JSON record (one per line) with the job index, how it stopped and the collected outputs.
+DEFAULT_MAX_INSTRUCTIONS = 10000000
+DEFAULT_COLLECT = ['pc', 'instructions', 'registers']
+
+def number(value):
+    # Numbers can be written as strings, to use hexadecimal
+    if isinstance(value, str):
+        return int(value, 0)
+    return value
+
+# Machines of this process, by (ROM, chip, aot): the ROM is mapped once, jobs only reset the machine
+machines = dict()
+
+def getMachine(rom, chip, aot):
+    key = (rom, chip, aot)
+    if key not in machines:
+        machine = Emulator(chip)
+        machine.load_rom(rom, aot)
+        machines[key] = machine
+    return machines[key]
+
+def jobMachine(job):
+    return (job['rom'], job.get('chip', 'SNC7001A'), job.get('aot', False))
+
+def applyStimulus(machine, stimulus):
+    for name, value in stimulus.get('registers', dict()).items():
+        machine.set_register(name, number(value))
+    for io, value in stimulus.get('io', dict()).items():
+        machine.set_io(io if not io.startswith('0x') else number(io), number(value))
+    for address, values in stimulus.get('data', dict()).items():
+        address = number(address)
+        if not isinstance(values, list):
+            values = [values]
+        for offset, value in enumerate(values):
+            machine.write_data(address + offset, number(value))
+
+def collect(machine, outputs):
+    record = dict()
+    for output in outputs:
+        fields = output.split(':')
+        if fields[0] == 'pc':
+            record['pc'] = machine.pc
+        elif fields[0] == 'instructions':
+            record['instructions'] = machine.instruction_count
+        elif fields[0] == 'cycles':
+            record['cycles'] = machine.cycle_count
+        elif fields[0] == 'time':
+            record['time'] = machine.emulated_time
+        elif fields[0] == 'registers':
+            record['registers'] = machine.registers()
+        elif fields[0] == 'io':
+            io = number(fields[1]) if fields[1].startswith('0x') else fields[1]
+            record.setdefault('io', dict())[fields[1]] = machine.get_io(io)
+        elif fields[0] == 'data':
+            address = number(fields[1])
+            count = number(fields[2]) if len(fields) > 2 else 1
+            record.setdefault('data', dict())[fields[1]] = [machine.read_data(address + offset) for offset in range(count)]
+        else:
+            raise ValueError('Unknown output: %s' % output)
+    return record
+
+def runJob(indexedJob):
+    (index, job) = indexedJob
+    record = dict([('job', index), ('rom', job['rom'])])
+    start = time.perf_counter()
+    machine = None
+    try:
+        machine = getMachine(*jobMachine(job))
+        machine.reset()
+        if 'checkpoint' in job:
+            machine.load_checkpoint(job['checkpoint'])
+        if 'pc' in job:
+            machine.pc = number(job['pc'])
+        if 'flash' in job:
+            machine.open_flash(job['flash'])
+        if 'adc_wav' in job:
+            machine.open_adc(job['adc_wav'])
+        if 'dac_wav' in job:
+            machine.open_dac(job['dac_wav'])
+        applyStimulus(machine, job.get('stimulus', dict()))
+        maxInstructions = number(job.get('max_instructions', DEFAULT_MAX_INSTRUCTIONS))
+        if 'until' in job and machine.run_until(number(job['until']), maxInstructions):
+            record['stopped'] = 'until'
+        else:
+            if 'until' not in job:
+                machine.run(maxInstructions)
+            record['stopped'] = 'max_instructions'
+        record.update(collect(machine, job.get('collect', DEFAULT_COLLECT)))
+        if 'save' in job:
+            machine.save_checkpoint(job['save'])
+    except Exception as e:
+        record['stopped'] = 'error'
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        if machine is not None:
+            machine.close_dac()
+            machine.close_adc()
+            machine.close_flash()
+    record['seconds'] = round(time.perf_counter() - start, 6)
+    return record
+
+def initWorker():
+    # Emulator messages would get mixed with the records
+    emulator.traceLevel = emulator.TRACE_OFF
+    sys.stdout = sys.stderr
+
+def loadManifest(path):
+    with open(path) as f:
+        jobs = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    for job in jobs:
+        for key in ['rom', 'checkpoint', 'save', 'flash', 'adc_wav', 'dac_wav']:
+            if key in job:
+                job[key] = os.path.join(base, job[key])
+    return jobs
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many S9KE emulator jobs in parallel')
+    parser.add_argument('manifest', help='JSON list of jobs')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='file to write records to (default: standard output)')
+    args = parser.parse_args()
+    jobs = loadManifest(args.manifest)
+    # Load every ROM (and compile it) once before starting the workers: forked workers share the mappings
+    initWorker()
+    for key in set(jobMachine(job) for job in jobs):
+        try:
+            getMachine(*key)
+        except Exception:
+            # Reported by the jobs using it
+            pass
+    output = open(args.output, 'w') if args.output else sys.__stdout__
+    with multiprocessing.Pool(args.jobs, initializer=initWorker) as pool:
+        for record in pool.imap_unordered(runJob, enumerate(jobs)):
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+    if args.output:
+        output.close()
+
+if __name__ == '__main__':
+    main()
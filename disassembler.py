@@ -417,9 +417,6 @@ with open(FW, 'rb') as f:
             offset = low & 0b_0011_1111
             mnemonic = pushpop(r)
             print_instruction(address, '%s IO(%s)' % (mnemonic, hex(offset, 2)), 'I/O register = %s' % (ioRegisterLabel(offset)), True)
-        # Reserved  FIXME Should throw en error ???
-        elif high == 0b_1111_1100 and (low & 0b_1000_0000) >> 7 == 0b_0:
-            print_instruction(address, 'Reserved', '', True)
         # Callff (2-words instruction)
         elif high == 0b_1111_1101:
             abs_addr_high = low
@@ -4,28 +4,47 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import argparse
+import copy
+import hashlib
+import heapq
+import marshal
+import mmap
 import os
+import queue
 import signal
+import struct
 import sys
+import threading
 import re
-from math import copysign
+import wave
+
+try:
+    import numpy
+except ImportError:
+    # MAC loops are then accumulated in Python (see runMacLoop)
+    numpy = None
+from array import array
 
 FW = '../FW_2_6/rom_2_6.bin'
 
 
-# Internal registers
-internal = {
-    'X0': 0x0000,
-    'X1': 0x0000,
-    'Y0': 0x0000,
-    'Y1': 0x0000,
-    'R0': 0x0000,
-    'R1': 0x0000,
-    'MR0': 0x0000,
-    'MR1': 0x0000
-}
-# I/O registers
-ioReg = {
+# Internal registers, indexed like registers_reg
+X0, X1, R0, R1, Y0, Y1, MR0, MR1 = range(8)
+internal = array('H', [0x0000] * 8)
+# I/O registers, indexed by I/O address (see ioRegisters)
+IO_SSF = 0x00
+IO_RAMBK = 0x0d
+IO_PCH = 0x15
+IO_PCL = 0x16
+IO_MMR = 0x17
+IO_SP = 0x18
+IO_MR2 = 0x19
+IO_SHIDX = 0x3e
+IO_SYSCONF = 0x7c
+ioReg = array('H', [0x0000] * 0x80)
+# Reset values of I/O registers
+ioRegResetValues = {
     'SSF': 0x0000,          # bit5: Index Register Overflow Flag   bit4: MAC Overflow Flag  bit3: Arithmetic Overflow Flag  bit2: Carry Flag    bit1: Negative Flag bit0: Zero Flag
     'SCR': 0x0002,
 	'Ix0': 0x0000,
@@ -38,7 +57,7 @@ ioReg = {
 	'Im11': 0x0000,         # Ix1/Iy1 modifier: ', m'   (value can be changed)
 	'Im12': 0x0001,         # Ix1/Iy1 modifier: ', 1'
 	'Im13': 0xffff,         # Ix1/Iy1 modifier: ', -1'
-	'OPM_CTRL': 0x0003,
+	'OPM_CONTROL': 0x0003,
 	'RAMBk': 0x00,
 	'Ix0Bk': 0x00,
 	'Ix1Bk': 0x00,
@@ -145,14 +164,10 @@ ioReg = {
 	'ADM': 0x0000,
 	'ADR': 0x0000
 }
-# Program RAM
-PRAM = [0x0000] * 0x8000
-# Working RAM
-WRAM = [0x0000] * 0x4000
-# Part of the WRAM (up to 12K words) can be assigned to Program RAM (0x200000-0x202fff)
-PRAM200000 = [0x0000] * 0x3000
-# Entire ROM is loaded into External Program Memory (0x400000-0xbfffff)
-CS1ROM = [0x0000] * 0x800000
+# Program RAM, Working RAM and memory mapped devices are accessed through the memory bus (see mapMemory)
+# Entire ROM is mapped into External Program Memory (0x400000-0xbfffff), see loadROM
+# Words past the end of the ROM file read as 0x0000
+CS1ROM = array('H')
 
 
 
@@ -196,6 +211,25 @@ operandYop = ['Y0', 'Y1', 'R0', 'R1']
 def operand2(Yop):
     return operandYop[Yop]
 
+def auOperation(AU, first_operand, second_operand):
+    # FIXME What is C ??? --> Carry ???
+    if AU == 0b_000:
+        return '%s + 1' % (first_operand)
+    elif AU == 0b_001:
+        return '%s - 1' % (first_operand)
+    elif AU == 0b_010:
+        return '%s + %s' % (first_operand, second_operand)
+    elif AU == 0b_011:
+        return '%s + %s + C' % (first_operand, second_operand)
+    elif AU == 0b_100:
+        return '%s - %s' % (first_operand, second_operand)
+    elif AU == 0b_101:
+        return '%s - %s + C - 1' % (first_operand, second_operand)
+    elif AU == 0b_110:
+        return '-%s + %s' % (first_operand, second_operand)
+    elif AU == 0b_111:
+        return '-%s + %s + C - 1' % (first_operand, second_operand)
+
 lu2Mnemonics = ['BCLR', 'BSET', 'BTOG', 'BTST']
 def lu2(LU2):
     return lu2Mnemonics[LU2]
@@ -338,6 +372,25 @@ ioRegisters = dict([
 ])
 def ioRegisterLabel(ioReg):
     return ioRegisters.get(ioReg, "NOT FOUND") #ioRegisters[ioReg]
+ioAddresses = dict([(label, address) for (address, label) in ioRegisters.items()])
+
+def resetIORegisters():
+    for address in range(len(ioReg)):
+        ioReg[address] = 0x0000
+    for (label, value) in ioRegResetValues.items():
+        ioReg[ioAddresses[label]] = value
+resetIORegisters()
+# Functions called before an instruction reads an I/O register, and after it writes one, indexed by I/O address
+ioReadHooks = [None] * 0x80
+ioWriteHooks = [None] * 0x80
+
+# Indirect registers: (index register, bank register, first modifier register) I/O addresses
+# The modifier register used by an access is the first one + A (see modifiers)
+indirectRegisters = [(0x02, 0x0e, 0x04), (0x03, 0x0f, 0x08), (0x13, 0x1a, 0x04), (0x14, 0x1b, 0x08)]
+# Index of the internal register designated by each operand field
+operandXopIndex = [X0, X1, R0, R1]
+operandYopIndex = [Y0, Y1, R0, R1]
+destXYIndex = [X0, X1, Y0, Y1]
 
 class bcolors:
     ADDRESS = '\033[90m'
@@ -351,6 +404,15 @@ class bcolors:
     RAM = '\033[1m\033[95m'
     ENDC = '\033[0m'
 
+# Trace levels: nothing, executed instructions only, instructions and all their side effects
+# Callers check the level before calling print_instruction/print_execution, so that messages
+# of disabled levels are never formatted
+TRACE_OFF = 0
+TRACE_INSTRUCTIONS = 1
+TRACE_FULL = 2
+traceLevels = ['off', 'instructions', 'full']
+traceLevel = TRACE_FULL
+
 def print_instruction(address, instr, comment='', wip=False):
     flag = ''
     if wip:
@@ -371,53 +433,307 @@ def print_control(message):
 
 
 def incrementPC(count = 1):
-    global ioReg
-    summedL = ioReg['PCL'] + count
-    ioReg['PCL'] = summedL & 0xffff
+    summedL = ioReg[IO_PCL] + count
+    ioReg[IO_PCL] = summedL & 0xffff
     carry = (summedL & 0xff0000) >> 16
     if carry > 0:
-        summedH = ioReg['PCH'] + carry
-        ioReg['PCH'] = summedH & 0xff
+        summedH = ioReg[IO_PCH] + carry
+        ioReg[IO_PCH] = summedH & 0xff
         if summedH > 0xff:
             # TODO Handle PC overflow ???
             raise
-    print_execution(f"{bcolors.REGVAL}PC{bcolors.ENDC}{bcolors.EXECUTION} was incremented to {bcolors.REGVAL}{hex((ioReg['PCH'] << 16) | ioReg['PCL'], 6)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"{bcolors.REGVAL}PC{bcolors.ENDC}{bcolors.EXECUTION} was incremented to {bcolors.REGVAL}{hex((ioReg[IO_PCH] << 16) | ioReg[IO_PCL], 6)}{bcolors.ENDC}{bcolors.EXECUTION}")
 
 def setPC(newPC):
-    global ioReg
-    ioReg['PCL'] = (newPC) & 0xffff
-    ioReg['PCH'] = ((newPC & 0xff0000) >> 16) & 0xff
-    print_execution(f"{bcolors.REGVAL}PC{bcolors.ENDC}{bcolors.EXECUTION} was set to {bcolors.REGVAL}{hex((ioReg['PCH'] << 16) | ioReg['PCL'], 6)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    ioReg[IO_PCL] = (newPC) & 0xffff
+    ioReg[IO_PCH] = ((newPC & 0xff0000) >> 16) & 0xff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"{bcolors.REGVAL}PC{bcolors.ENDC}{bcolors.EXECUTION} was set to {bcolors.REGVAL}{hex((ioReg[IO_PCH] << 16) | ioReg[IO_PCL], 6)}{bcolors.ENDC}{bcolors.EXECUTION}")
 
-def getOpCode(PC):
-    global PRAM
-    global CS1ROM
-    if PC < 0x8000:
-        return PRAM[PC]
-    elif PC >= 0x200000 and PC < 0x203000:
-        return PRAM200000[PC - 0x200000]
-    elif PC >= 0x400000 and PC < 0xC00000:
-        return CS1ROM[PC - 0x400000]
-    else:
-        # TODO ???
-        print_error('Cannot get opcode at address %s' % hex(PC, 6))
+# Memory bus
+# Program and data spaces are split into pages of PAGE_SIZE words. Each space has a page table, indexed by
+# address >> PAGE_BITS, holding the object serving every access to the page: RAM, ROM, MMIO or unmapped.
+PAGE_BITS = 10
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+PAGE_COUNT = 0x1000000 >> PAGE_BITS
+PRAM_WINDOW = 0x200000
+CS1ROM_BASE = 0x400000
+CS1ROM_SIZE = 0x800000
+zeroPage = array('H', [0x0000] * PAGE_SIZE)
+
+class RAMPage:
+    """RAM page, backed by zeroes, ROM words or a snapshot until its next write, which gives it its own copy"""
+    __slots__ = ('words', 'owned', 'written', 'programBase')
+
+    def __init__(self, words=zeroPage):
+        self.words = words
+        self.owned = False
+        self.written = False        # Written since the page was mapped
+        self.programBase = None     # Program address of the first word, when the page also holds code
+
+    def read(self, address):
+        return self.words[address & PAGE_MASK]
+    fetch = read
+
+    def write(self, address, value):
+        if not self.owned:
+            self.words = array('H', self.words)
+            self.owned = True
+            self.written = True
+        self.words[address & PAGE_MASK] = value
+
+    def writeWords(self, address, words):
+        if not self.owned:
+            self.words = array('H', self.words)
+            self.owned = True
+            self.written = True
+        offset = address & PAGE_MASK
+        self.words[offset:offset + len(words)] = words
+
+class ROMPage:
+    __slots__ = ('words',)
+    programBase = None
+
+    def __init__(self, words):
+        self.words = words
+
+    def read(self, address):
+        return self.words[address & PAGE_MASK]
+    fetch = read
+
+    def write(self, address, value):
+        print_error('Cannot write ROM at address %s' % hex(address, 6))
+        raise
+
+class MMIOPage:
+    """Memory mapped devices, dispatched by address to mmioReadHooks/mmioWriteHooks"""
+    __slots__ = ()
+    programBase = None
+
+    def read(self, address):
+        hook = mmioReadHooks.get(address)
+        if hook is None:
+            # FIXME Reads as 0 until the device is implemented
+            print_error('NOT YET IMPLEMENTED (reading from MMIO: %s)' % hex(address, 6))
+            return 0x0000
+        return hook(address)
+    fetch = read
+
+    def write(self, address, value):
+        hook = mmioWriteHooks.get(address)
+        if hook is None:
+            print_error('NOT YET IMPLEMENTED (writing to MMIO: %s)' % hex(address, 6))
+            return
+        hook(address, value)
+
+class UnmappedPage:
+    __slots__ = ('space',)
+    programBase = None
+
+    def __init__(self, space):
+        self.space = space
+
+    def read(self, address):
+        print_error('Cannot read %s memory at address %s' % (self.space, hex(address, 6)))
         raise
+    fetch = read
+
+    def write(self, address, value):
+        print_error('Cannot write %s memory at address %s' % (self.space, hex(address, 6)))
+        raise
+
+class WatchPage:
+    """Page holding watchpoints, wrapping the page actually serving the accesses (see installWatchpoints)"""
+    __slots__ = ('page', 'space', 'reads', 'writes')
+
+    def __init__(self, page, space):
+        self.page = page
+        self.space = space
+        self.reads = set()
+        self.writes = set()
+
+    @property
+    def programBase(self):
+        return self.page.programBase
+
+    def read(self, address):
+        value = self.page.read(address)
+        if address in self.reads and watching:
+            watchpointHit(self.space, address, 'r', value)
+        return value
+
+    def fetch(self, address):
+        # Fetching instructions does not trigger read watchpoints
+        return self.page.read(address)
+
+    def write(self, address, value):
+        self.page.write(address, value)
+        if address in self.writes and watching:
+            watchpointHit(self.space, address, 'w', value)
+
+mmioReadHooks = dict()      # data address -> function(address) returning the word read
+mmioWriteHooks = dict()     # data address -> function(address, value)
+
+# Chip profiles: sizes (in words) of the memory regions
+# Part of the WRAM (0 to 12K words, selected by SYSCONF) is shared with the Program RAM window at 0x200000
+chipProfiles = dict([
+    ('SNC7001A', dict([('pram', 0x8000), ('wram', 0x4000), ('sharedPram', [0x0000, 0x1000, 0x2000, 0x3000])])),
+    # FIXME Sizes to be checked against the SNP70032 spec sheet
+    ('SNP70032', dict([('pram', 0x4000), ('wram', 0x2000), ('sharedPram', [0x0000, 0x0800, 0x1000, 0x2000])])),
+])
+chip = chipProfiles['SNC7001A']
+
+def chipName():
+    return [name for name, profile in chipProfiles.items() if profile is chip][0]
+
+unmappedProgram = UnmappedPage('program')
+unmappedData = UnmappedPage('data')
+programPages = [unmappedProgram] * PAGE_COUNT
+dataPages = [unmappedData] * PAGE_COUNT
+
+def romPageWords(offset):
+    # Words of the ROM page starting at offset, without copying them unless the page is incomplete
+    if offset + PAGE_SIZE <= len(CS1ROM):
+        return CS1ROM[offset:offset + PAGE_SIZE]
+    elif offset < len(CS1ROM):
+        words = array('H', CS1ROM[offset:])
+        return words + array('H', [0x0000] * (PAGE_SIZE - len(words)))
+    return zeroPage
+
+def mapMemory(profile):
+    global chip
+    global programPages
+    global dataPages
+    chip = profile
+    programPages = [unmappedProgram] * PAGE_COUNT
+    dataPages = [unmappedData] * PAGE_COUNT
+    # Program RAM, initialized with the beginning of the ROM (copied on first write)
+    for page in range(chip['pram'] >> PAGE_BITS):
+        programPages[page] = RAMPage(romPageWords(page << PAGE_BITS))
+    # External Program Memory (SPI flash), pages after the end of the ROM read as 0x0000
+    emptyROMPage = ROMPage(zeroPage)
+    for page in range(CS1ROM_SIZE >> PAGE_BITS):
+        offset = page << PAGE_BITS
+        programPages[(CS1ROM_BASE >> PAGE_BITS) + page] = ROMPage(romPageWords(offset)) if offset < len(CS1ROM) else emptyROMPage
+    # Working RAM, then memory mapped devices up to the Program RAM window
+    for page in range(chip['wram'] >> PAGE_BITS):
+        dataPages[page] = RAMPage()
+    mmio = MMIOPage()
+    for page in range(chip['wram'] >> PAGE_BITS, PRAM_WINDOW >> PAGE_BITS):
+        dataPages[page] = mmio
+    mapSharedPRAM()
+
+def mapSharedPRAM():
+    removeWatchPages()
+    # FIXME SYSCONF bits [3:2] are assumed to select the size, shared words are assumed to be the last ones of the WRAM
+    shared = chip['sharedPram'][(ioReg[IO_SYSCONF] >> 2) & 0b11]
+    first = (chip['wram'] - shared) >> PAGE_BITS
+    for page in range(chip['wram'] >> PAGE_BITS):
+        dataPages[page].programBase = None
+    for page in range(max(chip['sharedPram']) >> PAGE_BITS):
+        window = (PRAM_WINDOW >> PAGE_BITS) + page
+        if page < shared >> PAGE_BITS:
+            dataPages[first + page].programBase = window << PAGE_BITS
+            programPages[window] = dataPages[first + page]
+            dataPages[window] = dataPages[first + page]
+        else:
+            programPages[window] = unmappedProgram
+            dataPages[window] = unmappedData
+    # Code previously mapped in the window is gone
+    for address in [address for address in codeWords if address >= PRAM_WINDOW and address < CS1ROM_BASE]:
+        invalidateCode(address)
+    installWatchpoints()
+    if traceLevel >= TRACE_FULL:
+        print_execution('%d words of WRAM mapped as Program RAM at %s' % (shared, hex(PRAM_WINDOW, 6)))
+
+def readProgram(address):
+    return programPages[address >> PAGE_BITS].read(address)
+
+def readData(address):
+    return dataPages[address >> PAGE_BITS].read(address)
+
+def writeData(address, value):
+    page = dataPages[address >> PAGE_BITS]
+    page.write(address, value)
+    if traceWriter is not None:
+        traceWriter.writes.append((address, value))
+    if page.programBase is not None:
+        codeAddress = page.programBase | (address & PAGE_MASK)
+        if codeAddress in codeWords:
+            invalidateCode(codeAddress)
+
+def writeDataWords(address, words):
+    """Write consecutive words of data memory, as one slice per RAM page"""
+    position = 0
+    while position < len(words):
+        page = dataPages[address >> PAGE_BITS]
+        count = min(len(words) - position, PAGE_SIZE - (address & PAGE_MASK))
+        if type(page) is not RAMPage or traceWriter is not None:
+            # Devices, watched pages and traced writes go word by word
+            for index in range(count):
+                writeData(address + index, words[position + index])
+        else:
+            page.writeWords(address, words[position:position + count])
+            if page.programBase is not None:
+                for index in range(count):
+                    codeAddress = page.programBase | ((address + index) & PAGE_MASK)
+                    if codeAddress in codeWords:
+                        invalidateCode(codeAddress)
+        address += count
+        position += count
+
+def programWords(address, count):
+    """Consecutive words of program memory, as one slice per RAM or ROM page"""
+    words = array('H')
+    while len(words) < count:
+        page = programPages[address >> PAGE_BITS]
+        inPage = min(count - len(words), PAGE_SIZE - (address & PAGE_MASK))
+        if type(page) in [RAMPage, ROMPage]:
+            words.extend(page.words[address & PAGE_MASK:(address & PAGE_MASK) + inPage])
+        else:
+            words.extend([readProgram(address + offset) for offset in range(inPage)])
+        address += inPage
+    return words
+
+def writeProgramWords(address, words):
+    """Write consecutive words of Program RAM, as one slice per page"""
+    position = 0
+    while position < len(words):
+        page = programPages[address >> PAGE_BITS]
+        count = min(len(words) - position, PAGE_SIZE - (address & PAGE_MASK))
+        if type(page) is WatchPage:
+            # Program memory watchpoints only fire on instructions
+            page = page.page
+        if type(page) is not RAMPage:
+            print_error('Cannot write program memory at address %s' % hex(address, 6))
+            raise
+        page.writeWords(address, words[position:position + count])
+        for codeAddress in range(address, address + count):
+            if codeAddress in codeWords:
+                invalidateCode(codeAddress)
+        address += count
+        position += count
+
+def getOpCode(PC):
+    return programPages[PC >> PAGE_BITS].fetch(PC)
 
 def push(value):
-    global ioReg
-    global WRAM
-    WRAM[ioReg['Sp']] = value
-    print_execution(f"Pushed {bcolors.REGVAL}{hex(value, 4)}{bcolors.ENDC}{bcolors.EXECUTION} on stack")
-    ioReg['Sp'] = ioReg['Sp'] + 1
-    print_execution(f"{bcolors.REGVAL}Sp{bcolors.ENDC}{bcolors.EXECUTION} incremented to {bcolors.REGVAL}{hex(ioReg['Sp'], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    writeData(ioReg[IO_SP], value)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Pushed {bcolors.REGVAL}{hex(value, 4)}{bcolors.ENDC}{bcolors.EXECUTION} on stack")
+    ioReg[IO_SP] = (ioReg[IO_SP] + 1) & 0xffff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"{bcolors.REGVAL}Sp{bcolors.ENDC}{bcolors.EXECUTION} incremented to {bcolors.REGVAL}{hex(ioReg[IO_SP], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
 
 def pop():
-    global ioReg
-    global WRAM
-    popped = WRAM[ioReg['Sp']-1]
-    print_execution(f"Popped {bcolors.REGVAL}{hex(popped, 4)}{bcolors.ENDC}{bcolors.EXECUTION} from stack")
-    ioReg['Sp'] = ioReg['Sp'] - 1
-    print_execution(f"{bcolors.REGVAL}Sp{bcolors.ENDC}{bcolors.EXECUTION} decremented to {bcolors.REGVAL}{hex(ioReg['Sp'], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    popped = readData((ioReg[IO_SP] - 1) & 0xffff)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Popped {bcolors.REGVAL}{hex(popped, 4)}{bcolors.ENDC}{bcolors.EXECUTION} from stack")
+    ioReg[IO_SP] = (ioReg[IO_SP] - 1) & 0xffff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"{bcolors.REGVAL}Sp{bcolors.ENDC}{bcolors.EXECUTION} decremented to {bcolors.REGVAL}{hex(ioReg[IO_SP], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
     return popped
 
 flags = dict([
@@ -429,608 +745,694 @@ flags = dict([
     ('ZF', 0b_00_0001)
 ])
 def setFlag(flagName):
-    global ioReg
-    ioReg['SSF'] = ioReg['SSF'] | flags[flagName]
-    print_execution(f"Flag {bcolors.REGVAL}{flagName}{bcolors.ENDC}{bcolors.EXECUTION} was set")
+    ioReg[IO_SSF] = ioReg[IO_SSF] | flags[flagName]
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Flag {bcolors.REGVAL}{flagName}{bcolors.ENDC}{bcolors.EXECUTION} was set")
 def clearFlag(flagName):
-    global ioReg
-    ioReg['SSF'] = ioReg['SSF'] & ~flags[flagName]
-    print_execution(f"Flag {bcolors.REGVAL}{flagName}{bcolors.ENDC}{bcolors.EXECUTION} was cleared")
+    ioReg[IO_SSF] = ioReg[IO_SSF] & ~flags[flagName]
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Flag {bcolors.REGVAL}{flagName}{bcolors.ENDC}{bcolors.EXECUTION} was cleared")
 def getFlag(flagName):
-    if (ioReg['SSF'] & flags[flagName]) != 0:
+    if pendingFlags is not None:
+        materializeFlags()
+    if (ioReg[IO_SSF] & flags[flagName]) != 0:
         return 1
     else:
         return 0
 
-sign = lambda x : copysign(1, x)
+# Lazy condition flags
+# ALU instructions only record their result and operands, ZF/NF/CF/AOF are computed from them when SSF
+# is actually read (getFlag, conditional jumps, SSF I/O reads). Most results are never tested.
+FLAGS_ADD = 0       # result = first + second (+ carry), AOF on signed overflow
+FLAGS_SUB = 1       # result = first - second (+ carry - 1), AOF on signed overflow
+FLAGS_LOGIC = 2     # CF and AOF cleared
+FLAGS_SHIFT = 3     # CF is the last bit shifted out (first), AOF cleared
+ALU_FLAGS = flags['AOF'] | flags['CF'] | flags['NF'] | flags['ZF']
+pendingFlags = None
 
-def incrementIndexRegister(indirectRegName, modif):
-    modifierReg = 'Im' + indirectRegName[-1] + str(modif)
-    print_execution('Updating indirect register %s with modifier register %s' % (indirectRegName, modifierReg))
-    summedIx = ioReg[indirectRegName] + ioReg[modifierReg]
-    ioReg[indirectRegName] = summedIx & 0xffff
-    carry = (summedIx & 0xff0000) >> 8
-    if carry > 0:
+def recordFlags(kind, result, first, second):
+    global pendingFlags
+    pendingFlags = (kind, result, first, second)
+    if traceLevel >= TRACE_FULL:
+        materializeFlags()
+
+def materializeFlags():
+    global pendingFlags
+    (kind, result, first, second) = pendingFlags
+    pendingFlags = None
+    truncated = result & 0xffff
+    ssf = 0
+    if truncated == 0x0000:
+        ssf |= flags['ZF']
+    if truncated & 0x8000: # FIXME signed ???
+        ssf |= flags['NF']
+    if kind == FLAGS_ADD:
+        # FIXME carry ???
+        if result > 0xffff:
+            ssf |= flags['CF']
+        if (first ^ truncated) & (second ^ truncated) & 0x8000:
+            ssf |= flags['AOF']
+    elif kind == FLAGS_SUB:
+        # FIXME For substraction, CF=0 if borrowing !!!
+        if result > 0xffff:
+            ssf |= flags['CF']
+        if (first ^ second) & (first ^ truncated) & 0x8000:
+            ssf |= flags['AOF']
+    elif kind == FLAGS_SHIFT:
+        if first:
+            ssf |= flags['CF']
+    ioReg[IO_SSF] = (ioReg[IO_SSF] & ~ALU_FLAGS) | ssf
+    if traceLevel >= TRACE_FULL:
+        for flagName in ['ZF', 'NF', 'CF', 'AOF']:
+            print_execution(f"Flag {bcolors.REGVAL}{flagName}{bcolors.ENDC}{bcolors.EXECUTION} was {'set' if ssf & flags[flagName] else 'cleared'}")
+
+def readSSF():
+    if pendingFlags is not None:
+        materializeFlags()
+
+def writeSSF():
+    # Flags written by the instruction replace the ones of the last ALU result
+    global pendingFlags
+    pendingFlags = None
+
+
+def incrementIndexRegister(ix, bk, im):
+    if traceLevel >= TRACE_FULL:
+        print_execution('Updating indirect register %s with modifier register %s' % (ioRegisterLabel(ix), ioRegisterLabel(im)))
+    # Modifiers are signed (0xffff: -1), overflowing the 16-bit index register carries into its bank register
+    summedIx = ioReg[ix] + signed16(ioReg[im])
+    ioReg[ix] = summedIx & 0xffff
+    carry = summedIx >> 16
+    if carry != 0:
         setFlag('IOF')
-        summedBk = ioReg[bkReg] + carry
-        ioReg[bkReg] = summedBk & 0xff
-        print_execution('Indirect register OVERFLOW: incremented bank register %s by %s to %s' % (bkReg, hex(carry, 2), hex(ioReg[BkReg], 2)))
-        if summedBk > 0xff:
+        summedBk = ioReg[bk] + carry
+        ioReg[bk] = summedBk & 0xff
+        if traceLevel >= TRACE_FULL:
+            print_execution('Indirect register OVERFLOW: incremented bank register %s by %d to %s' % (ioRegisterLabel(bk), carry, hex(ioReg[bk], 2)))
+        if summedBk > 0xff or summedBk < 0:
             # TODO Handle Bk overflow ???
             raise
     else:
         clearFlag('IOF')
-    print_execution(f"Indirect register {bcolors.REGVAL}{indirectRegName}{bcolors.ENDC}{bcolors.EXECUTION} incremented by {hex(ioReg[modifierReg], 4)} to {bcolors.REGVAL}{hex(ioReg[indirectRegName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-
-def setRegisterImmediate(reg1Name, hiloSuffix, value):
-    global internal
-    global ioReg
-    if reg1Name == 'Ix0' or reg1Name == 'Ix1':
-        if hiloSuffix == '.h':
-            ioReg[reg1Name] = (value & 0xff) << 8 | (ioReg[reg1Name] & 0xff)
-        elif hiloSuffix == '.l':
-            ioReg[reg1Name] = (ioReg[reg1Name] & 0xff00) | (value & 0xff)
-        else:
-            ioReg[reg1Name] = value & 0xff
-        print_execution(f"Register {bcolors.REGVAL}{reg1Name}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(ioReg[reg1Name], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Indirect register {bcolors.REGVAL}{ioRegisterLabel(ix)}{bcolors.ENDC}{bcolors.EXECUTION} incremented by {hex(ioReg[im], 4)} to {bcolors.REGVAL}{hex(ioReg[ix], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+
+def setRegisterImmediate(reg, L, value):
+    if L == 0b_00:
+        internal[reg] = (value & 0xff) << 8 | (internal[reg] & 0xff)
+    elif L == 0b_10:
+        internal[reg] = (internal[reg] & 0xff00) | (value & 0xff)
     else:
-        if hiloSuffix == '.h':
-            internal[reg1Name] = (value & 0xff) << 8 | (internal[reg1Name] & 0xff)
-        elif hiloSuffix == '.l':
-            internal[reg1Name] = (internal[reg1Name] & 0xff00) | (value & 0xff)
-        else:
-            internal[reg1Name] = value & 0xff
-        print_execution(f"Register {bcolors.REGVAL}{reg1Name}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[reg1Name], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-
-def setRegisterFromROM(regName, indirectRegName, modif):
-    global internal
-    global ioReg
-    global PRAM
-    bkReg = indirectRegName + 'Bk'
-    offset = ioReg[bkReg] + ioReg[indirectRegName]
-    if offset < 0x8000:
-        internal[regName] = PRAM[offset]
-    elif offset >= 0x200000 and offset < 0x203000:
-        internal[regName] = PRAM200000[offset - 0x200000]
-    elif offset >= 0x400000 and offset < 0xC00000:
-        internal[regName] =  CS1ROM[offset - 0x400000]
+        internal[reg] = value & 0xff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[reg]}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+
+def setIndexRegisterImmediate(ix, L, value):
+    if L == 0b_00:
+        ioReg[ix] = (value & 0xff) << 8 | (ioReg[ix] & 0xff)
+    elif L == 0b_10:
+        ioReg[ix] = (ioReg[ix] & 0xff00) | (value & 0xff)
     else:
-        # TODO ???
-        print_error('Cannot read ROM at address %s' % hex(offset, 6))
-        raise
-    print_execution(f"Register {bcolors.REGVAL}{regName}{bcolors.ENDC}{bcolors.EXECUTION} set by {bcolors.ROM}ROM({hex(offset, 6)}){bcolors.ENDC}{bcolors.EXECUTION} to {bcolors.REGVAL}{hex(internal[regName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-    incrementIndexRegister(indirectRegName, modif)
-
-def setRegFromIO(regLName, ioRegName):
-    global internal
-    global ioReg
-    internal[regLName] = ioReg[ioRegName]
-    print_execution(f"Register {bcolors.REGVAL}{regLName}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regLName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-
-def setIOFromReg(ioRegName, regLName):
-    global internal
-    global ioReg
-    ioReg[ioRegName] = internal[regLName]
-    print_execution(f"I/O register {bcolors.REGVAL}{ioRegName}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(ioReg[ioRegName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+        ioReg[ix] = value & 0xff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{ioRegisterLabel(ix)}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(ioReg[ix], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+
+def setRegisterFromROM(reg, ix, bk, im):
+    offset = ioReg[bk] + ioReg[ix]
+    internal[reg] = readProgram(offset)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[reg]}{bcolors.ENDC}{bcolors.EXECUTION} set by {bcolors.ROM}ROM({hex(offset, 6)}){bcolors.ENDC}{bcolors.EXECUTION} to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    incrementIndexRegister(ix, bk, im)
+
+def setRegFromIO(regL, io):
+    if ioReadHooks[io] is not None:
+        ioReadHooks[io]()
+    internal[regL] = ioReg[io]
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[regL]}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regL], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+
+def setIOFromReg(io, regL):
+    ioReg[io] = internal[regL]
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"I/O register {bcolors.REGVAL}{ioRegisterLabel(io)}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(ioReg[io], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    if ioWriteHooks[io] is not None:
+        ioWriteHooks[io]()
     
-def computeAUWithRegisters(regName, AU, first_operand, second_operand):
-    global internal
-    carry = getFlag('CF')
-    if AU == 0b_000:
-        result = internal[first_operand] + 1
-        if sign(internal[first_operand]) == 1 and sign(result) == -1:
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    elif AU == 0b_001:
-        result = internal[first_operand] - 1
-        if sign(internal[first_operand]) == -1 and sign(result) == 1:
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    elif AU == 0b_010:
-        result = internal[first_operand] + internal[second_operand]
-        if sign(internal[first_operand])==sign(internal[second_operand]) and sign(result)!=sign(internal[first_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    elif AU == 0b_011:
-        # FIXME WHAT IS C ??? --> Carry ???
-        result = internal[first_operand] + internal[second_operand] + carry
-        #operation = '%s + %s + C' % (first_operand, second_operand)
-        if sign(internal[first_operand])==sign(internal[second_operand]) and sign(result)!=sign(internal[first_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    elif AU == 0b_100:
-        result = internal[first_operand] - internal[second_operand]
-        if sign(internal[first_operand])!=sign(internal[second_operand]) and sign(result)!=sign(internal[first_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    elif AU == 0b_101:
-        # FIXME WHAT IS C ??? --> Carry ???
-        result = internal[first_operand] - internal[second_operand] + carry - 1
-        #operation = '%s - %s + C - 1' % (first_operand, second_operand)
-        if sign(internal[first_operand])!=sign(internal[second_operand]) and sign(result)!=sign(internal[first_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    elif AU == 0b_110:
-        result = -internal[first_operand] + internal[second_operand]
-        if sign(internal[first_operand])!=sign(internal[second_operand]) and sign(result)!=sign(internal[second_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    elif AU == 0b_111:
-        # FIXME WHAT IS C ??? --> Carry ???
-        result = -internal[first_operand] + internal[second_operand] + carry - 1
-        #operation = '-%s + %s + C - 1' % (first_operand, second_operand)
-        if sign(internal[first_operand])!=sign(internal[second_operand]) and sign(result)!=sign(internal[second_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    internal[regName] = result & 0xffff
-    print_execution(f"Register {bcolors.REGVAL}{regName}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-    # Update Flags
-    if internal[regName] == 0x0000:
-        setFlag('ZF')
-    else:
-        clearFlag('ZF')
-    if (internal[regName] & 0x8000) >> 15 == 0b_1: # FIXME signed ???
-        setFlag('NF')
-    else:
-        clearFlag('NF')
-    # FIXME For substraction, CF=0 if borrowing !!!
-    if (result >> 16) > 0: # FIXME carry ???
-        setFlag('CF')
-    else:
-        clearFlag('CF')
-
-def computeAUWithRegistersToRAM(indirectRegName, modif, AU, first_operand, second_operand):
-    global internal
-    global WRAM
-    global PRAM200000
-    bkReg = indirectRegName + 'Bk'
-    offset = ioReg[bkReg] + ioReg[indirectRegName]
-    carry = getFlag('CF')
+def computeAU(AU, first_operand, second_operand):
+    # Result of an AU operation on internal registers, its flags are recorded for later evaluation
+    first = internal[first_operand]
+    second = internal[second_operand]
     if AU == 0b_000:
-        result = internal[first_operand] + 1
-        if sign(internal[first_operand]) == 1 and sign(result) == -1:
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
+        result = first + 1
+        recordFlags(FLAGS_ADD, result, first, 1)
     elif AU == 0b_001:
-        result = internal[first_operand] - 1
-        if sign(internal[first_operand]) == -1 and sign(result) == 1:
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
+        result = first - 1
+        recordFlags(FLAGS_SUB, result, first, 1)
     elif AU == 0b_010:
-        result = internal[first_operand] + internal[second_operand]
-        if sign(internal[first_operand])==sign(internal[second_operand]) and sign(result)!=sign(internal[first_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
+        result = first + second
+        recordFlags(FLAGS_ADD, result, first, second)
     elif AU == 0b_011:
         # FIXME WHAT IS C ??? --> Carry ???
-        result = internal[first_operand] + internal[second_operand] + carry
-        #operation = '%s + %s + C' % (first_operand, second_operand)
-        if sign(internal[first_operand])==sign(internal[second_operand]) and sign(result)!=sign(internal[first_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
+        result = first + second + getFlag('CF')
+        recordFlags(FLAGS_ADD, result, first, second)
     elif AU == 0b_100:
-        result = internal[first_operand] - internal[second_operand]
-        if sign(internal[first_operand])!=sign(internal[second_operand]) and sign(result)!=sign(internal[first_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
+        result = first - second
+        recordFlags(FLAGS_SUB, result, first, second)
     elif AU == 0b_101:
         # FIXME WHAT IS C ??? --> Carry ???
-        result = internal[first_operand] - internal[second_operand] + carry - 1
-        #operation = '%s - %s + C - 1' % (first_operand, second_operand)
-        if sign(internal[first_operand])!=sign(internal[second_operand]) and sign(result)!=sign(internal[first_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
+        result = first - second + getFlag('CF') - 1
+        recordFlags(FLAGS_SUB, result, first, second)
     elif AU == 0b_110:
-        result = -internal[first_operand] + internal[second_operand]
-        if sign(internal[first_operand])!=sign(internal[second_operand]) and sign(result)!=sign(internal[second_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
+        result = -first + second
+        recordFlags(FLAGS_SUB, result, second, first)
     elif AU == 0b_111:
         # FIXME WHAT IS C ??? --> Carry ???
-        result = -internal[first_operand] + internal[second_operand] + carry - 1
-        #operation = '-%s + %s + C - 1' % (first_operand, second_operand)
-        if sign(internal[first_operand])!=sign(internal[second_operand]) and sign(result)!=sign(internal[second_operand]):
-            setFlag('AOF')
-        else:
-            clearFlag('AOF')
-    truncated = result & 0xffff
-    # Program RAM within WRAM
-    if offset >= 0x200000 and offset < 0x203000:
-        PRAM200000[offset - 0x200000] = truncated
-    # FIXME Handle MMIO when offset > 0x3fff
-    elif offset > 0x3fff:
-        # TODO
-        print_error('NOT YET IMPLEMENTED (writing to MMIO: %s)' % hex(offset, 6))
-    else:
-        WRAM[offset] = truncated
-    print_execution(f"{bcolors.RAM}RAM({hex(offset, 6)}){bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(truncated, 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-    # Update Flags
-    if truncated == 0x0000:
-        setFlag('ZF')
-    else:
-        clearFlag('ZF')
-    if (truncated & 0x8000) >> 15 == 0b_1: # FIXME signed ???
-        setFlag('NF')
-    else:
-        clearFlag('NF')
-    # FIXME For substraction, CF=0 if borrowing !!!
-    if (result >> 16) > 0: # FIXME carry ???
-        setFlag('CF')
-    else:
-        clearFlag('CF')
-    incrementIndexRegister(indirectRegName, modif)
-
-def setRegisterFromRAM(regName, indirectRegName, modif):
-    global internal
-    global ioReg
-    global WRAM
-    global PRAM200000
-    bkReg = indirectRegName + 'Bk'
-    offset = ioReg[bkReg] + ioReg[indirectRegName]
-    # Program RAM within WRAM
-    if offset >= 0x200000 and offset < 0x203000:
-        internal[regName] = PRAM200000[offset - 0x200000]
-    # FIXME Handle MMIO when offset > 0x3fff
-    elif offset > 0x3fff:
-        # TODO
-        print_error('NOT YET IMPLEMENTED (reading from MMIO: %s)' % hex(offset, 6))
-    else:
-        internal[regName] = WRAM[offset]
-    print_execution(f"Register {bcolors.REGVAL}{regName}{bcolors.ENDC}{bcolors.EXECUTION} set by {bcolors.RAM}RAM({hex(offset, 6)}){bcolors.ENDC}{bcolors.EXECUTION} to {bcolors.REGVAL}{hex(internal[regName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-    incrementIndexRegister(indirectRegName, modif)
-
-def setRAMFromRegister(indirectRegName, modif, regName):
-    global internal
-    global ioReg
-    global WRAM
-    global PRAM200000
-    bkReg = indirectRegName + 'Bk'
-    offset = ioReg[bkReg] + ioReg[indirectRegName]
-    # Program RAM within WRAM
-    if offset >= 0x200000 and offset < 0x203000:
-        PRAM200000[offset - 0x200000] = internal[regName]
-    # FIXME Handle MMIO when offset > 0x3fff
-    elif offset > 0x3fff:
-        # TODO
-        print_error('NOT YET IMPLEMENTED (writing to MMIO: %s)' % hex(offset, 6))
-    else:
-        WRAM[offset] = internal[regName]
-    print_execution(f"{bcolors.RAM}RAM({hex(offset, 6)}){bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-    incrementIndexRegister(indirectRegName, modif)
-
-def setRegisterFromRAMDirect(regName, offset):
-    global internal
-    global ioReg
-    global WRAM
-    addr = (ioReg['RAMBk'] & 0x00fe) >> 1 | offset
-    internal[regName] = WRAM[addr]
-    print_execution(f"Register {bcolors.REGVAL}{regName}{bcolors.ENDC}{bcolors.EXECUTION} set by {bcolors.RAM}RAM({hex(addr, 6)}){bcolors.ENDC}{bcolors.EXECUTION} to {bcolors.REGVAL}{hex(internal[regName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-
-def setRAMFromRegisterDirect(offset, regName):
-    global internal
-    global ioReg
-    global WRAM
-    addr = (ioReg['RAMBk'] & 0x00fe) >> 1 | offset
-    WRAM[addr] = internal[regName]
-    print_execution(f"{bcolors.RAM}RAM({hex(addr, 6)}){bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(WRAM[addr], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-
-def pushPopRegister(U, regName):
-    global internal
+        result = -first + second + getFlag('CF') - 1
+        recordFlags(FLAGS_SUB, result, second, first)
+    return result & 0xffff
+
+def computeAUWithRegisters(reg, AU, first_operand, second_operand):
+    internal[reg] = computeAU(AU, first_operand, second_operand)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[reg]}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+
+def computeAUWithRegistersToRAM(ix, bk, im, AU, first_operand, second_operand):
+    offset = ioReg[bk] + ioReg[ix]
+    truncated = computeAU(AU, first_operand, second_operand)
+    writeData(offset, truncated)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"{bcolors.RAM}RAM({hex(offset, 6)}){bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(truncated, 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    incrementIndexRegister(ix, bk, im)
+
+def setRegisterFromRAM(reg, ix, bk, im):
+    offset = ioReg[bk] + ioReg[ix]
+    internal[reg] = readData(offset)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[reg]}{bcolors.ENDC}{bcolors.EXECUTION} set by {bcolors.RAM}RAM({hex(offset, 6)}){bcolors.ENDC}{bcolors.EXECUTION} to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    incrementIndexRegister(ix, bk, im)
+
+def setRAMFromRegister(ix, bk, im, reg):
+    offset = ioReg[bk] + ioReg[ix]
+    writeData(offset, internal[reg])
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"{bcolors.RAM}RAM({hex(offset, 6)}){bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    incrementIndexRegister(ix, bk, im)
+
+def setRegisterFromRAMDirect(reg, offset):
+    addr = (ioReg[IO_RAMBK] & 0x00fe) >> 1 | offset
+    internal[reg] = readData(addr)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[reg]}{bcolors.ENDC}{bcolors.EXECUTION} set by {bcolors.RAM}RAM({hex(addr, 6)}){bcolors.ENDC}{bcolors.EXECUTION} to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+
+def setRAMFromRegisterDirect(offset, reg):
+    addr = (ioReg[IO_RAMBK] & 0x00fe) >> 1 | offset
+    writeData(addr, internal[reg])
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"{bcolors.RAM}RAM({hex(addr, 6)}){bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+
+def pushPopRegister(U, reg):
     if U == 0:
-        push(internal[regName])
+        push(internal[reg])
     else:
-        internal[regName] = pop()
+        internal[reg] = pop()
 
-def pushPopIO(r, ioRegName):
-    global ioReg
+def pushPopIO(r, io):
     if r == 0:
-        push(ioReg[ioRegName])
+        if ioReadHooks[io] is not None:
+            ioReadHooks[io]()
+        push(ioReg[io])
     else:
-        ioReg[ioRegName] = pop()
+        ioReg[io] = pop()
+        if ioWriteHooks[io] is not None:
+            ioWriteHooks[io]()
 
-def regMove(regDstName, regSrcName):
-    global internal
-    internal[regDstName] = internal[regSrcName]
-    print_execution(f"Register {bcolors.REGVAL}{regDstName}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regDstName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+def regMove(regDst, regSrc):
+    internal[regDst] = internal[regSrc]
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[regDst]}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regDst], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
 
-def computeLU1(regName, LU1, first_operand, second_operand):
-    global internal
+def computeLU1(reg, LU1, first_operand, second_operand):
     if LU1 == 0b_00:
-        internal[regName] = internal[first_operand] & internal[second_operand]
+        internal[reg] = internal[first_operand] & internal[second_operand]
     elif LU1 == 0b_01:
-        internal[regName] = internal[first_operand] | internal[second_operand]
+        internal[reg] = internal[first_operand] | internal[second_operand]
     elif LU1 == 0b_10:
-        internal[regName] = internal[first_operand] ^ internal[second_operand]
+        internal[reg] = internal[first_operand] ^ internal[second_operand]
     elif LU1 == 0b_11:
-        internal[regName] = ~internal[first_operand]
-    print_execution(f"Register {bcolors.REGVAL}{regName}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-    # Update Flags
-    if internal[regName] == 0x0000:
-        setFlag('ZF')
-    else:
-        clearFlag('ZF')
-    if (internal[regName] & 0x8000) >> 15 == 0b_1: # FIXME signed ???
-        setFlag('NF')
-    else:
-        clearFlag('NF')
-    # FIXME Carry can only be cleared ???
-    clearFlag('CF')
-    # FIXME Arithmetic Overflow can only be cleared ???
-    clearFlag('AOF')
+        internal[reg] = ~internal[first_operand] & 0xffff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[reg]}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    # FIXME Carry and Arithmetic Overflow can only be cleared ???
+    recordFlags(FLAGS_LOGIC, internal[reg], 0, 0)
 
-def computeLU2(regName, LU2, Cst_x, operand):
-    global internal
+def computeLU2(reg, LU2, Cst_x, operand):
     if LU2 == 0b_00:
         # Clear bit
-        internal[regName] = internal[operand] & ~(1 << Cst_x)
+        internal[reg] = internal[operand] & ~(1 << Cst_x)
     elif LU2 == 0b_01:
         # Set bit
-        internal[regName] = internal[operand] | (1 << Cst_x)
+        internal[reg] = internal[operand] | (1 << Cst_x)
     elif LU2 == 0b_10:
         # Toggle bit
-        internal[regName] = internal[operand] ^ (1 << Cst_x)
+        internal[reg] = internal[operand] ^ (1 << Cst_x)
     elif LU2 == 0b_11:
         # Test bit
-        internal[regName] = internal[operand] & (1 << Cst_x)
-    print_execution(f"Register {bcolors.REGVAL}{regName}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-    # Update Flags
-    if internal[regName] == 0x0000:
-        setFlag('ZF')
-    else:
-        clearFlag('ZF')
-    if (internal[regName] & 0x8000) >> 15 == 0b_1: # FIXME signed ???
-        setFlag('NF')
-    else:
-        clearFlag('NF')
-    # FIXME Carry can only be cleared ???
-    clearFlag('CF')
-    # FIXME Arithmetic Overflow can only be cleared ???
-    clearFlag('AOF')
-
-def computeShift(regDstName, sf, count, regSrcName):
-    global internal
-    if sf == 0b_00:
-        # FIXME Left Shift Sign Extension ???
-        result = internal[regSrcName] << count
-        if (result & 0x10000) >> 16 == 0b_1:
-            setFlag('CF')
-        else:
-            clearFlag('CF')
-    elif LU2 == 0b_01:
-        # Left Shift
-        result = internal[regSrcName] << count
-        if (result & 0x10000) >> 16 == 0b_1:
-            setFlag('CF')
-        else:
-            clearFlag('CF')
-    elif LU2 == 0b_10:
+        internal[reg] = internal[operand] & (1 << Cst_x)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[reg]}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    # FIXME Carry and Arithmetic Overflow can only be cleared ???
+    recordFlags(FLAGS_LOGIC, internal[reg], 0, 0)
+
+def computeShift(regDst, sf, count, regSrc):
+    source = internal[regSrc]
+    if sf == 0b_00 or sf == 0b_01:
+        # Left Shift (FIXME Left Shift Sign Extension ???)
+        result = source << count
+        carry = (result >> 16) & 1
+    elif sf == 0b_10:
         # Arithmetic Right Shift
-        result = internal[regSrcName] >> count
-        if (internal[regSrcName] & (1 << (count-1))) >> (count-1) == 0b_1:
-            setFlag('CF')
-        else:
-            clearFlag('CF')
-    elif LU2 == 0b_11:
-        # Logic Right Shift FIXME Should prepend zeroes !!!
-        result = (internal[regSrcName] & 0xffff) >> count
-        if (internal[regSrcName] & (1 << (count-1))) >> (count-1) == 0b_1:
-            setFlag('CF')
-        else:
-            clearFlag('CF')
-    internal[regDstName] = result & 0xffff
-    print_execution(f"Register {bcolors.REGVAL}{regDstName}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regDstName], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
-    # Update Flags
-    if internal[regDstName] == 0x0000:
-        setFlag('ZF')
+        result = signed16(source) >> count
+        carry = (source >> (count - 1)) & 1 if count > 0 else 0
+    elif sf == 0b_11:
+        # Logic Right Shift
+        result = source >> count
+        carry = (source >> (count - 1)) & 1 if count > 0 else 0
+    internal[regDst] = result & 0xffff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[regDst]}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(internal[regDst], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    # FIXME Arithmetic Overflow can only be cleared ???
+    recordFlags(FLAGS_SHIFT, internal[regDst], carry, 0)
+
+def computeShiftWithIndex(regDst, sf, regSrc):
+    count = ioReg[IO_SHIDX] & 0x000f
+    computeShift(regDst, sf, count, regSrc)
+
+# MAC
+# MR is a 40-bit accumulator: MR2 (I/O register, 8 bits), MR1, MR0. Operands are signed: integers (IS), or 1.15
+# fractions (FS) whose product is shifted left to stay aligned on MR1.
+# FIXME Assumed: results saturate to 40 bits, MOF is set when a result does not fit in MR1:MR0 (32 bits)
+MR_MAX = (1 << 39) - 1
+MR_MIN = -(1 << 39)
+# When MMR bit13 is set, MAC opcodes with bit6 set are Multiple Functions with Double-Fetched operands (EMAC),
+# loaded through Ix2/Iy2 with a linear or circular modifier
+MMR_DOUBLE_FETCH = 0x2000
+# (pointer, linear modifier, circular modifier, circular buffer base, circular buffer length) of X and Y fetches
+doubleFetchRegisters = [(0x1e, 0x2c, 0x2d, 0x36, 0x37), (0x1f, 0x2e, 0x2f, 0x38, 0x39)]
+
+def getMR():
+    mr = (ioReg[IO_MR2] & 0xff) << 32 | internal[MR1] << 16 | internal[MR0]
+    return mr - (1 << 40) if mr & (1 << 39) else mr
+
+def saturateMR(mr):
+    return MR_MAX if mr > MR_MAX else MR_MIN if mr < MR_MIN else mr
+
+def setMR(mr):
+    mr = saturateMR(mr)
+    internal[MR0] = mr & 0xffff
+    internal[MR1] = (mr >> 16) & 0xffff
+    ioReg[IO_MR2] = (mr >> 32) & 0xff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}MR{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(mr & 0xffffffffff, 10)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    if -0x80000000 <= mr <= 0x7fffffff:
+        clearFlag('MOF')
+    else:
+        setFlag('MOF')
+
+def macProduct(MAC, first, second):
+    product = signed16(internal[first]) * signed16(internal[second])
+    if MAC & 0b_100:
+        # FS
+        product <<= 1
+    return product
+
+def computeMac(MAC, first, second):
+    operation = MAC & 0b_011
+    if operation == 0b_00:
+        setMR(macProduct(MAC, first, second))
+    elif operation == 0b_01:
+        setMR(getMR() + macProduct(MAC, first, second))
+    elif operation == 0b_10:
+        setMR(getMR() - macProduct(MAC, first, second))
+
+def doubleFetch(reg, pointer, circular):
+    (ix, linear, modifierC, base, length) = doubleFetchRegisters[pointer]
+    address = ioReg[ix]
+    internal[reg] = readData(address)
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Register {bcolors.REGVAL}{registers_reg[reg]}{bcolors.ENDC}{bcolors.EXECUTION} set by {bcolors.RAM}RAM({hex(address, 6)}){bcolors.ENDC}{bcolors.EXECUTION} to {bcolors.REGVAL}{hex(internal[reg], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    # FIXME Assumed: pointers wrap around without bank registers, and do not update IOF
+    if circular:
+        size = ioReg[length] or 0x10000
+        ioReg[ix] = (ioReg[base] + (address - ioReg[base] + signed16(ioReg[modifierC])) % size) & 0xffff
     else:
-        clearFlag('ZF')
-    if (internal[regDstName] & 0x8000) >> 15 == 0b_1: # FIXME signed ???
-        setFlag('NF')
+        ioReg[ix] = (address + ioReg[linear]) & 0xffff
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Indirect register {bcolors.REGVAL}{ioRegisterLabel(ix)}{bcolors.ENDC}{bcolors.EXECUTION} set to {bcolors.REGVAL}{hex(ioReg[ix], 4)}{bcolors.ENDC}{bcolors.EXECUTION}")
+
+# Hardware loops
+# Do0/Do1 start a loop of the next instructions up to Loop0/Loop1, repeated cntV times. Each of the two loop
+# units has a counter and a start address, the ones of the enclosing loop are saved on the loop stack.
+# FIXME Assumed: a count of 0 repeats the body 64 times, no limit on the depth of the loop stack
+loopCounters = [0, 0]
+loopStarts = [0x000000, 0x000000]
+loopStack = []          # (unit, start address, counter) of the enclosing loops
+
+def startLoop(unit, start, count):
+    loopStack.append((unit, loopStarts[unit], loopCounters[unit]))
+    loopStarts[unit] = start
+    loopCounters[unit] = count or 64
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Loop {bcolors.REGVAL}{unit}{bcolors.ENDC}{bcolors.EXECUTION} started at {bcolors.REGVAL}{hex(start, 6)}{bcolors.ENDC}{bcolors.EXECUTION} for {bcolors.REGVAL}{loopCounters[unit]}{bcolors.ENDC}{bcolors.EXECUTION} iterations")
+
+def endLoopIteration(unit, PC):
+    # Address executed after the Loop instruction at PC
+    if loopCounters[unit] > 1:
+        loopCounters[unit] -= 1
+        if traceLevel >= TRACE_FULL:
+            print_execution(f"Loop {bcolors.REGVAL}{unit}{bcolors.ENDC}{bcolors.EXECUTION} counter decremented to {bcolors.REGVAL}{loopCounters[unit]}{bcolors.ENDC}{bcolors.EXECUTION}")
+        return loopStarts[unit]
+    if loopStack and loopStack[-1][0] == unit:
+        (_, loopStarts[unit], loopCounters[unit]) = loopStack.pop()
     else:
-        clearFlag('NF')
-    # FIXME Arithmetic Overflow can only be cleared ???
-    clearFlag('AOF')
+        print_error('Loop%d without Do%d' % (unit, unit))
+        loopCounters[unit] = 0
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Loop {bcolors.REGVAL}{unit}{bcolors.ENDC}{bcolors.EXECUTION} ended")
+    return PC+1
+
+def loopIterations(unit, start, length, cycles):
+    """Iterations of the body of a hardware loop that its block can repeat before running it the usual way
+    (see blockCode): all but the last one, as long as the instruction limit and the next event are not reached"""
+    if loopStarts[unit] != start or traceLevel >= TRACE_INSTRUCTIONS or start in breakpoints:
+        return 0
+    iterations = loopCounters[unit] - 1
+    if instructionLimit != float('inf'):
+        iterations = min(iterations, int(instructionLimit - instructionCount) // length - 1)
+    if nextEventCycle != float('inf'):
+        iterations = min(iterations, int(nextEventCycle - cycleCount - 1) // cycles)
+    return max(iterations, 0)
 
-def computeShiftWithIndex(regDstName, sf, regSrcName):
-    count = ioReg['ShIdx'] & 0x000f
-    computeShift(regDstName, sf, count, regSrcName)
+def resetLoops():
+    loopCounters[:] = [0, 0]
+    loopStarts[:] = [0x000000, 0x000000]
+    loopStack.clear()
 
 def conditionMatched(cond):
+    if pendingFlags is not None:
+        materializeFlags()
+    ssf = ioReg[IO_SSF]
+    ZF = ssf & flags['ZF'] != 0
+    # Signed comparisons: negative result, unless the operation overflowed
+    LT = (ssf & flags['NF'] != 0) != (ssf & flags['AOF'] != 0)
     if cond == 0b_0000:     # Jeq: Jump if zero
-        return getFlag('ZF') == 1
+        return ZF
     elif cond == 0b_0001:   # Jne: Jump if _not_ zero
-        return getFlag('ZF') == 0
+        return not ZF
     elif cond == 0b_0010:   # Jgt: Jump if greater than zero
-        return (~(getFlag('NF')^getFlag('AOF')) & ~getFlag('ZF')) == 1
+        return not LT and not ZF
     elif cond == 0b_0011:   # Jge: Jump if greater than or equal to zero
-        return (~(getFlag('NF')^getFlag('AOF')) | getFlag('ZF')) == 1
+        return not LT or ZF
     elif cond == 0b_0100:   # Jlt: Jump if less than zero
-        return ((getFlag('NF')^getFlag('AOF')) & ~getFlag('ZF')) == 1
+        return LT and not ZF
     elif cond == 0b_0101:   # Jle: Jump if less than or equal to zero
-        return ((getFlag('NF')^getFlag('AOF')) | getFlag('ZF')) == 1
+        return LT or ZF
     elif cond == 0b_0110:   # Jav: Jump if Arithmetic Overflow
-        return getFlag('AOF') == 1
+        return ssf & flags['AOF'] != 0
     elif cond == 0b_0111:   # Jnav: Jump if Arithmetic Overflow
-        return getFlag('AOF') == 0
+        return ssf & flags['AOF'] == 0
     elif cond == 0b_1000:   # Jac: Jump if Carry
-        return getFlag('CF') == 1
+        return ssf & flags['CF'] != 0
     elif cond == 0b_1001:   # Jnac: Jump if _not_ Carry
-        return getFlag('CF') == 0
+        return ssf & flags['CF'] == 0
     elif cond == 0b_1010:   # Jmr0s: Jump if MR0 negative
-        return (internal['MR0'] & 0x8000) >> 15 == 1
+        return (internal[MR0] & 0x8000) >> 15 == 1
     elif cond == 0b_1011:   # Jmr0ns: Jump if MR0 _not_ negative
-        return (internal['MR0'] & 0x8000) >> 15 == 0
+        return (internal[MR0] & 0x8000) >> 15 == 0
     elif cond == 0b_1100:   # Jmv: Jump if MAC Overflow
-        return getFlag('MOF') == 1
+        return ssf & flags['MOF'] != 0
     elif cond == 0b_1101:   # Jnmv: Jump if _not_ MAC Overflow
-        return getFlag('MOF') == 0
+        return ssf & flags['MOF'] == 0
     elif cond == 0b_1110:   # Jixv: Jump if Index Overflow
-        return getFlag('IOF') == 1
+        return ssf & flags['IOF'] != 0
     elif cond == 0b_1111:   # Jirr: Jump if Special EIR Case
         raise
         # FIXME return IntRR[7]
 
 
-# TODO MMIO
+# Instruction handlers
+# Each handler is called with the address of the instruction followed by the operands extracted when decoding the opcode
+# Only control flow handlers update PC, the caller moves PC past every other instruction
+def executeCall(PC, abs_addr, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, '')
+    push(PC+1)
+    setPC(abs_addr)
 
+def executeJmp(PC, offset, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, 'Dest = %s' % (hex(PC+1+offset, 6)))
+    incrementPC(offset+1)
 
+def executeJcond(PC, cond, offset, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, 'Dest = %s' % (hex(PC+1+offset, 6)))
+    if conditionMatched(cond):
+        if traceLevel >= TRACE_FULL:
+            print_execution(f"Condition {bcolors.JUMP}MATCHED{bcolors.ENDC}{bcolors.EXECUTION}")
+        incrementPC(offset+1)
+    else:
+        incrementPC()
 
+def executeRegisterFromRAMDirect(PC, reg, offset, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, '', True)
+    setRegisterFromRAMDirect(reg, offset)
 
+def executeRAMFromRegisterDirect(PC, offset, reg, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, '', True)
+    setRAMFromRegisterDirect(offset, reg)
 
+def executeLoadImmediate(PC, reg, L, imm, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    setRegisterImmediate(reg, L, imm)
 
+def executeLoadIndexImmediate(PC, ix, L, imm, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    setIndexRegisterImmediate(ix, L, imm)
 
+def executeAUToRAM(PC, ix, bk, im, AU, first_operand, second_operand, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, '', True)
+    computeAUWithRegistersToRAM(ix, bk, im, AU, first_operand, second_operand)
 
+def executeLU1(PC, reg, LU1, first_operand, second_operand, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    computeLU1(reg, LU1, first_operand, second_operand)
 
-# Open file
-address = 0
-with open(FW, 'rb') as f:
-    # Load complete rom into CS1ROM
-    word = f.read(2)
-    while word and address < 0x800000:
-        high = word[1]
-        low = word[0]
-        #print('Loading value %s into CS1ROM[%s]' % (hex((high << 8) | low, 4), hex(address, 4)))
-        CS1ROM[address] = (high << 8) | low
-        word = f.read(2)
-        address += 1
-    print_execution('Loaded %d words into CS1ROM.' % address)
-# Load first 32KW into Program RAM
-address = 0
-for word in CS1ROM:
-    if address == 0x8000:
-        break
-    #print('Loading value %s into PRAM[%s]' % (hex(word, 4), hex(address, 4)))
-    PRAM[address] = word
-    address += 1
-print_execution('Loaded %d words into PRAM.' % address)
+def executeLU2(PC, reg, LU2, Cst_x, operand, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    computeLU2(reg, LU2, Cst_x, operand)
 
-# Start executing at 0x000000 (Default PC value)
-# FIXME Starting point as argument ? (another interrupt, fa 0x40000, fu 0x3000, ...)
+def executeRegisterFromRAM(PC, reg, ix, bk, im, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    setRegisterFromRAM(reg, ix, bk, im)
 
-# Execution control
-breakpoints = [0x000000, 0x0004e5, 0x000100, 0x001ec5]
-quit = False
-stepByStep = False
-ioRegex = re.compile('^io (.+)$')
-wramRegex = re.compile('^wram (.+)$')
-pramRegex = re.compile('^pram (.+)$')
-romRegex = re.compile('^rom (.+)$')
-# Stop on Ctrl+C
-def sigint_handler(sig, frame):
-    global stepByStep
-    if stepByStep:
-        sys.exit(1)
+def executeRAMFromRegister(PC, ix, bk, im, reg, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    setRAMFromRegister(ix, bk, im, reg)
+
+def executeRegisterFromROM(PC, reg, ix, bk, im, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    setRegisterFromROM(reg, ix, bk, im)
+
+def executeShiftWithIndex(PC, regDst, sf, regSrc, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, '', True)
+    computeShiftWithIndex(regDst, sf, regSrc)
+
+def executeRegFromIO(PC, regL, io, text, comment):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, comment)
+    setRegFromIO(regL, io)
+
+def executeIOFromReg(PC, io, regL, text, comment):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, comment)
+    setIOFromReg(io, regL)
+
+def executeAU(PC, reg, AU, first_operand, second_operand, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, '', True)
+    computeAUWithRegisters(reg, AU, first_operand, second_operand)
+
+def executeRegMove(PC, regDst, regSrc, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    regMove(regDst, regSrc)
+
+def executePushPopRegister(PC, U, reg, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    pushPopRegister(U, reg)
+
+def executeShift(PC, regDst, sf, count, regSrc, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, '', True)
+    computeShift(regDst, sf, count, regSrc)
+
+def executePushPopIO(PC, r, io, text, comment):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, comment, True)
+    pushPopIO(r, io)
+
+def executeMac(PC, MAC, first, second, load, fetches, text, doubleFetchText):
+    global cycleCount
+    # Operands are multiplied before the parallel loads replace them
+    if fetches is not None and ioReg[IO_MMR] & MMR_DOUBLE_FETCH:
+        if traceLevel >= TRACE_INSTRUCTIONS:
+            print_instruction(PC*2, doubleFetchText)
+        computeMac(MAC, first, second)
+        for fetch in fetches:
+            doubleFetch(*fetch)
+        if fetches:
+            cycleCount += EMAC_CYCLES - MAC_CYCLES
     else:
-        stepByStep = True
-signal.signal(signal.SIGINT, sigint_handler)
+        if traceLevel >= TRACE_INSTRUCTIONS:
+            print_instruction(PC*2, text)
+        computeMac(MAC, first, second)
+        if load is not None:
+            setRegisterFromRAM(*load)
 
-# Execution
-while not quit:
-    PC = (ioReg['PCH'] << 16) | ioReg['PCL']
-    opcode = getOpCode(PC)
+def executeCallff(PC, abs_addr_high):
+    second_word = getOpCode(PC+1)
+    abs_addr_low = second_word
+    abs_addr = (abs_addr_high << 16) | abs_addr_low
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, 'Callff\t%s' % (hex(abs_addr, 6)), '', True)
+    retAddr = PC+2
+    retH = (retAddr >> 16) & 0xff
+    retL = retAddr & 0xffff
+    push(retL)
+    push(retH)
+    setPC(abs_addr)
+
+def executeJmpff(PC, abs_addr_high):
+    second_word = getOpCode(PC+1)
+    abs_addr_low = second_word
+    abs_addr = (abs_addr_high << 16) | abs_addr_low
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, 'Jmpff\t%s' % (hex(abs_addr, 6)), '', True)
+    setPC(abs_addr)
+
+def executeRet(PC, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    retAddr = pop()
+    setPC(retAddr)
+
+def executeRetff(PC, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    retH = pop()
+    retL = pop()
+    retAddr = (retH << 16) | retL
+    setPC(retAddr)
+
+def executeReti(PC, text):
+    # Interrupts push their return address like Callff
+    executeRetff(PC, text)
+    leaveInterrupt()
+
+def executeDo(PC, unit, count, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    startLoop(unit, PC+1, count)
+
+def executeLoop(PC, unit, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+    setPC(endLoopIteration(unit, PC))
+
+def executeNop(PC, text):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text)
+
+def executeNotImplemented(PC, text, comment, wip):
+    if traceLevel >= TRACE_INSTRUCTIONS:
+        print_instruction(PC*2, text, comment, wip)
+    print_error('NOT YET IMPLEMENTED')
+
+def executeUnknown(PC):
+    print('%s\tUNKNOWN' % hex(PC*2,6))
+    print_error('UNKNOWN INSTRUCTION')
+    raise
+    # TODO Should break and throw an error
+
+
+# Handlers that update PC themselves (they end a basic block)
+flowHandlers = [executeCall, executeJmp, executeJcond, executeCallff, executeJmpff, executeRet, executeRetff, executeReti, executeLoop, executeUnknown]
+
+# Timing
+# Cycles taken by an instruction, by handler (1 otherwise). Fetching an instruction from External Program
+# Memory (SPI flash on CS1) takes CS1_WAIT_CYCLES more per word.
+# FIXME Assumed costs: flow instructions refill the pipeline, 2-word instructions take a cycle per word
+MAC_CYCLES = 1          # Single-cycle multiplier-accumulator
+EMAC_CYCLES = 2         # FIXME Assumed: double-fetched operands (added by executeMac)
+instructionCycles = dict([
+    (executeCall, 2),
+    (executeJmp, 2),
+    (executeJcond, 2),
+    (executeCallff, 3),
+    (executeJmpff, 3),
+    (executeRet, 2),
+    (executeRetff, 2),
+    (executeReti, 2),
+    (executeMac, MAC_CYCLES),
+])
+twoWordHandlers = [executeCallff, executeJmpff]
+CS1_WAIT_CYCLES = 4     # FIXME Assumed SPI flash wait states
+
+class Instruction:
+    """Decoded opcode: handler to call and operands to call it with (after the instruction address)"""
+    __slots__ = ('handler', 'args', 'flow', 'words', 'cycles')
+
+    def __init__(self, handler, *args):
+        self.handler = handler
+        self.args = args
+        self.flow = handler in flowHandlers
+        self.words = 2 if handler in twoWordHandlers else 1
+        self.cycles = instructionCycles.get(handler, 1)
+
+def instructionCost(PC, instruction):
+    if PC >= CS1ROM_BASE:
+        return instruction.cycles + instruction.words * CS1_WAIT_CYCLES
+    return instruction.cycles
+
+def decodeOpCode(opcode):
     high = (opcode & 0xff00) >> 8
     low = opcode & 0xff
-    #print("opcode@%s: %s" % (hex(PC, 6), hex(opcode, 4)))
-    #print('%s %s' % (hex(high,2), hex(low,2)))
-    # TODO Handle breakpoints (address, condition, ...) + dump registers / stack / ram ?
-    if PC in breakpoints or stepByStep:
-        while True:
-            command = input(f"{bcolors.CONTROL}> {bcolors.ENDC}")
-            try:
-                ioMatch = ioRegex.match(command)
-                wramMatch = wramRegex.match(command)
-                pramMatch = pramRegex.match(command)
-                romMatch = romRegex.match(command)
-                if 'q' == command:  # Stop emulator
-                    print_control('Stopping emulator.')
-                    quit = True
-                    break
-                elif 'c' == command:    # Continue execution
-                    stepByStep = False
-                    break
-                elif 's' == command or '' == command:   # Step-by-step, next instruction
-                    stepByStep = True
-                    break
-                elif 'reg' == command:
-                    print_control("Internal registers:\t%s" % ("\t".join("{}={}".format(k, hex(v, 4)) for k, v in internal.items())))
-                elif ioMatch:
-                    if ioMatch.group(1).startswith('0x'):
-                        ioAddr = int(ioMatch.group(1), 16)
-                        print_control("I/O register: %s(%s)=%s" % (hex(ioAddr, 2), ioRegisterLabel(ioAddr), hex(ioReg[ioRegisterLabel(ioAddr)], 4)))
-                    else:
-                        print_control("I/O register: %s=%s" % (ioMatch.group(1), hex(ioReg[ioMatch.group(1)], 4)))
-                elif wramMatch:
-                    wramAddr = int(wramMatch.group(1), 16)
-                    print_control("WRAM word: %s=%s" % (hex(wramAddr, 6), hex(WRAM[wramAddr], 4)))
-                elif pramMatch:
-                    pramAddr = int(pramMatch.group(1), 16)
-                    if pramAddr < 0x8000:
-                        pramWord = PRAM[pramAddr]
-                    elif pramAddr >= 0x200000 and pramAddr < 0x203000:
-                        pramWord = PRAM200000[pramAddr - 0x200000]
-                    elif pramAddr >= 0x400000 and pramAddr < 0xC00000:
-                        pramWord =  CS1ROM[pramAddr - 0x400000]
-                    else:
-                        # TODO ???
-                        print_error('Cannot read ROM at address %s' % hex(pramAddr, 6))
-                        raise
-                    print_control("PRAM word: %s=%s" % (hex(pramAddr, 6), hex(pramWord, 4)))
-                elif romMatch:
-                    romAddr = int(romMatch.group(1), 16)
-                    print_control("ROM word: %s=%s" % (hex(romAddr, 6), hex(CS1ROM[romAddr], 4)))
-                else:
-                    print_control(f'{bcolors.ERROR}Invalid command.{bcolors.ENDC}')
-                    print_control("""Usage:
-\tc:                    Continue execution
-\ts or <enter>:         Step-by-step / Next instruction
-\treg:                  Print internal registers
-\tio <addr>|<label>:    Print I/O register
-\twram <addr>:          Print WRAM word
-\tpram <addr>:          Print PRAM word
-\trom <addr>:           Print ROM word
-\tq:                    Quit""")
-            except:
-                print_control(f'{bcolors.ERROR}Oops! Something bad occurred. Try again!{bcolors.ENDC}')
-        if quit:
-            continue
-
     # Call
     if high & 0b_1000_0000 == 0:
         abs_addr = ((high & 0b_0111_1111) << 8) + low
-        print_instruction(PC*2, 'Call\t%s' % (hex(abs_addr, 4)), '')
-        push(PC+1)
-        setPC(abs_addr)
+        return Instruction(executeCall, abs_addr, 'Call\t%s' % (hex(abs_addr, 4)))
     # Jump
     elif ((high >> 4) & 0b_0000_1111) == 0b_1000:
         offset = signed12( ((high & 0b_0000_1111) << 8) + low ) # Offset is signed !
-        print_instruction(PC*2, 'Jmp\t%s' % (hex(offset, 3)), 'Dest = %s' % (hex(PC+1+offset, 6)))
-        incrementPC(offset+1)
+        return Instruction(executeJmp, offset, 'Jmp\t%s' % (hex(offset, 3)))
     # Jump Condition
     elif ((high >> 4) & 0b_0000_1111) == 0b_1001:
         cond = high & 0b_0000_1111
         offset = signed8(low)   # Offset is signed !
         mnemonic = 'J' + condsuffix(cond)
-        print_instruction(PC*2, '%s\t%s' % (mnemonic, hex(offset, 2)), 'Dest = %s' % (hex(PC+1+offset, 6)))
-        if conditionMatched(cond):
-            print_execution(f"Condition {bcolors.JUMP}MATCHED{bcolors.ENDC}{bcolors.EXECUTION}")
-            incrementPC(offset+1)
-        else:
-            incrementPC()
+        return Instruction(executeJcond, cond, offset, '%s\t%s' % (mnemonic, hex(offset, 2)))
     # RW Mem (direct)
     elif ((high >> 5) & 0b_0000_0111) == 0b_101:
         r = (high & 0b_0001_0000) >> 4       # r=0: DM(imm) <= Reg      r=1: Reg <= DM(imm)
@@ -1038,20 +1440,18 @@ while not quit:
         reg = high & 0b_0000_0111
         offset = (hash << 8) | low
         if r:
-            print_instruction(PC*2, '%s = DM(%s)' % (register(reg), hex(offset, 3)), '', True)
-            setRegisterFromRAMDirect(register(reg), offset)
+            return Instruction(executeRegisterFromRAMDirect, reg, offset, '%s = DM(%s)' % (register(reg), hex(offset, 3)))
         else:
-            print_instruction(PC*2, 'DM(%s) = %s' % (hex(offset, 3), register(reg)), '', True)
-            setRAMFromRegisterDirect(offset, register(reg))
-        incrementPC()
+            return Instruction(executeRAMFromRegisterDirect, offset, reg, 'DM(%s) = %s' % (hex(offset, 3), register(reg)))
     # Load Immediate
     elif ((high >> 5) & 0b_0000_0111) == 0b_110 and ((high >> 3) & 0b_0000_0011) != 0b_01:
         L = (high & 0b_0001_1000) >> 3       # L=00: Load High, Keep Low     L=10: Keep High, Load Low       L=11: Clear High, Load Low
         reg1 = high & 0b_0000_0111
         imm = low
-        print_instruction(PC*2, '%s%s = %s' % (register1(reg1), hilo(L), hex(imm, 2)))
-        setRegisterImmediate(register1(reg1), hilo(L), imm)
-        incrementPC()
+        if reg1 >= 6:
+            # Ix0/Ix1 are I/O registers
+            return Instruction(executeLoadIndexImmediate, indirectRegisters[reg1 - 6][0], L, imm, '%s%s = %s' % (register1(reg1), hilo(L), hex(imm, 2)))
+        return Instruction(executeLoadImmediate, reg1, L, imm, '%s%s = %s' % (register1(reg1), hilo(L), hex(imm, 2)))
     # AU(2) To Mem
     elif ((high >> 3) & 0b_0001_1111) == 0b_11001 and ((low >> 7) & 0b_0000_0001) == 0b_0:
         A = (high & 0b_0000_0110) >> 1       # A=00: No Change  A=01: By Modifier   A=10: +1    A=11: -1
@@ -1060,28 +1460,9 @@ while not quit:
         AU = (low & 0b_0001_1100) >> 2
         Yop = (low & 0b_0000_0011)
         modif = modifier(A)                  # Modifier indicates how the data address (indirect register Ix/y) is incremented after the operation (not incremented, +1, -1, +modifier register lm)
-        first_operand = operand1(Xop)
-        second_operand = operand2(Yop)
-        # FIXME What is C ??? --> Carry ???
-        if AU == 0b_000:
-            operation = '%s + 1' % (first_operand)
-        elif AU == 0b_001:
-            operation = '%s - 1' % (first_operand)
-        elif AU == 0b_010:
-            operation = '%s + %s' % (first_operand, second_operand)
-        elif AU == 0b_011:
-            operation = '%s + %s + C' % (first_operand, second_operand)
-        elif AU == 0b_100:
-            operation = '%s - %s' % (first_operand, second_operand)
-        elif AU == 0b_101:
-            operation = '%s - %s + C - 1' % (first_operand, second_operand)
-        elif AU == 0b_110:
-            operation = '-%s + %s' % (first_operand, second_operand)
-        elif AU == 0b_111:
-            operation = '-%s + %s + C - 1' % (first_operand, second_operand)
-        print_instruction(PC*2, 'RAM(Ix%s%s) = %s' % (Ix, modif, operation), '', True)
-        computeAUWithRegistersToRAM('Ix%s' % Ix, A, AU, first_operand, second_operand)
-        incrementPC()
+        (ix, bk, im) = indirectRegisters[Ix]
+        operation = auOperation(AU, operand1(Xop), operand2(Yop))
+        return Instruction(executeAUToRAM, ix, bk, im + A, AU, operandXopIndex[Xop], operandYopIndex[Yop], 'RAM(Ix%s%s) = %s' % (Ix, modif, operation))
     # LU(1)
     elif ((high >> 3) & 0b_0001_1111) == 0b_11001 and ((low >> 7) & 0b_0000_0001) == 0b_1 and ((low >> 2) & 0b_0000_0001) == 0b_0:
         reg = high & 0b_0000_0111
@@ -1098,9 +1479,7 @@ while not quit:
             operation = '%s XOR %s' % (first_operand, second_operand)
         elif LU1 == 0b_11:
             operation = 'NOT %s' % (first_operand)
-        print_instruction(PC*2, '%s = %s' % (register(reg), operation))
-        computeLU1(register(reg), LU1, first_operand, second_operand)
-        incrementPC()
+        return Instruction(executeLU1, reg, LU1, operandXopIndex[Xop], operandYopIndex[Yop], '%s = %s' % (register(reg), operation))
     # LU(2)
     elif ((high >> 3) & 0b_0001_1111) == 0b_11001 and ((low >> 7) & 0b_0000_0001) == 0b_1 and ((low >> 2) & 0b_0000_0001) == 0b_1:
         _f = high & 0b_0000_0001              # 0: r0    1: r1
@@ -1109,9 +1488,7 @@ while not quit:
         Yop = (low & 0b_0000_0011)
         operand = operand2(Yop)
         mnemonic = lu2(LU2)
-        print_instruction(PC*2, 'R%s = %s.%d\t%s' % (_f, mnemonic, Cst_x, operand))
-        computeLU2('R%s' % _f, LU2, Cst_x, operand)
-        incrementPC()
+        return Instruction(executeLU2, R0 + _f, LU2, Cst_x, operandYopIndex[Yop], 'R%s = %s.%d\t%s' % (_f, mnemonic, Cst_x, operand))
     # RW SRAM (indirect)
     elif ((high >> 3) & 0b_0001_1111) == 0b_11100 and ((low >> 7) & 0b_0000_0001) == 0b_0 and (low & 0b_0000_0011) == 0b_00:
         reg = high & 0b_0000_0111
@@ -1120,13 +1497,11 @@ while not quit:
         Ixy = (low & 0b_0000_1100) >> 2      # 00: Ix0   01: Ix1    10: Iy0     11: Iy1
         modif = modifier(A)                  # Modifier indicates how the data address (indirect register Ix/y) is incremented after the operation (not incremented, +1, -1, +modifier register lm)
         ind = indirect(Ixy)
+        (ix, bk, im) = indirectRegisters[Ixy]
         if r:
-            print_instruction(PC*2, '%s = RAM(%s%s)' % (register(reg), ind, modif))
-            setRegisterFromRAM(register(reg), ind, A)
+            return Instruction(executeRegisterFromRAM, reg, ix, bk, im + A, '%s = RAM(%s%s)' % (register(reg), ind, modif))
         else:
-            print_instruction(PC*2, 'RAM(%s%s) = %s' % (ind, modif, register(reg)))
-            setRAMFromRegister(ind, A, register(reg))
-        incrementPC()
+            return Instruction(executeRAMFromRegister, ix, bk, im + A, reg, 'RAM(%s%s) = %s' % (ind, modif, register(reg)))
     # Load ROM (indirect)
     elif ((high >> 3) & 0b_0001_1111) == 0b_11100 and ((low >> 6) & 0b_0000_0011) == 0b_01 and (low & 0b_0000_0011) == 0b_01:
         reg = high & 0b_0000_0111
@@ -1134,9 +1509,8 @@ while not quit:
         Ixy = (low & 0b_0000_1100) >> 2      # 00: Ix0   01: Ix1    10: Iy0     11: Iy1
         modif = modifier(A)                  # Modifier indicates how the data address (indirect register Ix/y) is incremented after the operation (not incremented, +1, -1, +modifier register lm)
         ind = indirect(Ixy)
-        print_instruction(PC*2, '%s = ROM(%s%s)' % (register(reg), ind, modif))
-        setRegisterFromROM(register(reg), ind, A)
-        incrementPC()
+        (ix, bk, im) = indirectRegisters[Ixy]
+        return Instruction(executeRegisterFromROM, reg, ix, bk, im + A, '%s = ROM(%s%s)' % (register(reg), ind, modif))
     # Shift index
     elif ((high >> 3) & 0b_0001_1111) == 0b_11100 and ((low >> 6) & 0b_0000_0011) == 0b_01 and (low & 0b_0000_0111) == 0b_010:
         reg = high & 0b_0000_0111
@@ -1144,48 +1518,24 @@ while not quit:
         sf = (low & 0b_0001_1000) >> 3       # 00: Shift Left Sign Extension    01: A/L Shift Left  10: A Shift Right   11: L Shift Right
         mnemonic = shift(sf)
         # Number of bits to shift is determined by the ShIdx I/O (0x003e)
-        print_instruction(PC*2, 'R%s = %s.Idx %s' % (_f, mnemonic, register(reg)), '', True)
-        computeShiftWithIndex('R%s' % _f, sf, register(reg))
-        incrementPC()
+        return Instruction(executeShiftWithIndex, R0 + _f, sf, reg, 'R%s = %s.Idx %s' % (_f, mnemonic, register(reg)))
     # I/O (1)
     elif ((high >> 3) & 0b_0001_1111) == 0b_11100 and ((low >> 7) & 0b_0000_0001) == 0b_1:
         r = (high & 0b_0000_0100) >> 2        # r=0: IO(offset) <= RegL      r=1: RegL <= IO(offset)
         regL = (high & 0b_0000_0011)
         offset = low & 0b_0111_1111
         if r:
-            print_instruction(PC*2, '%s = IO(%s)' % (registerL(regL), hex(offset, 2)), 'I/O register = %s' % (ioRegisterLabel(offset)))
-            setRegFromIO(registerL(regL), ioRegisterLabel(offset))
+            return Instruction(executeRegFromIO, regL, offset, '%s = IO(%s)' % (registerL(regL), hex(offset, 2)), 'I/O register = %s' % (ioRegisterLabel(offset)))
         else:
-            print_instruction(PC*2, 'IO(%s) = %s' % (hex(offset, 2), registerL(regL)), 'I/O register = %s' % (ioRegisterLabel(offset)))
-            setIOFromReg(ioRegisterLabel(offset), registerL(regL))
-        incrementPC()
+            return Instruction(executeIOFromReg, offset, regL, 'IO(%s) = %s' % (hex(offset, 2), registerL(regL)), 'I/O register = %s' % (ioRegisterLabel(offset)))
     # AU(1)
     elif ((high >> 3) & 0b_0001_1111) == 0b_11101:
         regDst = high & 0b_0000_0111
         regSrc = (low & 0b_1110_0000) >> 5
         AU = (low & 0b_0001_1100) >> 2
         Yop = (low & 0b_0000_0011)
-        first_operand = register(regSrc)
-        second_operand = operand2(Yop)
-        if AU == 0b_000:
-            operation = '%s + 1' % (first_operand)
-        elif AU == 0b_001:
-            operation = '%s - 1' % (first_operand)
-        elif AU == 0b_010:
-            operation = '%s + %s' % (first_operand, second_operand)
-        elif AU == 0b_011:
-            operation = '%s + %s + C' % (first_operand, second_operand)
-        elif AU == 0b_100:
-            operation = '%s - %s' % (first_operand, second_operand)
-        elif AU == 0b_101:
-            operation = '%s - %s + C - 1' % (first_operand, second_operand)
-        elif AU == 0b_110:
-            operation = '-%s + %s' % (first_operand, second_operand)
-        elif AU == 0b_111:
-            operation = '-%s + %s + C - 1' % (first_operand, second_operand)
-        print_instruction(PC*2, '%s = %s' % (register(regDst), operation), '', True)
-        computeAUWithRegisters(register(regDst), AU, first_operand, second_operand)
-        incrementPC()
+        operation = auOperation(AU, register(regSrc), operand2(Yop))
+        return Instruction(executeAU, regDst, AU, regSrc, operandYopIndex[Yop], '%s = %s' % (register(regDst), operation))
     # MAC
     elif ((high >> 3) & 0b_0001_1111) == 0b_11110:
         MAC = high & 0b_0000_0111
@@ -1218,28 +1568,44 @@ while not quit:
         # Optional second (parallel) operation (load from RAM)
         if M == 0b_0:
             operation2 = ''
+            load = None
         elif M == 0b_1:
             modif = modifier(A)              # Modifier indicates how the data address (indirect register Ix/y) is incremented after the operation (not incremented, +1, -1, +modifier register lm)
             operation2 = ', %s = RAM(Ix%s%s)' % (dxy(DXY), Ix, modif)
-        print_instruction(PC*2, 'MR = %s%s' % (operation, operation2), '', True)
-        print_error('NOT YET IMPLEMENTED')
-        # FIXME Also update MOF flag
-        incrementPC()
+            (ix, bk, im) = indirectRegisters[Ix]
+            load = (destXYIndex[DXY], ix, bk, im + A)
+        # EMAC: same opcodes with bit6 set, when MMR (0x0017) bit13 enables Double Fetch Instructions
+        if Ix:
+            EM = M                           # 0: simple MAC    1: multiple-function
+            AmX = (low & 0b_0010_0000) >> 5  # 0: ImxL (Linear)     1: ImxC (Circular)
+            AmY = (low & 0b_0001_0000) >> 4  # 0: ImyL (Linear)     1: ImyC (Circular)
+            DmX = (low & 0b_0000_1000) >> 3  # 0: X0    1: X1
+            DmY = (low & 0b_0000_0100) >> 2  # 0: Y0    1: Y1
+            if EM == 0b_0:
+                fetches = ()
+                doubleFetchText = 'MR = %s' % (operation)
+            elif EM == 0b_1:
+                fetches = ((X0 + DmX, 0, AmX), (Y0 + DmY, 1, AmY))
+                doubleFetchText = 'MR = %s, X%s = RAM(Ix2, %s), Y%s = RAM(Iy2, %s)' % (operation, DmX, ['ImxL', 'ImxC'][AmX], DmY, ['ImyL', 'ImyC'][AmY])
+        else:
+            fetches = None
+            doubleFetchText = None
+        if MAC in [0b_011, 0b_111]:
+            instruction = Instruction(executeNotImplemented, 'MR = %s%s' % (operation, operation2), '', True)
+            instruction.cycles = MAC_CYCLES
+            return instruction
+        return Instruction(executeMac, MAC, X0 + X, Y0 + Y, load, fetches, 'MR = %s%s' % (operation, operation2), doubleFetchText)
     # Reg Move
     elif high == 0b_1111_1000 and (low & 0b_0000_0011) == 0b_00:
         regSrc = (low & 0b_1110_0000) >> 5
         regDst = (low & 0b_0001_1100) >> 2
-        print_instruction(PC*2, '%s = %s' % (register(regDst), register(regSrc)))
-        regMove(register(regDst), register(regSrc))
-        incrementPC()
+        return Instruction(executeRegMove, regDst, regSrc, '%s = %s' % (register(regDst), register(regSrc)))
     # Push / Pop
     elif high == 0b_1111_1000 and (low & 0b_0001_1110) >> 1 == 0b_0001:
         reg = (low & 0b_1110_0000) >> 5
         U = low & 0b_0000_0001               # 0: push  1: pop
         mnemonic = pushpop(U)
-        print_instruction(PC*2, '%s %s' % (mnemonic, register(reg)))
-        pushPopRegister(U, register(reg))
-        incrementPC()
+        return Instruction(executePushPopRegister, U, reg, '%s %s' % (mnemonic, register(reg)))
     # Shift
     elif ((high >> 1) & 0b_0111_1111) == 0b_111_1101:
         _f = high & 0b_0000_0001             # 0: r0    1: r1
@@ -1247,124 +1613,2526 @@ while not quit:
         sf = (low & 0b_0001_1000) >> 3       # 00: Shift Left Sign Extension    01: A/L Shift Left  10: A Shift Right   11: L Shift Right
         sh = low & 0b_0000_0111              # Number of bits to shift (000: 1, 001: 2, ...)
         mnemonic = shift(sf)
-        print_instruction(PC*2, 'R%s = %s.%s %s' % (_f, mnemonic, (sh+1), register(reg)), '', True)
-        computeShift('R%s' % _f, sf, sh+1, register(reg))
-        incrementPC()
+        return Instruction(executeShift, R0 + _f, sf, sh+1, reg, 'R%s = %s.%s %s' % (_f, mnemonic, (sh+1), register(reg)))
     # I/O (2) + Push / Pop I/O
     elif high == 0b_1111_1100 and (low & 0b_1000_0000) >> 7 == 0b_1:
         r = (low & 0b_0100_0000) >> 6        # 0: Push IO(offset)   1: Pop IO(offset)
         offset = low & 0b_0011_1111
         mnemonic = pushpop(r)
-        print_instruction(PC*2, '%s IO(%s)' % (mnemonic, hex(offset, 2)), 'I/O register = %s' % (ioRegisterLabel(offset)), True)
-        pushPopIO(r, ioRegisterLabel(offset))
-        incrementPC()
-    # Reserved  FIXME Should throw en error ???
-    elif high == 0b_1111_1100 and (low & 0b_1000_0000) >> 7 == 0b_0:
-        print_instruction(PC*2, 'Reserved', '', True)
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()
-    # Callff (2-words instruction)
-    elif high == 0b_1111_1101:
-        abs_addr_high = low
-        second_word = getOpCode(PC+1)
-        #print('%s %s' % (hex(second_word[0],2), hex(second_word[1],2)))
-        abs_addr_low = second_word
-        abs_addr = (abs_addr_high << 16) | abs_addr_low
-        print_instruction(PC*2, 'Callff\t%s' % (hex(abs_addr, 6)), '', True)
-        retAddr = PC+2
-        retH = (retAddr >> 16) & 0xff
-        retL = retAddr & 0xffff
-        push(retL)
-        push(retH)
-        setPC(abs_addr)
-    # Jumpff (2-words instruction)
-    elif high == 0b_1111_1110:
-        abs_addr_high = low
-        second_word = getOpCode(PC+1)
-        #print('%s %s' % (hex(second_word[0],2), hex(second_word[1],2)))
-        abs_addr_low = second_word
-        abs_addr = (abs_addr_high << 16) | abs_addr_low
-        print_instruction(PC*2, 'Jmpff\t%s' % (hex(abs_addr, 6)), '', True)
-        setPC(abs_addr)
-    # Do0   FIXME No operation documentation??? Should fail ???
+        return Instruction(executePushPopIO, r, offset, '%s IO(%s)' % (mnemonic, hex(offset, 2)), 'I/O register = %s' % (ioRegisterLabel(offset)))
+    # Do0   FIXME No operation documentation??? (was decoded as Reserved)
     elif high == 0b_1111_1100 and (low & 0b_1100_0000) >> 6 == 0b_00:
         cntV = low & 0b_0011_1111
-        print_instruction(PC*2, 'Do0\t%s' % (cntV), '', True)
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()
-    # Do1   FIXME No operation documentation??? Should fail ???
+        return Instruction(executeDo, 0, cntV, 'Do0\t%s' % (cntV))
+    # Do1   FIXME No operation documentation??? (was decoded as Reserved)
     elif high == 0b_1111_1100 and (low & 0b_1100_0000) >> 6 == 0b_01:
         cntV = low & 0b_0011_1111
-        print_instruction(PC*2, 'Do1\t%s' % (cntV), '', True)
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()
-    # Loop0 FIXME No operation documentation??? Should fail ???
+        return Instruction(executeDo, 1, cntV, 'Do1\t%s' % (cntV))
+    # Callff (2-words instruction)
+    elif high == 0b_1111_1101:
+        return Instruction(executeCallff, low)
+    # Jumpff (2-words instruction)
+    elif high == 0b_1111_1110:
+        return Instruction(executeJmpff, low)
+    # Loop0 FIXME No operation documentation???
     elif high == 0b_1111_1111 and low == 0b_1111_1100:
-        print_instruction(PC*2, 'Loop0', '', True)
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()   # FIXME
-    # Loop1 FIXME No operation documentation??? Should fail ???
+        return Instruction(executeLoop, 0, 'Loop0')
+    # Loop1 FIXME No operation documentation???
     elif high == 0b_1111_1111 and low == 0b_1111_1110:
-        print_instruction(PC*2, 'Loop1', '', True)
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()   # FIXME
+        return Instruction(executeLoop, 1, 'Loop1')
     # Ret
     elif high == 0b_1111_1111 and low == 0b_0100_0000:
-        print_instruction(PC*2, 'Ret')
-        retAddr = pop()
-        setPC(retAddr)
+        return Instruction(executeRet, 'Ret')
     # Reti
     elif high == 0b_1111_1111 and low == 0b_0100_0001:
-        print_instruction(PC*2, 'Reti')
-        retH = pop()
-        retL = pop()
-        retAddr = (retH << 16) | retL
-        setPC(retAddr)
+        return Instruction(executeReti, 'Reti')
     # Retff
     elif high == 0b_1111_1111 and low == 0b_0100_0010:
-        print_instruction(PC*2, 'Retff')
-        retH = pop()
-        retL = pop()
-        retAddr = (retH << 16) | retL
-        setPC(retAddr)
+        return Instruction(executeRetff, 'Retff')
     # ICEC  FIXME Unused ???
     elif high == 0b_1111_1111 and low == 0b_1111_1101:
-        print_instruction(PC*2, 'ICE Call Function', '', True)
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()
+        return Instruction(executeNotImplemented, 'ICE Call Function', '', True)
     # NOP
     elif high == 0b_1111_1111 and low == 0b_1111_1111:
-        print_instruction(PC*2, 'Nop')
-        incrementPC()
+        return Instruction(executeNop, 'Nop')
     # DisSPSW   FIXME Undocumented ?! Should fail ??? (Clear SCR.SPSW)
     elif high == 0b_1111_1111 and low == 0b_0000_0001:
-        print_instruction(PC*2, 'DisSPSW', '', True)
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()
+        return Instruction(executeNotImplemented, 'DisSPSW', '', True)
     # EnSPSW    FIXME Undocumented ?! Should fail ??? (Enable SCR.SPSW write)
     elif high == 0b_1111_1111 and low == 0b_1111_1111:
-        print_instruction(PC*2, 'EnSPSW', ', True')
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()
-    # EMAC      FIXME CONFLICTS WITH MAC OPERATION (0b_11110...) ?!
-    elif ((high >> 3) & 0b_1111_1000) == 0b_11110 and (low & 0b_01000000) >> 6 == 0b_1:
-        MAC = high & 0b_0000_0111
-        EM = (low & 0b_1000_0000) >> 7       # 0: simple MAC    1: multiple-function
-        AmX = (low & 0b_0010_0000) >> 5      # 0: ImxL (Linear)     1: ImxC (Circular)
-        AmY = (low & 0b_0001_0000) >> 4      # 0: ImyL (Linear)     1: ImyC (Circular)
-        DmX = (low & 0b_0000_1000) >> 3      # 0: X0    1: X1
-        DmY = (low & 0b_0000_0100) >> 2      # 0: Y0    1: Y1
-        X = (low & 0b_0000_0010) >> 1        # 0: X0    1: X1
-        Y = low & 0b_0000_0001               # 0: Y0    1: Y1
-        # TODO Multiple Functions with Double-Fetched
-        # When MMR register (0x0017) bit13 is set, MAC operation should enable Double Fetch Instruction
-        # -> same binary instruction, different behaviour and parameter layout...
-        print_instruction(PC*2, 'EMAC')
-        print_error('NOT YET IMPLEMENTED')
-        incrementPC()
+        return Instruction(executeNotImplemented, 'EnSPSW', ', True', False)
     # Unhandled opcode
     else:
-        print('%s\tUNKNOWN' % hex(PC*2,6))
-        print_error('UNKNOWN INSTRUCTION')
-        raise
-        # TODO Should break and throw an error
+        return Instruction(executeUnknown)
+
+# Every 16-bit opcode is decoded once, the first time it is executed
+opcodeTable = [None] * 0x10000
+
+def decodeAt(PC):
+    opcode = getOpCode(PC)
+    instruction = opcodeTable[opcode]
+    if instruction is None:
+        instruction = opcodeTable[opcode] = decodeOpCode(opcode)
+    return instruction
+
+
+# Basic blocks
+# Straight-line instructions up to (and including) the next control flow instruction are translated
+# into a single Python function, cached by start address. Instructions in a block are executed without
+# fetching, decoding or incrementing PC, which is only updated before the last instruction of the block.
+BLOCK_MAX_LENGTH = 256
+BLOCK_STEP = -1         # returned by blocks which would run past an event, the next instruction is stepped
+# Handlers that write to data memory, possibly to WRAM shared with the Program RAM window at 0x200000
+storeHandlers = [executeAUToRAM, executeRAMFromRegister, executeRAMFromRegisterDirect, executePushPopRegister, executePushPopIO]
+# Handlers that can trigger watchpoints, besides stores
+watchedHandlers = [executeRegisterFromRAM, executeRegisterFromRAMDirect, executeRegisterFromROM, executeRegFromIO, executeIOFromReg, executeMac]
+blockCache = dict()     # start address -> block function (None if no block can start there)
+blockEnds = dict()      # start address -> address following the cached block
+codeWords = dict()      # writable program memory address -> start addresses of the blocks covering it
+blockInterrupted = False
+breakpoints = dict()    # address -> Breakpoint, blocks never run past a breakpoint
+instructionCount = 0    # instructions executed so far
+cycleCount = 0          # cycles taken by these instructions (see instructionCycles)
+instructionLimit = 0    # run() stops once instructionCount reaches it
+
+def isProgramAddress(address):
+    return programPages[address >> PAGE_BITS] is not unmappedProgram
+
+def isWritableProgramAddress(address):
+    page = programPages[address >> PAGE_BITS]
+    if type(page) is WatchPage:
+        page = page.page
+    return type(page) is RAMPage
+
+def touchesPC(instruction):
+    # Instructions accessing PCH/PCL as I/O registers need an up-to-date PC, they cannot be part of a block
+    if instruction.handler in [executeRegFromIO, executePushPopIO]:
+        return instruction.args[1] in [IO_PCH, IO_PCL]
+    if instruction.handler == executeIOFromReg:
+        return instruction.args[0] in [IO_PCH, IO_PCL]
+    return False
+
+# Hooks which neither depend on cycleCount nor schedule events
+timelessHooks = [readSSF, writeSSF, mapSharedPRAM]
+
+def accessesDevice(instruction):
+    """Whether an instruction can access a device (I/O register with a hook, memory mapped device), which may
+    depend on the cycle count or schedule an event"""
+    handler = instruction.handler
+    args = instruction.args
+    if handler == executeRegFromIO:
+        hooks = [ioReadHooks[args[1]]]
+    elif handler == executeIOFromReg:
+        hooks = [ioWriteHooks[args[0]]]
+    elif handler == executePushPopIO:
+        hooks = [ioReadHooks[args[1]], ioWriteHooks[args[1]]]
+    elif handler == executeRegisterFromRAMDirect:
+        return type(dataPages[args[1] >> PAGE_BITS]) is MMIOPage
+    elif handler == executeRAMFromRegisterDirect:
+        return type(dataPages[args[0] >> PAGE_BITS]) is MMIOPage
+    elif handler == executeMac:
+        return args[3] is not None or bool(args[4])
+    else:
+        # Indirect accesses to data memory
+        return handler in [executeRegisterFromRAM, executeRAMFromRegister, executeAUToRAM]
+    return any(hook is not None and hook not in timelessHooks for hook in hooks)
+
+def blockCode(name, start, aot=False):
+    """Source of a function executing the basic block at start, returning the next PC (None after a return), or
+    BLOCK_STEP when an event is due before its last instruction. Also returns the address following the block
+    and the control flow instruction ending it (if any)."""
+    lines = ['def %s():' % name, '    global instructionCount', '    global cycleCount']
+    PC = start
+    count = 0
+    cycles = 0
+    synced = 0          # cycles of the instructions before the current one, already added to cycleCount
+    lastStart = 0       # cycles of the instructions before the last one
+    last = None
+    macs = False
+    loops = True
+    while count < BLOCK_MAX_LENGTH and isProgramAddress(PC) and (aot or PC == start or PC not in breakpoints):
+        instruction = decodeAt(PC)
+        if touchesPC(instruction):
+            break
+        call = '%s(%s)' % (instruction.handler.__name__, ', '.join(repr(arg) for arg in (PC,) + instruction.args))
+        count += 1
+        cost = instructionCost(PC, instruction)
+        lastStart = cycles
+        device = accessesDevice(instruction)
+        if device and cycles > synced:
+            # Devices see the cycle count at the start of the instruction, like step() does
+            lines.append('    cycleCount += %d' % (cycles - synced))
+            synced = cycles
+        cycles += cost
+        macs = macs or instruction.handler == executeMac
+        loops = loops and instruction.handler != executeDo
+        if instruction.flow:
+            body = lines[3:]
+            bodySynced = synced
+            # Control flow handlers compute their target from PC
+            lines.append('    ioReg[IO_PCL] = %s' % hex(PC & 0xffff, 4))
+            lines.append('    ioReg[IO_PCH] = %s' % hex((PC >> 16) & 0xff, 2))
+            lines.append('    instructionCount += %d' % count)
+            lines.append('    cycleCount += %d' % (cycles - synced))
+            lines.append('    %s' % call)
+            if instruction.handler in [executeRet, executeRetff, executeReti]:
+                lines.append('    return None')
+            else:
+                if aot and instruction.handler in [executeCall, executeCallff]:
+                    # Direct call to the compiled routine, which returns when the callee executes Ret/Retff
+                    target = flowTargets(PC, instruction)[1][0]
+                    if isAOTAddress(target):
+                        lines.append('    %s(%s)' % (aotRoutineName(target), hex(target, 6)))
+                lines.append('    return (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]')
+            last = (PC, instruction)
+            PC += 1
+            break
+        lines.append('    %s' % call)
+        PC += 1
+        conditions = []
+        if instruction.handler in storeHandlers or (watchpoints and instruction.handler in watchedHandlers):
+            # Stop here if this instruction overwrote code from a cached block, or triggered a watchpoint
+            conditions.append('blockInterrupted')
+        if device:
+            # or made an event due (interrupt request, device started...), which step() would run next
+            conditions.append('cycleCount + %d >= nextEventCycle' % (cycles - synced))
+        if conditions:
+            lines.append('    if %s:' % ' or '.join(conditions))
+            lines.append('        instructionCount += %d' % count)
+            lines.append('        cycleCount += %d' % (cycles - synced))
+            lines.append('        return leaveBlock(%s)' % hex(PC, 6))
+    if count == 0:
+        return None, PC, None
+    # Events due before the last instruction of the block starts are run before the instruction they are due at
+    lines.insert(3, '    if cycleCount + %d >= nextEventCycle:' % lastStart)
+    lines.insert(4, '        return BLOCK_STEP')
+    if loops and last is not None and last[1].handler == executeLoop:
+        # Body of a hardware loop: repeated without returning to the run loop, or decoding the Loop instruction,
+        # until the events due (including the ones the body schedules)
+        unit = last[1].args[0]
+        lines[3:3] = ['    for iteration in range(loopIterations(%d, %s, %d, %d)):' % (unit, hex(start, 6), count, cycles)] + \
+            ['    ' + line for line in body] + \
+            ['        instructionCount += %d' % count, '        cycleCount += %d' % (cycles - bodySynced), '        loopCounters[%d] -= 1' % unit,
+             '        if cycleCount + %d >= nextEventCycle:' % lastStart, '            break']
+    if macs and isMacLoop(start, last):
+        lines.insert(3, '    runMacLoop(%s)' % hex(start, 6))
+    elif isIdleLoop(start, last):
+        lines.insert(3, '    skipIdleLoop(%s, %d, %d)' % (hex(start, 6), count, cycles))
+    if last is None:
+        lines.append('    instructionCount += %d' % count)
+        lines.append('    cycleCount += %d' % (cycles - synced))
+        lines.append('    leaveBlock(%s)' % hex(PC, 6))
+        lines.append('    return %s' % hex(PC, 6))
+    return '\n'.join(lines), PC, last
+
+def translateBlock(start):
+    source, end, last = blockCode('block', start)
+    if source is None:
+        blockCache[start] = None
+        return None
+    namespace = dict()
+    exec(source, globals(), namespace)
+    block = namespace['block']
+    blockCache[start] = block
+    blockEnds[start] = end
+    for address in range(start, end):
+        if isWritableProgramAddress(address):
+            codeWords.setdefault(address, []).append(start)
+    return block
+
+def leaveBlock(nextPC):
+    global blockInterrupted
+    blockInterrupted = False
+    ioReg[IO_PCL] = nextPC & 0xffff
+    ioReg[IO_PCH] = (nextPC >> 16) & 0xff
+
+def invalidateCode(address):
+    # Called when program memory is written: drop every cached or compiled block covering the address
+    global blockInterrupted
+    for start in codeWords.pop(address, []):
+        macLoops.pop((start, False), None)
+        macLoops.pop((start, True), None)
+        idleStates.pop(start, None)
+        if start in blockCache:
+            if traceLevel >= TRACE_FULL:
+                print_execution(f"Invalidating cached block at {bcolors.REGVAL}{hex(start, 6)}{bcolors.ENDC}{bcolors.EXECUTION}")
+            del blockCache[start]
+            del blockEnds[start]
+        if start in aotEntries:
+            if traceLevel >= TRACE_FULL:
+                print_execution(f"Disabling compiled block at {bcolors.REGVAL}{hex(start, 6)}{bcolors.ENDC}{bcolors.EXECUTION}")
+            disableAOTBlock(start)
+    blockInterrupted = True
+
+def invalidateProgramPage(base):
+    # The content of a whole page of program memory was replaced
+    for address in range(base, base + PAGE_SIZE):
+        if address in codeWords:
+            invalidateCode(address)
+
+
+# MAC loops
+# Blocks jumping back to themselves while accumulating products of operands loaded from RAM (FIR filters, dot
+# products, ...) run all their iterations but the last at once: the words loaded by every iteration are read
+# as strided runs of RAM pages, and the products are accumulated with NumPy when it is available. Such loops
+# only hold loads from RAM (or parallel loads) with constant modifiers, MR += / MR -= MACs, the decrement of
+# a counter register, and end with Jne to their start. Iterations are run at once as long as the counter does
+# not reach 0, index registers do not overflow, and neither the instruction limit nor the next event is reached.
+MAC_LOOP_MIN_ITERATIONS = 8
+JNE = 0b_0001
+macLoops = dict()       # (start address, double fetch mode) -> MacLoop (None if the block is not one)
+
+class MacLoop:
+    """Structure of a MAC loop. Loads are (register, index register, bank register or None, modifier register)
+    in execution order, MAC operands are ('load', load) for a word loaded before it in the same iteration,
+    ('previous', load) for a word loaded after it in the previous iteration, or ('register', register)."""
+    __slots__ = ('length', 'cycles', 'counter', 'loads', 'macs', 'lastLoads')
+
+    def __init__(self, length, cycles, counter, loads, macs, lastLoads):
+        self.length = length
+        self.cycles = cycles
+        self.counter = counter
+        self.loads = loads
+        self.macs = macs
+        self.lastLoads = lastLoads      # register -> last load of the register in an iteration
+
+def isMacLoop(start, last):
+    # Blocks that may be MAC loops (see analyzeMacLoop)
+    if last is None or last[1].handler != executeJcond or last[1].args[0] != JNE:
+        return False
+    return flowTargets(*last)[0][0] == start
+
+def analyzeMacLoop(start, doubleFetchMode):
+    loads = []
+    macs = []
+    lastLoads = dict()
+    counter = None
+    length = 0
+    cycles = 0
+    PC = start
+    while length < BLOCK_MAX_LENGTH and isProgramAddress(PC) and (PC == start or PC not in breakpoints):
+        instruction = decodeAt(PC)
+        handler = instruction.handler
+        args = instruction.args
+        length += 1
+        cycles += instructionCost(PC, instruction)
+        if handler == executeJcond:
+            if isMacLoop(start, (PC, instruction)) and macs and counter is not None:
+                macs = [(MAC, macOperand(first, lastLoads), macOperand(second, lastLoads)) for (MAC, first, second) in macs]
+                return MacLoop(length, cycles, counter, loads, macs, lastLoads)
+            return None
+        elif handler == executeRegisterFromRAM and args[0] in destXYIndex:
+            (reg, ix, bk, im) = args[:4]
+            lastLoads[reg] = len(loads)
+            loads.append((reg, ix, bk, im))
+        elif handler == executeMac and args[0] & 0b_011 in [0b_01, 0b_10]:
+            (MAC, first, second, load, fetches) = args[:5]
+            # Operands loaded earlier in the iteration, others are resolved once the whole iteration is known
+            macs.append((MAC, ('load', lastLoads[first]) if first in lastLoads else first, ('load', lastLoads[second]) if second in lastLoads else second))
+            if fetches is not None and doubleFetchMode:
+                for (reg, pointer, circular) in fetches:
+                    if circular:
+                        return None
+                    (ix, linear, _, _, _) = doubleFetchRegisters[pointer]
+                    lastLoads[reg] = len(loads)
+                    loads.append((reg, ix, None, linear))
+                if fetches:
+                    cycles += EMAC_CYCLES - MAC_CYCLES
+            elif load is not None:
+                (reg, ix, bk, im) = load
+                lastLoads[reg] = len(loads)
+                loads.append((reg, ix, bk, im))
+        elif handler == executeAU and args[1] == 0b_001 and args[0] == args[2] and counter is None and args[0] not in destXYIndex:
+            # Counter decrement (MAC operands and loads are X0, X1, Y0 or Y1)
+            counter = args[0]
+        else:
+            return None
+        PC += 1
+    return None
+
+def macOperand(operand, lastLoads):
+    if isinstance(operand, tuple):
+        return operand
+    if operand in lastLoads:
+        return ('previous', lastLoads[operand])
+    return ('register', operand)
+
+def dataWords(address, stride, count):
+    """Words of data memory at address, address + stride, ... if they all are in RAM pages, None otherwise"""
+    if stride == 0:
+        page = dataPages[address >> PAGE_BITS]
+        return array('H', [page.read(address)]) * count if type(page) is RAMPage else None
+    words = array('H')
+    while count > 0:
+        page = dataPages[address >> PAGE_BITS]
+        if type(page) is not RAMPage:
+            return None
+        offset = address & PAGE_MASK
+        inPage = min(count, ((PAGE_MASK - offset) // stride if stride > 0 else offset // -stride) + 1)
+        end = offset + stride * inPage
+        words.extend(page.words[offset:end if end >= 0 else None:stride])
+        address += stride * inPage
+        count -= inPage
+    return words
+
+def macTerms(loop, streams, iterations):
+    """Products added to MR by every MAC of every iteration, in execution order"""
+    columns = []
+    for (MAC, first, second) in loop.macs:
+        operands = []
+        for (kind, source) in [first, second]:
+            if kind == 'load':
+                words = streams[source]
+            elif kind == 'previous':
+                words = array('H', [internal[loop.loads[source][0]]]) + streams[source][:-1]
+            else:
+                words = array('H', [internal[source]]) * iterations
+            operands.append(words)
+        sign = 1 if MAC & 0b_011 == 0b_01 else -1
+        if MAC & 0b_100:
+            # FS
+            sign *= 2
+        if numpy is not None:
+            columns.append(numpy.frombuffer(operands[0], dtype=numpy.int16).astype(numpy.int64) * numpy.frombuffer(operands[1], dtype=numpy.int16) * sign)
+        else:
+            columns.append([x * y * sign for x, y in zip(array('h', operands[0].tobytes()), array('h', operands[1].tobytes()))])
+    if numpy is not None:
+        return numpy.stack(columns, axis=1).ravel()
+    return [term for terms in zip(*columns) for term in terms]
+
+def accumulateMac(mr, terms):
+    # Same result as adding the terms one at a time with saturation: partial sums only need to be saturated
+    # from the first one outside of the 40-bit range
+    if numpy is not None:
+        sums = numpy.cumsum(terms) + mr
+        outside = (sums > MR_MAX) | (sums < MR_MIN)
+        if not outside.any():
+            return int(sums[-1])
+        first = int(outside.argmax())
+        mr = saturateMR(int(sums[first]))
+        terms = terms[first + 1:].tolist()
+    for term in terms:
+        mr = saturateMR(mr + term)
+    return mr
+
+def runMacLoop(start):
+    """Called by the block of a possible MAC loop before its instructions"""
+    global instructionCount
+    global cycleCount
+    if traceLevel >= TRACE_INSTRUCTIONS or watchpoints or start in breakpoints:
+        return
+    key = (start, ioReg[IO_MMR] & MMR_DOUBLE_FETCH != 0)
+    if key not in macLoops:
+        macLoops[key] = analyzeMacLoop(start, key[1])
+    loop = macLoops[key]
+    if loop is None:
+        return
+    # The block runs the iteration following them, which may be the last one
+    iterations = (internal[loop.counter] or 0x10000) - 1
+    if instructionLimit != float('inf'):
+        iterations = min(iterations, int(instructionLimit - instructionCount) // loop.length - 1)
+    if nextEventCycle != float('inf'):
+        iterations = min(iterations, int(nextEventCycle - cycleCount - 1) // loop.cycles)
+    if iterations < MAC_LOOP_MIN_ITERATIONS:
+        return
+    # Offsets of the loads from their index register in an iteration, which must not overflow
+    offsets = []
+    steps = dict()
+    for (_, ix, _, im) in loop.loads:
+        offsets.append(steps.get(ix, 0))
+        steps[ix] = offsets[-1] + signed16(ioReg[im])
+    for ((_, ix, _, im), offset) in zip(loop.loads, offsets):
+        for value in [ioReg[ix] + offset, ioReg[ix] + offset + signed16(ioReg[im])]:
+            if min(value, value + (iterations - 1) * steps[ix]) < 0 or max(value, value + (iterations - 1) * steps[ix]) > 0xffff:
+                return
+    streams = []
+    for ((_, ix, bk, _), offset) in zip(loop.loads, offsets):
+        words = dataWords((ioReg[bk] if bk is not None else 0) + ioReg[ix] + offset, steps[ix], iterations)
+        if words is None:
+            return
+        streams.append(words)
+    setMR(accumulateMac(getMR(), macTerms(loop, streams, iterations)))
+    for reg, load in loop.lastLoads.items():
+        internal[reg] = streams[load][-1]
+    for ix, step in steps.items():
+        ioReg[ix] += iterations * step
+    if any(bk is not None for (_, _, bk, _) in loop.loads):
+        clearFlag('IOF')
+    internal[loop.counter] = (internal[loop.counter] - iterations) & 0xffff
+    instructionCount += iterations * loop.length
+    cycleCount += iterations * loop.cycles
+
+
+# Idle loops
+# Blocks jumping back to themselves which only read registers, I/O registers (without side effects) and memory
+# are polling loops: once an iteration ends in the state it started from, the next ones are identical until
+# an event (or the outside) changes something. Emulated time then skips to the iteration where the next event
+# is taken, or to the instruction limit.
+idleHandlers = [executeRegFromIO, executeRegisterFromRAM, executeRegisterFromRAMDirect, executeRegisterFromROM, executeAU, executeLU1,
+    executeLU2, executeShift, executeShiftWithIndex, executeRegMove, executeLoadImmediate, executeLoadIndexImmediate, executeNop]
+idleStates = dict()     # start address -> (registers and flags, instructionCount) when its block last started
+
+def isIdleLoop(start, last):
+    if last is None or last[1].handler not in [executeJcond, executeJmp] or flowTargets(*last)[0][0] != start:
+        return False
+    for PC in range(start, last[0]):
+        instruction = decodeAt(PC)
+        if instruction.handler not in idleHandlers:
+            return False
+        if instruction.handler == executeRegFromIO and ioReadHooks[instruction.args[1]] not in [None, readSSF, readADCStatus, readDACStatus]:
+            # The value of devices like timer counters changes with time (FIFO status registers schedule an
+            # event where they change, see scheduleStatusChange)
+            return False
+    return True
+
+def skipIdleLoop(start, length, cycles):
+    """Called by the block of a possible idle loop before its instructions"""
+    global instructionCount
+    global cycleCount
+    state = (internal.tobytes(), ioReg.tobytes(), pendingFlags)
+    previous = idleStates.get(start)
+    idleStates[start] = (state, instructionCount)
+    # Same state as when the previous iteration started, nothing else ran since
+    if previous is None or previous[1] + length != instructionCount or previous[0] != state:
+        return
+    if traceLevel >= TRACE_INSTRUCTIONS or watchpoints or start in breakpoints:
+        return
+    # The block runs the iteration following them, at the end of which the next event is taken
+    iterations = float('inf')
+    if nextEventCycle != float('inf'):
+        iterations = (nextEventCycle - cycleCount + cycles - 1) // cycles - 1
+    if instructionLimit != float('inf'):
+        iterations = min(iterations, int(instructionLimit - instructionCount) // length - 1)
+    if iterations == float('inf') or iterations <= 0:
+        return
+    instructionCount += iterations * length
+    cycleCount += iterations * cycles
+    idleStates[start] = (state, instructionCount)
+
+
+# Breakpoints and watchpoints
+# Breakpoints are only looked up between blocks, which never run past one. Watchpoints are checked by
+# WatchPage wrappers installed in the page tables over the watched pages, and by wrappers of the I/O hooks
+# of the watched I/O registers: pages and registers without watchpoints are accessed as usual. While there
+# are watchpoints, blocks check for hits after every instruction accessing memory or I/O registers, and
+# compiled routines (translated without these checks) are not used.
+class Breakpoint:
+    __slots__ = ('address', 'condition', 'ignore', 'hits')
+
+    def __init__(self, address, condition=None, ignore=0):
+        self.address = address
+        self.condition = compileCondition(condition)
+        self.ignore = ignore        # Hits ignored before stopping
+        self.hits = 0
+
+class Watchpoint:
+    __slots__ = ('space', 'address', 'access', 'condition', 'ignore', 'hits')
+
+    def __init__(self, space, address, access='w', condition=None, ignore=0):
+        self.space = space          # 'data', 'program' or 'io'
+        self.address = address
+        self.access = access        # 'r', 'w' or 'rw'
+        self.condition = compileCondition(condition)
+        self.ignore = ignore
+        self.hits = 0
+
+watchpoints = dict()    # (space, address) -> Watchpoint
+watchPages = []         # (page table, index) of the installed WatchPages
+watchedIOHooks = dict() # I/O address -> (read hook, write hook) wrapped by watchpoints
+watching = True         # False while the state is accessed from outside (Emulator accessors, conditions)
+stopReason = None       # Breakpoint or (Watchpoint, access, value) which stopped run()
+
+def compileCondition(condition):
+    # Conditions are Python expressions (see conditionNamespace), or functions of the Emulator
+    if isinstance(condition, str):
+        return compile(condition, '<condition>', 'eval')
+    return condition
+
+def conditionNamespace(address, value):
+    namespace = dict(zip(registers_reg, internal))
+    namespace.update([(label, ioReg[io]) for (label, io) in ioAddresses.items()])
+    namespace.update([
+        ('PC', (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]),
+        ('address', address),
+        ('value', value),
+        ('wram', lambda address: unwatched(readData, address)),
+        ('pram', lambda address: unwatched(readProgram, address)),
+    ])
+    return namespace
+
+def conditionMet(point, address, value):
+    if point.condition is not None:
+        if callable(point.condition):
+            met = unwatched(point.condition, Emulator.active)
+        else:
+            met = eval(point.condition, dict(), conditionNamespace(address, value))
+        if not met:
+            return False
+    point.hits += 1
+    return point.hits > point.ignore
+
+def breakpointHit(PC):
+    global stopReason
+    breakpoint = breakpoints[PC]
+    if not conditionMet(breakpoint, PC, None):
+        return False
+    stopReason = breakpoint
+    return True
+
+def watchpointHit(space, address, access, value):
+    global stopReason
+    global instructionLimit
+    global blockInterrupted
+    watchpoint = watchpoints[(space, address)]
+    if access not in watchpoint.access or not conditionMet(watchpoint, address, value):
+        return
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Watchpoint: {space} {hex(address, 6)} {'read' if access == 'r' else 'written'} ({bcolors.REGVAL}{hex(value, 4)}{bcolors.ENDC}{bcolors.EXECUTION})")
+    stopReason = (watchpoint, access, value)
+    # Stop after this instruction
+    instructionLimit = 0
+    blockInterrupted = True
+
+def unwatched(function, *args):
+    global watching
+    watching = False
+    try:
+        return function(*args)
+    finally:
+        watching = True
+
+def removeWatchPages():
+    for (pages, index) in watchPages:
+        if type(pages[index]) is WatchPage:
+            pages[index] = pages[index].page
+    watchPages.clear()
+    for io, (readHook, writeHook) in watchedIOHooks.items():
+        ioReadHooks[io] = readHook
+        ioWriteHooks[io] = writeHook
+    watchedIOHooks.clear()
+
+def watchIOHook(io, access, hook):
+    def watchedHook():
+        if hook is not None:
+            hook()
+        if watching:
+            watchpointHit('io', io, access, ioReg[io])
+    return watchedHook
+
+def installWatchpoints():
+    # Called with the page tables and I/O hooks free of watchpoint wrappers
+    for (space, address), watchpoint in watchpoints.items():
+        if space == 'io':
+            if address not in watchedIOHooks:
+                watchedIOHooks[address] = (ioReadHooks[address], ioWriteHooks[address])
+                ioReadHooks[address] = watchIOHook(address, 'r', ioReadHooks[address])
+                ioWriteHooks[address] = watchIOHook(address, 'w', ioWriteHooks[address])
+            continue
+        pages = programPages if space == 'program' else dataPages
+        index = address >> PAGE_BITS
+        if type(pages[index]) is not WatchPage:
+            pages[index] = WatchPage(pages[index], space)
+            watchPages.append((pages, index))
+        if 'r' in watchpoint.access:
+            pages[index].reads.add(address)
+        if 'w' in watchpoint.access:
+            pages[index].writes.add(address)
+
+def flushBlocks():
+    # Cached blocks are translated differently while there are watchpoints
+    for start in blockCache:
+        for address in range(start, blockEnds.get(start, start)):
+            if address in codeWords and start in codeWords[address]:
+                codeWords[address].remove(start)
+    blockCache.clear()
+    blockEnds.clear()
+
+
+# Ahead-of-time recompilation
+# Every routine statically reachable from the reset and interrupt vectors is translated into Python source:
+# one function per basic block, and one function per routine dispatching between its blocks. Calls to
+# other routines are direct Python calls. The generated code is compiled and cached on disk, keyed by the
+# hash of the ROM, the chip profile (which maps the pages it is translated from) and the hash of this
+# emulator. Anything it does not cover (code in the 0x200000 window, indirect or unknown targets,
+# overwritten code, breakpoints) is left to the interpreter.
+AOT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 's9ke-toolchain')
+vectors = [0x000000] + list(range(0x000014, 0x00007c, 4))
+aotRoutines = dict()        # routine entry -> routine function
+aotRoutineBlocks = dict()   # routine entry -> {block start -> block function}
+aotBlockEnds = dict()       # block start -> address following the block
+aotEntries = dict()         # block start -> routine function able to resume there
+# Direct calls nest Python calls: routines which do not return (main loops reached through Call, ...) go back to
+# the interpreter once AOT_MAX_DEPTH routines are running, instead of raising RecursionError
+AOT_MAX_DEPTH = 64
+aotDepth = 0
+
+def isAOTAddress(address):
+    # Program memory initialized from the words of the ROM file
+    if address < chip['pram']:
+        return address >= 0 and address < len(CS1ROM)
+    return address >= CS1ROM_BASE and address < CS1ROM_BASE + min(len(CS1ROM), CS1ROM_SIZE)
+
+def isBlankAddress(address):
+    # Padding and unused vectors (0x0000 decodes as Call 0x0000, which would be followed word by word)
+    return getOpCode(address) == 0x0000
+
+def aotRoutineName(entry):
+    return 'aot_%06x' % entry
+
+def aotBlockName(start):
+    return 'aotb_%06x' % start
+
+def flowTargets(PC, instruction):
+    """Static successors of a control flow instruction: (addresses in the same routine, called routines)"""
+    handler = instruction.handler
+    if handler == executeCall:
+        return [PC+1], [instruction.args[0]]
+    elif handler == executeCallff:
+        return [PC+2], [(instruction.args[0] << 16) | getOpCode(PC+1)]
+    elif handler == executeJmp:
+        return [PC+1+instruction.args[0]], []
+    elif handler == executeJcond:
+        return [PC+1+instruction.args[1], PC+1], []
+    elif handler == executeJmpff:
+        # Tail jump: the target is compiled as a separate routine
+        return [], [(instruction.args[0] << 16) | getOpCode(PC+1)]
+    elif handler == executeLoop:
+        # The start of the loop follows the Do instruction (see translateROM)
+        return [PC+1], []
+    return [], []
+
+def translateROM():
+    blocks = dict()     # block start -> (source, end, last)
+    routines = dict()   # routine entry -> block starts
+    pending = [vector for vector in vectors if isAOTAddress(vector) and not isBlankAddress(vector)]
+    while pending:
+        entry = pending.pop()
+        if entry in routines or not isAOTAddress(entry):
+            continue
+        starts = routines[entry] = set()
+        work = [entry]
+        while work:
+            start = work.pop()
+            if start in starts or not isAOTAddress(start) or isBlankAddress(start):
+                continue
+            if start in blocks:
+                # Also part of another routine
+                (source, end, last) = blocks[start]
+            else:
+                source, end, last = blockCode(aotBlockName(start), start, aot=True)
+                if source is None:
+                    continue
+                blocks[start] = (source, end, last)
+            starts.add(start)
+            work.extend(address + 1 for address in range(start, end) if decodeAt(address).handler == executeDo)
+            if last is None:
+                work.append(end)
+            else:
+                local, callees = flowTargets(*last)
+                work.extend(local)
+                pending.extend(callees)
+    lines = ['# Generated by emulator.py, do not edit', '']
+    for start in sorted(blocks):
+        lines.append(blocks[start][0])
+        lines.append('')
+    lines.append('aotBlockEnds = {%s}' % ', '.join('%s: %s' % (hex(start, 6), hex(blocks[start][1], 6)) for start in sorted(blocks)))
+    lines.append('aotRoutineBlocks = {')
+    for entry in sorted(routines):
+        lines.append('    %s: {%s},' % (hex(entry, 6), ', '.join('%s: %s' % (hex(start, 6), aotBlockName(start)) for start in sorted(routines[entry]))))
+    lines.append('}')
+    lines.append('')
+    for entry in sorted(routines):
+        lines.append('def %s(PC):' % aotRoutineName(entry))
+        lines.append('    global aotDepth')
+        lines.append('    if aotDepth >= AOT_MAX_DEPTH:')
+        lines.append('        return')
+        lines.append('    blocks = aotRoutineBlocks[%s]' % hex(entry, 6))
+        lines.append('    aotDepth += 1')
+        lines.append('    try:')
+        lines.append('        while instructionLimit - instructionCount >= BLOCK_MAX_LENGTH and cycleCount < nextEventCycle:')
+        lines.append('            block = blocks.get(PC)')
+        lines.append('            if block is None:')
+        lines.append('                return')
+        lines.append('            PC = block()')
+        lines.append('            if PC == BLOCK_STEP:')
+        lines.append('                return BLOCK_STEP')
+        lines.append('    finally:')
+        lines.append('        aotDepth -= 1')
+        lines.append('')
+    lines.append('aotRoutines = {%s}' % ', '.join('%s: %s' % (hex(entry, 6), aotRoutineName(entry)) for entry in sorted(routines)))
+    return '\n'.join(lines) + '\n'
+
+def romHash(romPath):
+    digest = hashlib.sha256()
+    with open(romPath, 'rb') as f:
+        for chunk in iter(lambda: f.read(0x100000), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def loadAOT(romPath):
+    with open(__file__, 'rb') as f:
+        emulatorHash = hashlib.sha256(f.read()).hexdigest()
+    name = os.path.join(AOT_CACHE, '%s-%s-%s' % (romHash(romPath), chipName(), emulatorHash[:16]))
+    codePath = '%s.%s.code' % (name, sys.implementation.cache_tag)
+    try:
+        with open(codePath, 'rb') as f:
+            code = marshal.load(f)
+        if traceLevel >= TRACE_FULL:
+            print_execution('Loaded compiled ROM from %s' % codePath)
+    except (OSError, EOFError, ValueError, TypeError):
+        source = translateROM()
+        code = compile(source, name + '.py', 'exec')
+        os.makedirs(AOT_CACHE, exist_ok=True)
+        for path, write in [(name + '.py', lambda f: f.write(source.encode())), (codePath, lambda f: marshal.dump(code, f))]:
+            # Write atomically, other runs of the same ROM may be loading it
+            with open(path + '.%d.tmp' % os.getpid(), 'wb') as f:
+                write(f)
+            os.replace(path + '.%d.tmp' % os.getpid(), path)
+        if traceLevel >= TRACE_FULL:
+            print_execution('Compiled ROM to %s' % codePath)
+    namespace = dict()
+    exec(code, globals(), namespace)
+    globals().update(namespace)
+    for entry, blocks in aotRoutineBlocks.items():
+        for start in list(blocks):
+            end = aotBlockEnds[start]
+            if any(start <= breakpoint < end for breakpoint in breakpoints):
+                # Leave breakpoints to the interpreter
+                del blocks[start]
+                continue
+            aotEntries.setdefault(start, aotRoutines[entry])
+            for address in range(start, end):
+                if isWritableProgramAddress(address) and start not in codeWords.get(address, []):
+                    codeWords.setdefault(address, []).append(start)
+    if traceLevel >= TRACE_FULL:
+        print_execution('Loaded %d compiled routines (%d blocks).' % (len(aotRoutines), len(aotEntries)))
+    return namespace
+
+def disableAOTBlock(start):
+    del aotEntries[start]
+    for blocks in aotRoutineBlocks.values():
+        blocks.pop(start, None)
+
+
+def loadROM(path):
+    """Map the ROM file read-only, as a sequence of 16-bit words (only pages actually read are loaded)"""
+    with open(path, 'rb') as f:
+        size = min(os.fstat(f.fileno()).st_size, 0x800000 * 2) & ~1
+        if size == 0:
+            return array('H')
+        # The mapping stays valid once the file is closed
+        rom = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    words = memoryview(rom)[:size].cast('H')
+    if sys.byteorder != 'little':
+        # ROM words are little-endian: big-endian hosts need a swapped copy
+        words = array('H', words.tobytes())
+        words.byteswap()
+    return words
+
+# Emulated clock
+# Emulated time advances by a cycle of the system clock per cycle taken by instructions. The system clock is
+# generated by the Fractional PLL from the 32.768kHz crystal, changing it starts a new period of time.
+# FIXME The PLL registers are not documented: 0xf300 is assumed to hold the integer part of the multiplier,
+# 0xf301 its fractional part (/65536), and the PLL to be bypassed (system clock = crystal) while it is 0
+PLL_BASE = 0xf300
+PLL_REGISTERS = 4
+PLL_REFERENCE = 32768
+pllRegisters = [0x0000] * PLL_REGISTERS
+clockFrequency = PLL_REFERENCE
+clockStartTime = 0.0    # emulated time (seconds) and cycleCount when clockFrequency was last changed
+clockStartCycle = 0
+
+def emulatedTime():
+    return clockStartTime + (cycleCount - clockStartCycle) / clockFrequency
+
+def readPLL(address):
+    return pllRegisters[address - PLL_BASE]
+
+def writePLL(address, value):
+    global clockFrequency
+    global clockStartTime
+    global clockStartCycle
+    pllRegisters[address - PLL_BASE] = value
+    multiplier = pllRegisters[0] + pllRegisters[1] / 0x10000
+    frequency = PLL_REFERENCE * multiplier if multiplier > 0 else PLL_REFERENCE
+    if frequency != clockFrequency:
+        clockStartTime = emulatedTime()
+        clockStartCycle = cycleCount
+        clockFrequency = frequency
+        if traceLevel >= TRACE_FULL:
+            print_execution('System clock set to %.6f MHz' % (clockFrequency / 1000000))
+
+def resetPLL():
+    for address in range(PLL_BASE, PLL_BASE + PLL_REGISTERS):
+        writePLL(address, 0x0000)
+
+# Event scheduler
+# Devices schedule what they do at a given cycle (timer overflows, ...) instead of being polled: the execution
+# loops only compare cycleCount with nextEventCycle, and run the due events before the instruction step() would run
+# them at (blocks and hardware loops stop there). Events are (cycle, sequence, function name, arguments) so that
+# they can be saved to checkpoints.
+events = []
+eventSequence = 0
+nextEventCycle = float('inf')
+
+def schedule(cycle, function, *args):
+    global eventSequence
+    global nextEventCycle
+    heapq.heappush(events, (cycle, eventSequence, function.__name__, args))
+    eventSequence += 1
+    nextEventCycle = events[0][0]
+
+def runEvents():
+    global nextEventCycle
+    # Events can change what idle loops are waiting for
+    idleStates.clear()
+    while events and events[0][0] <= cycleCount:
+        (cycle, _, function, args) = heapq.heappop(events)
+        globals()[function](cycle, *args)
+    nextEventCycle = events[0][0] if events else float('inf')
+
+def resetEvents():
+    global nextEventCycle
+    events.clear()
+    nextEventCycle = float('inf')
+
+# Interrupt controller
+# Channel n is enabled by bit n of INTEN (bit n-16 of INTEN2 for channels 16 and more), requested by the same bit
+# of INTRQ/INTRQ2, and cleared by writing it to INTCR/INTCR2. The requested and enabled channel with the
+# lowest number is taken, channels set in INTPR/INTPR2 first: the return address is pushed like Callff does,
+# and execution continues at its vector, until Reti.
+# FIXME Assumed: no global enable bit, no nesting, requests stay pending until cleared
+INTERRUPT_VECTORS = 0x000014
+INTERRUPT_CYCLES = 2
+interruptChannels = dict([
+    ('ADC', 0), ('T0', 1), ('P00', 2), ('T1', 3), ('P01', 4), ('T2', 5), ('P02', 6), ('DAC', 8), ('SPI', 9),
+    ('MSP', 10), ('I2S', 11), ('USB', 15), ('CIS', 16), ('RTC', 17), ('NF', 18), ('DMA_CIS_W', 19), ('DMA_NF_RW', 20),
+    ('SAR_ADC', 21), ('DMA_DEV_RW', 25),
+])
+# (enable, request, priority, clear) I/O addresses of channels 0-15, then 16-31
+interruptRegisters = [(0x20, 0x21, 0x22, 0x23), (0x32, 0x33, 0x34, 0x35)]
+inInterrupt = False
+interruptCheckScheduled = False
+
+def requestInterrupt(channel):
+    (_, request, _, _) = interruptRegisters[channel >> 4]
+    ioReg[request] |= 1 << (channel & 0xf)
+    scheduleInterruptCheck()
+
+def scheduleInterruptCheck():
+    global interruptCheckScheduled
+    if not interruptCheckScheduled:
+        interruptCheckScheduled = True
+        schedule(cycleCount, checkInterrupts)
+
+def checkInterrupts(cycle):
+    global interruptCheckScheduled
+    interruptCheckScheduled = False
+    if inInterrupt:
+        # Reti checks again
+        return
+    pending = 0
+    priority = 0
+    for (shift, (enable, request, high, _)) in zip([0, 16], interruptRegisters):
+        pending |= (ioReg[enable] & ioReg[request]) << shift
+        priority |= ioReg[high] << shift
+    if pending:
+        channels = (pending & priority) or pending
+        enterInterrupt((channels & -channels).bit_length() - 1)
+
+def enterInterrupt(channel):
+    global inInterrupt
+    global cycleCount
+    inInterrupt = True
+    retAddr = (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]
+    vector = INTERRUPT_VECTORS + 4 * channel
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Interrupt channel {bcolors.REGVAL}{channel}{bcolors.ENDC}{bcolors.EXECUTION} taken, vector {bcolors.REGVAL}{hex(vector, 6)}{bcolors.ENDC}{bcolors.EXECUTION}")
+    push(retAddr & 0xffff)
+    push((retAddr >> 16) & 0xff)
+    setPC(vector)
+    cycleCount += INTERRUPT_CYCLES
+    if profiler is not None:
+        profiler.enter(vector)
+
+def leaveInterrupt():
+    global inInterrupt
+    inInterrupt = False
+    scheduleInterruptCheck()
+
+def clearInterrupts(registers):
+    (_, request, _, clear) = registers
+    ioReg[request] &= ~ioReg[clear]
+    ioReg[clear] = 0x0000
+
+# Timers
+# FIXME Assumed behaviour: Tx bit 0 starts the timer, Tx bits [10:8] select the clock divider (2^(n+1)). The
+# counter counts up from TxCNT, and overflowing past 0xffff requests the timer interrupt and reloads TxCNT.
+# With bit x of EVENT set, timer x counts events (see timerEvent) instead of clock cycles.
+# (control, reload, counter value, interrupt channel, event count) I/O addresses of T0, T1 and T2
+timerRegisters = [(0x10, 0x45, 0x47, 1, 0x4d), (0x11, 0x46, 0x40, 3, 0x4e), (0x12, 0x4c, None, 5, 0x4f)]
+IO_EVENT = 0x3d
+# Counter value of each timer at timerStartCycles (None while stopped), reprogramming a timer cancels its
+# scheduled overflow by changing its generation
+timerStartValues = [0x0000] * 3
+timerStartCycles = [None] * 3
+timerGenerations = [0] * 3
+
+def timerDivider(timer):
+    return 2 << ((ioReg[timerRegisters[timer][0]] >> 8) & 0b111)
+
+def timerValue(timer):
+    if timerStartCycles[timer] is None:
+        return timerStartValues[timer]
+    return timerStartValues[timer] + (cycleCount - timerStartCycles[timer]) // timerDivider(timer)
+
+def startTimer(timer, cycle, value):
+    timerGenerations[timer] += 1
+    timerStartValues[timer] = value
+    if ioReg[timerRegisters[timer][0]] & 0x0001 and not ioReg[IO_EVENT] & (1 << timer):
+        timerStartCycles[timer] = cycle
+        schedule(cycle + (0x10000 - value) * timerDivider(timer), timerOverflow, timer, timerGenerations[timer])
+    else:
+        timerStartCycles[timer] = None
+
+def timerOverflow(cycle, timer, generation):
+    if generation != timerGenerations[timer]:
+        return
+    if traceLevel >= TRACE_FULL:
+        print_execution(f"Timer {bcolors.REGVAL}T{timer}{bcolors.ENDC}{bcolors.EXECUTION} overflow")
+    # Counting goes on from the reload value, at the exact cycle of the overflow
+    startTimer(timer, cycle, ioReg[timerRegisters[timer][1]])
+    requestInterrupt(timerRegisters[timer][3])
+
+def timerEvent(timer):
+    # External event on the EVENT pin of a timer
+    (control, reload, _, channel, count) = timerRegisters[timer]
+    ioReg[count] = (ioReg[count] + 1) & 0xffff
+    if ioReg[control] & 0x0001 and ioReg[IO_EVENT] & (1 << timer):
+        timerStartValues[timer] += 1
+        if timerStartValues[timer] > 0xffff:
+            timerStartValues[timer] = ioReg[reload]
+            requestInterrupt(channel)
+
+def timerWriteHook(timer):
+    def restartTimer():
+        startTimer(timer, cycleCount, ioReg[timerRegisters[timer][1]])
+    return restartTimer
+
+def timerReadHook(timer):
+    def readTimer():
+        ioReg[timerRegisters[timer][2]] = timerValue(timer) & 0xffff
+    return readTimer
+
+def restartTimers():
+    for timer in range(len(timerRegisters)):
+        startTimer(timer, cycleCount, ioReg[timerRegisters[timer][1]])
+
+# Audio
+# DAC output (DAOL/DAOR writes) can be captured to a WAV file, and ADC input (ADC_DATA/ADR reads) read from one.
+# Samples go through preallocated buffers of AUDIO_CHUNK frames, which are written to/read from the files in
+# one call. The FIFO status registers follow the samples the DAC has not played yet and the samples the ADC
+# converted but were not read yet, at the sample rate (in emulated time), and the DAC FIFO empty and ADC FIFO
+# full interrupts are requested when this happens. Audio files are not part of snapshots and checkpoints.
+# FIXME Assumed: 16-sample FIFOs, status bits [4:0] count the samples, bit8: full, bit9: empty (reset value),
+# sample rates are not derived from DAC_SET/ADC_SET, I2S output goes through DAOL/DAOR like the DAC
+IO_ADC_FIFOSTATUS = 0x26
+IO_ADC_DATA = 0x28
+IO_DAC_FIFOSTATUS = 0x4b
+IO_DAOL = 0x55
+IO_DAOR = 0x56
+IO_ADR = 0x7f
+AUDIO_FIFO_DEPTH = 16
+AUDIO_CHUNK = 0x10000
+AUDIO_SAMPLE_RATE = 16000
+FIFO_FULL = 0x0100
+FIFO_EMPTY = 0x0200
+dacOutput = None
+adcInput = None
+
+def fifoStatus(level):
+    return level | (FIFO_FULL if level >= AUDIO_FIFO_DEPTH else 0) | (FIFO_EMPTY if level == 0 else 0)
+
+def scheduleStatusChange(device):
+    # Idle loops polling a FIFO status register are skipped up to the event where its level changes
+    time = device.nextChange()
+    if time is None:
+        return
+    cycle = cyclesUntil(time)
+    if not cycleCount < device.statusCycle <= cycle:
+        device.statusCycle = cycle
+        schedule(cycle, fifoStatusChange)
+
+def fifoStatusChange(cycle):
+    # Nothing to do, the event only ends skipped idle loop iterations
+    pass
+
+def cyclesUntil(time):
+    # First cycle at or after an emulated time (at the current clock frequency)
+    return cycleCount + max(int((time - emulatedTime()) * clockFrequency) + 1, 1)
+
+class DACOutput:
+    """Samples written to DAOL (mono) or DAOL then DAOR (stereo), streamed to a 16-bit WAV file"""
+
+    def __init__(self, path, channels=1, sampleRate=AUDIO_SAMPLE_RATE):
+        self.wav = wave.open(path, 'wb')
+        self.wav.setnchannels(channels)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sampleRate)
+        self.channels = channels
+        self.sampleRate = sampleRate
+        self.samples = array('h', [0]) * (AUDIO_CHUNK * channels)
+        self.position = 0
+        self.left = 0
+        self.frames = 0
+        self.generation = 0
+        self.statusCycle = 0        # cycle of the last status change event
+        self.restart()
+
+    def restart(self):
+        self.level = 0              # samples in the FIFO at emulated time self.time
+        self.time = emulatedTime()
+
+    def nextChange(self):
+        # Time the next sample is played at, when the FIFO is not empty
+        if self.fifoLevel() == 0:
+            return None
+        return self.time + 1 / self.sampleRate
+
+    def fifoLevel(self):
+        now = emulatedTime()
+        played = int((now - self.time) * self.sampleRate)
+        if played >= self.level:
+            self.level = 0
+            self.time = now
+        elif played > 0:
+            self.level -= played
+            self.time += played / self.sampleRate
+        return self.level
+
+    def write(self, channel, value):
+        if channel == 0 and self.channels == 2:
+            self.left = value
+            return
+        level = self.fifoLevel()
+        if level >= AUDIO_FIFO_DEPTH:
+            # Overflow: the sample is dropped
+            print_error('DAC FIFO overflow')
+            return
+        if self.channels == 2:
+            self.samples[self.position] = signed16(self.left)
+            self.position += 1
+        self.samples[self.position] = signed16(value)
+        self.position += 1
+        if self.position == len(self.samples):
+            self.flush()
+        self.frames += 1
+        self.level = level + 1
+        # FIFO empty interrupt once the DAC played it all
+        self.generation += 1
+        schedule(cyclesUntil(self.time + self.level / self.sampleRate), dacFifoEmpty, self.generation)
+
+    def flush(self):
+        samples = self.samples[:self.position]
+        if sys.byteorder != 'little':
+            samples.byteswap()
+        self.wav.writeframesraw(samples.tobytes())
+        self.position = 0
+
+    def close(self):
+        self.flush()
+        self.wav.close()
+
+class ADCInput:
+    """Samples of a 16-bit WAV file (first channel), converted at its sample rate"""
+
+    def __init__(self, path):
+        self.wav = wave.open(path, 'rb')
+        if self.wav.getsampwidth() != 2:
+            raise ValueError('%s: only 16-bit WAV files are supported' % path)
+        self.channels = self.wav.getnchannels()
+        self.sampleRate = self.wav.getframerate()
+        self.samples = array('h')
+        self.previous = array('h')  # chunk before self.samples
+        self.first = 0              # index of the first frame of self.samples
+        self.consumed = 0           # frames read from the FIFO, or dropped
+        self.generation = 0
+        self.statusCycle = 0        # cycle of the last status change event
+        self.restart()
+
+    def restart(self):
+        self.startTime = emulatedTime() - self.consumed / self.sampleRate
+
+    def nextChange(self):
+        # Time the next sample is converted at, when the FIFO is not full
+        if self.fifoLevel() >= AUDIO_FIFO_DEPTH:
+            return None
+        return self.startTime + (self.converted() + 1) / self.sampleRate
+
+    def sample(self, index):
+        # Frames are read forward, one chunk at a time, and read as 0 after the end of the file. FIFO reads lag
+        # behind SAR ADC reads (readADR) by up to AUDIO_FIFO_DEPTH frames, which can be in the previous chunk.
+        while index >= self.first + len(self.samples):
+            data = self.wav.readframes(AUDIO_CHUNK)
+            if not data:
+                return 0x0000
+            self.first += len(self.samples)
+            self.previous = self.samples
+            self.samples = array('h', data)
+            if sys.byteorder != 'little':
+                self.samples.byteswap()
+            if self.channels > 1:
+                self.samples = self.samples[::self.channels]
+        if index >= self.first:
+            return self.samples[index - self.first] & 0xffff
+        if index >= self.first - len(self.previous):
+            return self.previous[index - self.first] & 0xffff
+        print_error('ADC frame %d was dropped from the input buffers' % index)
+        return 0x0000
+
+    def converted(self):
+        return max(int((emulatedTime() - self.startTime) * self.sampleRate), 0)
+
+    def fifoLevel(self):
+        level = self.converted() - self.consumed
+        if level > AUDIO_FIFO_DEPTH:
+            # Overrun: the oldest samples were dropped
+            self.consumed += level - AUDIO_FIFO_DEPTH
+            level = AUDIO_FIFO_DEPTH
+        return max(level, 0)
+
+    def read(self):
+        if self.fifoLevel() == 0:
+            # Underrun: the last sample is read again
+            return self.sample(max(self.consumed - 1, 0))
+        value = self.sample(self.consumed)
+        self.consumed += 1
+        self.scheduleFull()
+        return value
+
+    def scheduleFull(self):
+        # FIFO full interrupt once the ADC converted AUDIO_FIFO_DEPTH samples more than were read
+        self.generation += 1
+        schedule(cyclesUntil(self.startTime + (self.consumed + AUDIO_FIFO_DEPTH) / self.sampleRate), adcFifoFull, self.generation)
+
+    def close(self):
+        self.wav.close()
+
+def dacFifoEmpty(cycle, generation):
+    if dacOutput is not None and generation == dacOutput.generation:
+        requestInterrupt(interruptChannels['DAC'])
+
+def adcFifoFull(cycle, generation):
+    if adcInput is not None and generation == adcInput.generation:
+        requestInterrupt(interruptChannels['ADC'])
+
+def writeDAOL():
+    if dacOutput is not None:
+        dacOutput.write(0, ioReg[IO_DAOL])
+
+def writeDAOR():
+    if dacOutput is not None:
+        dacOutput.write(1, ioReg[IO_DAOR])
+
+def readDACStatus():
+    if dacOutput is not None:
+        ioReg[IO_DAC_FIFOSTATUS] = (ioReg[IO_DAC_FIFOSTATUS] & ~0x031f) | fifoStatus(dacOutput.fifoLevel())
+        scheduleStatusChange(dacOutput)
+
+def readADCStatus():
+    if adcInput is not None:
+        ioReg[IO_ADC_FIFOSTATUS] = (ioReg[IO_ADC_FIFOSTATUS] & ~0x031f) | fifoStatus(adcInput.fifoLevel())
+        scheduleStatusChange(adcInput)
+
+def readADCData():
+    if adcInput is not None:
+        ioReg[IO_ADC_DATA] = adcInput.read()
+
+def readADR():
+    # SAR ADC: the input level at the time of the read, without going through the FIFO
+    if adcInput is not None:
+        ioReg[IO_ADR] = adcInput.sample(adcInput.converted())
+
+# SPI flash
+# A NOR flash on the SPI bus, backed by an image file mapped in memory: programming and erasing write to the
+# mapping, which the OS writes back to the file, and reads are slices of it. The flash is accessed byte by
+# byte through the SPI master (SPICSC selects it, writing SPITRANSFER exchanges the bytes of SPIDADA0-5), or
+# by the flash controller at 0xf800, which runs a whole command between the flash and a WRAM buffer.
+# Commands are served when they are issued, the controller being busy (and then requesting the SPI interrupt)
+# for as long as the SPI transfer would take. The flash image is not part of snapshots and checkpoints.
+# FIXME Assumed: SPICSC bit0 selects the flash, SPITRANSFER holds the number of bytes to exchange (1-12),
+# SPIDADA words hold two bytes, the first one in their low byte. Controller registers: command (writing it
+# starts the command), flash address bits [15:0], bits [23:16], WRAM buffer address, length in words (2 bytes
+# each, the first one in the low byte), status (bit0: busy, bit1: write enable latch). 1 SPI bit per cycle,
+# programming and erasing take no time (WIP is never set). JEDEC ID: 0xef, 0x40, log2(size).
+IO_SPIDADA0 = 0x57
+IO_SPICSC = 0x5e
+IO_SPITRANSFER = 0x5f
+SPI_DATA_BYTES = 12
+SPI_FLASH_BASE = 0xf800
+SPI_FLASH_REGISTERS = 0x100
+FLASH_COMMAND = 0
+FLASH_ADDRESSL = 1
+FLASH_ADDRESSH = 2
+FLASH_BUFFER = 3
+FLASH_LENGTH = 4
+FLASH_STATUS = 5
+FLASH_BUSY = 0x01
+FLASH_WEL = 0x02
+FLASH_CYCLES_PER_BYTE = 8
+FLASH_PAGE_SIZE = 0x100
+FLASH_READ = 0x03
+FLASH_FAST_READ = 0x0b
+FLASH_PAGE_PROGRAM = 0x02
+FLASH_WRITE_ENABLE = 0x06
+FLASH_WRITE_DISABLE = 0x04
+FLASH_READ_STATUS = 0x05
+FLASH_READ_ID = 0x9f
+flashHeaderBytes = dict([(FLASH_READ, 4), (FLASH_FAST_READ, 5), (FLASH_PAGE_PROGRAM, 4), (0x20, 4), (0x52, 4), (0xd8, 4)])
+flashEraseSizes = dict([(0x20, 0x1000), (0x52, 0x8000), (0xd8, 0x10000), (0xc7, None), (0x60, None)])
+spiFlash = None
+spiFlashRegisters = [0x0000] * SPI_FLASH_REGISTERS
+spiFlashDoneCycle = 0
+
+class SPIFlash:
+    """NOR flash serving the commands of the SPI bus from an image file"""
+
+    def __init__(self, path):
+        self.file = open(path, 'r+b')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size == 0:
+            self.file.close()
+            raise ValueError('%s: empty flash image' % path)
+        self.image = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE)
+        self.status = 0x00
+        self.transaction = None     # bytes exchanged since the flash was selected
+
+    def read(self, address, count):
+        """count bytes from address, wrapping around at the end of the flash"""
+        address %= self.size
+        if address + count <= self.size:
+            return self.image[address:address + count]
+        data = bytearray(self.image[address:])
+        while len(data) < count:
+            data += self.image[:min(count - len(data), self.size)]
+        return bytes(data)
+
+    def program(self, address, data):
+        # Bytes past the end of the page wrap around to its start, and programming only clears bits
+        data = data[-FLASH_PAGE_SIZE:]
+        page = (address % self.size) & ~(FLASH_PAGE_SIZE - 1)
+        offset = address & (FLASH_PAGE_SIZE - 1)
+        for (start, chunk) in [(page + offset, data[:FLASH_PAGE_SIZE - offset]), (page, data[FLASH_PAGE_SIZE - offset:])]:
+            end = min(start + len(chunk), self.size)
+            if end > start:
+                programmed = int.from_bytes(self.image[start:end], 'little') & int.from_bytes(chunk[:end - start], 'little')
+                self.image[start:end] = programmed.to_bytes(end - start, 'little')
+
+    def erase(self, address, size):
+        start = (address % self.size) & ~(size - 1) if size is not None else 0
+        end = min(start + size, self.size) if size is not None else self.size
+        self.image[start:end] = b'\xff' * (end - start)
+
+    def command(self, opcode, address=0, data=b''):
+        """Run a command changing the flash (the others only answer while the flash is selected)"""
+        if opcode == FLASH_WRITE_ENABLE:
+            self.status |= FLASH_WEL
+        elif opcode == FLASH_WRITE_DISABLE:
+            self.status &= ~FLASH_WEL
+        elif opcode == FLASH_PAGE_PROGRAM or opcode in flashEraseSizes:
+            if not self.status & FLASH_WEL:
+                print_error('SPI flash command %s ignored: writes are not enabled' % hex(opcode, 2))
+                return
+            if opcode == FLASH_PAGE_PROGRAM:
+                self.program(address, data)
+            else:
+                self.erase(address, flashEraseSizes[opcode])
+            self.status &= ~FLASH_WEL
+
+    def identification(self):
+        return bytes([0xef, 0x40, self.size.bit_length() - 1])
+
+    def select(self):
+        self.transaction = bytearray()
+
+    def exchange(self, data):
+        """Bytes sent back by the flash while receiving data"""
+        if self.transaction is None:
+            return bytes([0xff] * len(data))
+        start = len(self.transaction)
+        self.transaction += data
+        opcode = self.transaction[0]
+        header = flashHeaderBytes.get(opcode, 1)
+        response = bytearray(len(data))
+        first = max(start, header)
+        count = len(self.transaction) - first
+        if count > 0:
+            if opcode in [FLASH_READ, FLASH_FAST_READ]:
+                response[first - start:] = self.read(self.address() + first - header, count)
+            elif opcode == FLASH_READ_STATUS:
+                response[first - start:] = bytes([self.status]) * count
+            elif opcode == FLASH_READ_ID:
+                response[first - start:] = (self.identification()[first - header:] + bytes(count))[:count]
+        return bytes(response)
+
+    def address(self):
+        return int.from_bytes(self.transaction[1:4], 'big')
+
+    def deselect(self):
+        if self.transaction:
+            opcode = self.transaction[0]
+            if len(self.transaction) >= flashHeaderBytes.get(opcode, 1):
+                self.command(opcode, self.address(), bytes(self.transaction[4:]))
+        self.transaction = None
+
+    def close(self):
+        self.image.flush()
+        self.image.close()
+        self.file.close()
+
+def writeSPICSC():
+    if spiFlash is not None:
+        if ioReg[IO_SPICSC] & 0x0001:
+            if spiFlash.transaction is None:
+                spiFlash.select()
+        else:
+            spiFlash.deselect()
+
+def writeSPITransfer():
+    count = min(ioReg[IO_SPITRANSFER] & 0xf, SPI_DATA_BYTES)
+    data = array('H', ioReg[IO_SPIDADA0:IO_SPIDADA0 + SPI_DATA_BYTES // 2])
+    if sys.byteorder != 'little':
+        data.byteswap()
+    if spiFlash is not None:
+        response = spiFlash.exchange(data.tobytes()[:count])
+    else:
+        response = bytes([0xff] * count)
+    data = array('H', (response + bytes(SPI_DATA_BYTES))[:SPI_DATA_BYTES])
+    if sys.byteorder != 'little':
+        data.byteswap()
+    ioReg[IO_SPIDADA0:IO_SPIDADA0 + SPI_DATA_BYTES // 2] = data
+    requestInterrupt(interruptChannels['SPI'])
+
+def readSPIFlashRegister(address):
+    if address - SPI_FLASH_BASE == FLASH_STATUS:
+        status = spiFlash.status & FLASH_WEL if spiFlash is not None else 0x0000
+        return status | (FLASH_BUSY if cycleCount < spiFlashDoneCycle else 0)
+    return spiFlashRegisters[address - SPI_FLASH_BASE]
+
+def writeSPIFlashRegister(address, value):
+    spiFlashRegisters[address - SPI_FLASH_BASE] = value
+    if address - SPI_FLASH_BASE == FLASH_COMMAND:
+        runFlashCommand(value & 0xff)
+
+def runFlashCommand(opcode):
+    global spiFlashDoneCycle
+    if spiFlash is None:
+        print_error('No SPI flash image (SPI flash command %s)' % hex(opcode, 2))
+        return
+    address = ((spiFlashRegisters[FLASH_ADDRESSH] & 0xff) << 16) | spiFlashRegisters[FLASH_ADDRESSL]
+    buffer = spiFlashRegisters[FLASH_BUFFER]
+    length = spiFlashRegisters[FLASH_LENGTH]
+    header = flashHeaderBytes.get(opcode, 1)
+    if opcode in [FLASH_READ, FLASH_FAST_READ]:
+        words = array('H', spiFlash.read(address, length * 2))
+        if sys.byteorder != 'little':
+            words.byteswap()
+        writeDataWords(buffer, words)
+    elif opcode == FLASH_PAGE_PROGRAM:
+        words = dataWords(buffer, 1, length)
+        if words is None:
+            words = array('H', [readData(buffer + offset) for offset in range(length)])
+        if sys.byteorder != 'little':
+            words.byteswap()
+        spiFlash.command(opcode, address, words.tobytes())
+    else:
+        length = 0
+        spiFlash.command(opcode, address)
+    if traceLevel >= TRACE_FULL:
+        print_execution('SPI flash command %s at %s (%d words at %s)' % (hex(opcode, 2), hex(address, 6), length, hex(buffer, 4)))
+    spiFlashDoneCycle = cycleCount + (header + length * 2) * FLASH_CYCLES_PER_BYTE
+    schedule(spiFlashDoneCycle, spiFlashDone)
+
+def spiFlashDone(cycle):
+    # Only the last command issued is done
+    if cycle == spiFlashDoneCycle:
+        requestInterrupt(interruptChannels['SPI'])
+
+def resetSPIFlash():
+    global spiFlashDoneCycle
+    spiFlashRegisters[:] = [0x0000] * SPI_FLASH_REGISTERS
+    spiFlashDoneCycle = 0
+    if spiFlash is not None:
+        spiFlash.deselect()
+        spiFlash.status = 0x00
+
+# DMA
+# Two DMA channels copy words between data memory, program memory, the SPI flash and I/O registers: the
+# "DMA Schedule" channel at 0xf100 and DMA1 at 0xfe27. Starting a channel schedules the whole transfer as
+# one event at the cycle it completes, which copies the words as slices of the memory pages (I/O registers,
+# which can be device FIFOs, are accessed once per word), sets the done flag and requests the interrupt.
+# FIXME Assumed register layout of both channels: source address bits [15:0], destination address bits
+# [15:0], length in words, mode (bits [1:0]: source, bits [3:2]: destination, see DMA_DATA...), high address
+# bits (bits [7:0]: source bits [23:16], bits [15:8]: destination bits [23:16]), control (writing bit0 starts
+# the transfer, bit0 reads as busy, bit1 as done). The SPI flash is addressed in bytes, I/O registers are not
+# incremented. Transfers take 1 cycle per word, plus the SPI transfer of flash words. Both channels request
+# the DMA_DEV_RW interrupt.
+DMA_DATA = 0
+DMA_PROGRAM = 1
+DMA_FLASH = 2
+DMA_IO = 3
+DMA_SOURCE = 0
+DMA_DESTINATION = 1
+DMA_LENGTH = 2
+DMA_MODE = 3
+DMA_ADDRESSH = 4
+DMA_CONTROL = 5
+DMA_START = 0x0001
+DMA_BUSY = 0x0001
+DMA_DONE = 0x0002
+DMA_CYCLES_PER_WORD = 1
+dmaChannels = [(0xf100, 0x100), (0xfe27, 6)]   # (first address, number of registers)
+dmaRegisters = [[0x0000] * registers for (_, registers) in dmaChannels]
+dmaDoneCycles = [0, 0]
+
+def dmaRegisterHooks(channel):
+    (base, _) = dmaChannels[channel]
+
+    def readDMA(address):
+        if address - base == DMA_CONTROL:
+            busy = DMA_BUSY if cycleCount < dmaDoneCycles[channel] else 0x0000
+            return (dmaRegisters[channel][DMA_CONTROL] & ~DMA_BUSY) | busy
+        return dmaRegisters[channel][address - base]
+
+    def writeDMA(address, value):
+        if address - base == DMA_CONTROL:
+            dmaRegisters[channel][DMA_CONTROL] = value & ~(DMA_BUSY | DMA_DONE)
+            if value & DMA_START:
+                startDMA(channel)
+        else:
+            dmaRegisters[channel][address - base] = value
+    return (readDMA, writeDMA)
+
+def startDMA(channel):
+    registers = dmaRegisters[channel]
+    source = ((registers[DMA_ADDRESSH] & 0xff) << 16) | registers[DMA_SOURCE]
+    destination = ((registers[DMA_ADDRESSH] >> 8) << 16) | registers[DMA_DESTINATION]
+    length = registers[DMA_LENGTH]
+    mode = registers[DMA_MODE]
+    cycles = length * DMA_CYCLES_PER_WORD
+    if DMA_FLASH in [mode & 0b11, (mode >> 2) & 0b11]:
+        cycles += length * 2 * FLASH_CYCLES_PER_BYTE
+    dmaDoneCycles[channel] = cycleCount + cycles
+    if traceLevel >= TRACE_FULL:
+        print_execution('DMA channel %d: %d words from %s to %s (mode %s)' % (channel, length, hex(source, 6), hex(destination, 6), hex(mode, 2)))
+    # The transfer is done (and its words copied) when the event runs
+    schedule(dmaDoneCycles[channel], dmaTransfer, channel, source, destination, length, mode)
+
+def dmaRead(space, address, count):
+    if space == DMA_DATA:
+        words = dataWords(address, 1, count)
+        return words if words is not None else array('H', [readData(address + offset) for offset in range(count)])
+    if space == DMA_PROGRAM:
+        return programWords(address, count)
+    if space == DMA_FLASH:
+        if spiFlash is None:
+            print_error('DMA from the SPI flash without a flash image')
+            return array('H', [0xffff] * count)
+        words = array('H', spiFlash.read(address, count * 2))
+        if sys.byteorder != 'little':
+            words.byteswap()
+        return words
+    io = address & 0x7f
+    words = array('H', [0x0000] * count)
+    for offset in range(count):
+        if ioReadHooks[io] is not None:
+            ioReadHooks[io]()
+        words[offset] = ioReg[io]
+    return words
+
+def dmaWrite(space, address, words):
+    if space == DMA_DATA:
+        writeDataWords(address, words)
+    elif space == DMA_PROGRAM:
+        writeProgramWords(address, words)
+    elif space == DMA_FLASH:
+        if spiFlash is None:
+            print_error('DMA to the SPI flash without a flash image')
+            return
+        words = array('H', words)
+        if sys.byteorder != 'little':
+            words.byteswap()
+        spiFlash.command(FLASH_PAGE_PROGRAM, address, words.tobytes())
+    else:
+        io = address & 0x7f
+        for word in words:
+            ioReg[io] = word
+            if ioWriteHooks[io] is not None:
+                ioWriteHooks[io]()
+
+def dmaTransfer(cycle, channel, source, destination, length, mode):
+    if length > 0:
+        dmaWrite((mode >> 2) & 0b11, destination, dmaRead(mode & 0b11, source, length))
+    # Only the last transfer started on the channel is done
+    if cycle == dmaDoneCycles[channel]:
+        dmaRegisters[channel][DMA_CONTROL] |= DMA_DONE
+        requestInterrupt(interruptChannels['DMA_DEV_RW'])
+
+def resetDMA():
+    for channel in range(len(dmaChannels)):
+        dmaRegisters[channel][:] = [0x0000] * len(dmaRegisters[channel])
+        dmaDoneCycles[channel] = 0
+
+def restartAudio():
+    if dacOutput is not None:
+        dacOutput.restart()
+    if adcInput is not None:
+        adcInput.restart()
+        adcInput.scheduleFull()
+
+def resetDevices():
+    global inInterrupt
+    global interruptCheckScheduled
+    resetEvents()
+    resetPLL()
+    inInterrupt = False
+    interruptCheckScheduled = False
+    restartTimers()
+    restartAudio()
+    resetSPIFlash()
+    resetDMA()
+
+def installIOHooks():
+    # Devices reacting to I/O register accesses, and memory mapped devices
+    ioReadHooks[IO_SSF] = readSSF
+    ioWriteHooks[IO_SSF] = writeSSF
+    ioWriteHooks[IO_SYSCONF] = mapSharedPRAM
+    for address in range(PLL_BASE, PLL_BASE + PLL_REGISTERS):
+        mmioReadHooks[address] = readPLL
+        mmioWriteHooks[address] = writePLL
+    for registers in interruptRegisters:
+        for io in registers[:3]:
+            ioWriteHooks[io] = scheduleInterruptCheck
+        ioWriteHooks[registers[3]] = lambda registers=registers: clearInterrupts(registers)
+    for timer, (control, reload, value, _, _) in enumerate(timerRegisters):
+        ioWriteHooks[control] = timerWriteHook(timer)
+        ioWriteHooks[reload] = timerWriteHook(timer)
+        if value is not None:
+            ioReadHooks[value] = timerReadHook(timer)
+    ioWriteHooks[IO_EVENT] = restartTimers
+    ioWriteHooks[IO_DAOL] = writeDAOL
+    ioWriteHooks[IO_DAOR] = writeDAOR
+    ioReadHooks[IO_DAC_FIFOSTATUS] = readDACStatus
+    ioReadHooks[IO_ADC_FIFOSTATUS] = readADCStatus
+    ioReadHooks[IO_ADC_DATA] = readADCData
+    ioReadHooks[IO_ADR] = readADR
+    ioWriteHooks[IO_SPICSC] = writeSPICSC
+    ioWriteHooks[IO_SPITRANSFER] = writeSPITransfer
+    for address in range(SPI_FLASH_BASE, SPI_FLASH_BASE + SPI_FLASH_REGISTERS):
+        mmioReadHooks[address] = readSPIFlashRegister
+        mmioWriteHooks[address] = writeSPIFlashRegister
+    for channel, (base, registers) in enumerate(dmaChannels):
+        (readDMA, writeDMA) = dmaRegisterHooks(channel)
+        for address in range(base, base + registers):
+            mmioReadHooks[address] = readDMA
+            mmioWriteHooks[address] = writeDMA
+
+
+# Binary traces
+# Every retired instruction is recorded as little-endian (kind, index, value, address) records: one
+# TRACE_INSTRUCTION record (opcode, PC) followed by one record per internal register, I/O register and data
+# word it changed. PC changes are implied by the next TRACE_INSTRUCTION record. Records are queued in chunks
+# to a thread writing the file, so that the emulator only waits when the writer is behind.
+TRACE_MAGIC = b'S9KETRC1'
+TRACE_RECORD = struct.Struct('<BBHI')
+TRACE_INSTRUCTION = 0
+TRACE_REGISTER = 1      # index: internal register
+TRACE_IO = 2            # index: I/O address
+TRACE_DATA = 3          # address: data address
+TRACE_CHUNK_SIZE = 0x40000
+TRACE_QUEUE_LENGTH = 32
+traceWriter = None
+
+class TraceWriter:
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=TRACE_CHUNK_SIZE * 4)
+        self.file.write(TRACE_MAGIC)
+        self.buffer = bytearray()
+        self.writes = []            # (address, value) of data words written by the current instruction
+        self.chunks = queue.Queue(TRACE_QUEUE_LENGTH)
+        self.thread = threading.Thread(target=self.writeChunks, daemon=True)
+        self.thread.start()
+
+    def writeChunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            self.file.write(chunk)
+        self.file.close()
+
+    def flush(self):
+        self.chunks.put(bytes(self.buffer))
+        self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.chunks.put(None)
+        self.thread.join()
+
+def traceInstruction(PC, internalBefore, ioBefore):
+    # Flags are part of the traced state, whether they are evaluated lazily or not
+    if pendingFlags is not None:
+        materializeFlags()
+    buffer = traceWriter.buffer
+    buffer += TRACE_RECORD.pack(TRACE_INSTRUCTION, 0, getOpCode(PC), PC)
+    if internal != internalBefore:
+        for index in range(len(internal)):
+            if internal[index] != internalBefore[index]:
+                buffer += TRACE_RECORD.pack(TRACE_REGISTER, index, internal[index], 0)
+    if ioReg != ioBefore:
+        for io in range(len(ioReg)):
+            if ioReg[io] != ioBefore[io] and io != IO_PCH and io != IO_PCL:
+                buffer += TRACE_RECORD.pack(TRACE_IO, io, ioReg[io], 0)
+    for (address, value) in traceWriter.writes:
+        buffer += TRACE_RECORD.pack(TRACE_DATA, 0, value, address)
+    traceWriter.writes.clear()
+    if len(buffer) >= TRACE_CHUNK_SIZE:
+        traceWriter.flush()
+
+
+# Profiler
+# Counts executions and cycles per PC, and rebuilds the dynamic call graph: Call/Callff enter a routine, Ret,
+# Reti and Retff leave it. Cycles are accumulated per call stack (tuple of routine entry addresses, the first
+# one being where profiling started), from which inclusive and exclusive costs per routine are derived.
+callHandlers = [executeCall, executeCallff]
+returnHandlers = [executeRet, executeRetff, executeReti]
+profiler = None
+
+class Profiler:
+    def __init__(self, PC):
+        self.executions = dict()    # PC -> executions
+        self.cycles = dict()        # PC -> cycles
+        self.calls = dict()         # routine -> calls
+        self.stackCycles = dict()   # call stack -> cycles spent in its last routine
+        self.stack = (PC,)
+
+    def count(self, PC, instruction, cost):
+        self.executions[PC] = self.executions.get(PC, 0) + 1
+        self.cycles[PC] = self.cycles.get(PC, 0) + cost
+        self.stackCycles[self.stack] = self.stackCycles.get(self.stack, 0) + cost
+        if instruction.handler in callHandlers:
+            self.enter((ioReg[IO_PCH] << 16) | ioReg[IO_PCL])
+        elif instruction.handler in returnHandlers:
+            self.leave()
+
+    def enter(self, routine):
+        self.calls[routine] = self.calls.get(routine, 0) + 1
+        self.stack = self.stack + (routine,)
+
+    def leave(self):
+        # Returning from where profiling started (or from a routine entered with Jmp) keeps the first routine
+        if len(self.stack) > 1:
+            self.stack = self.stack[:-1]
+
+    def routines(self):
+        """routine -> (calls, exclusive cycles, inclusive cycles)"""
+        exclusive = dict()
+        inclusive = dict()
+        for stack, cycles in self.stackCycles.items():
+            exclusive[stack[-1]] = exclusive.get(stack[-1], 0) + cycles
+            # Recursive routines only count once per stack
+            for routine in set(stack):
+                inclusive[routine] = inclusive.get(routine, 0) + cycles
+        return dict([(routine, (self.calls.get(routine, 0), exclusive.get(routine, 0), inclusive[routine])) for routine in inclusive])
+
+    def report(self, count=None):
+        """Text tables of the routines (by inclusive cycles) and instructions (by cycles) costing the most"""
+        total = max(sum(self.cycles.values()), 1)
+        lines = ['Routine\t\tCalls\tExclusive cycles\t\tInclusive cycles']
+        routines = sorted(self.routines().items(), key=lambda item: item[1][2], reverse=True)
+        for routine, (calls, exclusive, inclusive) in routines[:count]:
+            lines.append('%s\t%d\t%d\t%6.2f%%\t\t%d\t%6.2f%%' % (hex(routine, 6), calls, exclusive, 100 * exclusive / total, inclusive, 100 * inclusive / total))
+        lines.append('')
+        lines.append('PC\t\tExecutions\tCycles')
+        for PC in sorted(self.cycles, key=self.cycles.get, reverse=True)[:count]:
+            lines.append('%s\t%d\t\t%d\t%6.2f%%' % (hex(PC, 6), self.executions[PC], self.cycles[PC], 100 * self.cycles[PC] / total))
+        return '\n'.join(lines) + '\n'
+
+    def collapsed(self):
+        """Collapsed stacks ("routine;routine;... cycles" lines), for flamegraph.pl and compatible tools"""
+        return ''.join('%s %d\n' % (';'.join(hex(routine, 6) for routine in stack), cycles) for stack, cycles in sorted(self.stackCycles.items()))
+
+
+# Machines
+# The state of the emulated machine lives in module globals, which handlers and translated code access
+# directly. An Emulator owns its own set of these globals and installs it (activate) before using them:
+# several machines can live in the same process, one of them being active at a time.
+
+# Machine globals saved by snapshots and checkpoints, besides registers and memory
+snapshotGlobals = ['pendingFlags', 'instructionCount', 'cycleCount', 'pllRegisters', 'clockFrequency', 'clockStartTime', 'clockStartCycle',
+    'events', 'eventSequence', 'nextEventCycle', 'inInterrupt', 'interruptCheckScheduled', 'timerStartValues', 'timerStartCycles', 'timerGenerations',
+    'loopCounters', 'loopStarts', 'loopStack', 'spiFlashRegisters', 'spiFlashDoneCycle',
+    'dmaRegisters', 'dmaDoneCycles']
+
+# Checkpoint files: magic, header length, marshalled header (machine state and list of RAM pages), then the
+# words of every RAM page written since reset, little-endian. The header is padded to a multiple of the host
+# page size, so that the RAM pages can be mapped from the file as they are.
+CHECKPOINT_MAGIC = b'S9KECKPT'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_ALIGNMENT = mmap.ALLOCATIONGRANULARITY
+
+class Emulator:
+    active = None
+
+    def __init__(self, chipName='SNC7001A'):
+        self.state = dict([
+            ('internal', array('H', [0x0000] * 8)),
+            ('ioReg', array('H', [0x0000] * 0x80)),
+            ('ioReadHooks', [None] * 0x80),
+            ('ioWriteHooks', [None] * 0x80),
+            ('pendingFlags', None),
+            ('CS1ROM', array('H')),
+            ('chip', chipProfiles[chipName]),
+            ('programPages', [unmappedProgram] * PAGE_COUNT),
+            ('dataPages', [unmappedData] * PAGE_COUNT),
+            ('mmioReadHooks', dict()),
+            ('mmioWriteHooks', dict()),
+            ('blockCache', dict()),
+            ('blockEnds', dict()),
+            ('codeWords', dict()),
+            ('macLoops', dict()),
+            ('idleStates', dict()),
+            ('blockInterrupted', False),
+            ('breakpoints', dict()),
+            ('watchpoints', dict()),
+            ('watchPages', []),
+            ('watchedIOHooks', dict()),
+            ('stopReason', None),
+            ('instructionCount', 0),
+            ('cycleCount', 0),
+            ('events', []),
+            ('eventSequence', 0),
+            ('nextEventCycle', float('inf')),
+            ('inInterrupt', False),
+            ('interruptCheckScheduled', False),
+            ('timerStartValues', [0x0000] * 3),
+            ('timerStartCycles', [None] * 3),
+            ('timerGenerations', [0] * 3),
+            ('loopCounters', [0, 0]),
+            ('loopStarts', [0x000000, 0x000000]),
+            ('loopStack', []),
+            ('pllRegisters', [0x0000] * PLL_REGISTERS),
+            ('clockFrequency', PLL_REFERENCE),
+            ('clockStartTime', 0.0),
+            ('clockStartCycle', 0),
+            ('instructionLimit', 0),
+            ('aotRoutines', dict()),
+            ('aotRoutineBlocks', dict()),
+            ('aotBlockEnds', dict()),
+            ('aotEntries', dict()),
+            ('traceWriter', None),
+            ('dacOutput', None),
+            ('adcInput', None),
+            ('spiFlash', None),
+            ('spiFlashRegisters', [0x0000] * SPI_FLASH_REGISTERS),
+            ('spiFlashDoneCycle', 0),
+            ('dmaRegisters', [[0x0000] * registers for (_, registers) in dmaChannels]),
+            ('dmaDoneCycles', [0, 0]),
+            ('profiler', None),
+        ])
+        self.romPath = None
+        self.activate()
+        installIOHooks()
+        self.reset()
+
+    def activate(self):
+        if Emulator.active is self:
+            return
+        if Emulator.active is not None:
+            # Scalars (and containers replaced since) are saved back into the machine being deactivated
+            machine = Emulator.active.state
+            for name in machine:
+                machine[name] = globals()[name]
+        globals().update(self.state)
+        Emulator.active = self
+
+    def load_rom(self, path, aot=False):
+        global CS1ROM
+        self.activate()
+        CS1ROM = loadROM(path)
+        self.romPath = path
+        if traceLevel >= TRACE_FULL:
+            print_execution('Loaded %d words into CS1ROM.' % len(CS1ROM))
+        for cache in [blockCache, blockEnds, codeWords, aotRoutines, aotRoutineBlocks, aotBlockEnds, aotEntries]:
+            cache.clear()
+        # First 32KW of the ROM are loaded into Program RAM
+        self.reset()
+        if traceLevel >= TRACE_FULL:
+            print_execution('Loaded %d words into PRAM.' % chip['pram'])
+        if aot:
+            # Compiled routines are part of the machine: other machines may run another ROM
+            self.state.update(loadAOT(path))
+
+    def reset(self):
+        global pendingFlags
+        global blockInterrupted
+        global instructionCount
+        global cycleCount
+        global clockStartTime
+        global clockStartCycle
+        self.activate()
+        removeWatchPages()
+        # Code cached from Program RAM written since the ROM was loaded is gone
+        for address in list(codeWords):
+            page = programPages[address >> PAGE_BITS]
+            if type(page) is RAMPage and page.written:
+                invalidateCode(address)
+        for index in range(len(internal)):
+            internal[index] = 0x0000
+        # Devices are restarted at cycle 0
+        instructionCount = 0
+        cycleCount = 0
+        clockStartTime = 0.0
+        clockStartCycle = 0
+        resetIORegisters()
+        resetDevices()
+        resetLoops()
+        pendingFlags = None
+        blockInterrupted = False
+        # Start executing at 0x000000 (Default PC value)
+        mapMemory(chip)
+
+    def snapshot(self):
+        """Capture the machine state. RAM pages are not copied: they become copy-on-write, so that the ones
+        written afterwards are the only ones restore() has to put back."""
+        self.activate()
+        removeWatchPages()
+        pages = dict()
+        for index, page in list(enumerate(programPages)) + [(None, page) for page in dataPages]:
+            if type(page) is RAMPage and page not in pages:
+                page.owned = False
+                pages[page] = (page.words, page.programBase, index << PAGE_BITS if index is not None else None)
+        snapshot = dict([
+            ('internal', array('H', internal)),
+            ('ioReg', array('H', ioReg)),
+            ('programPages', list(programPages)),
+            ('dataPages', list(dataPages)),
+            ('pages', pages),
+            ('globals', copy.deepcopy(dict([(name, globals()[name]) for name in snapshotGlobals]))),
+        ])
+        installWatchpoints()
+        return snapshot
+
+    def restore(self, snapshot):
+        """Go back to the state captured by snapshot() (which can be restored again later)"""
+        global blockInterrupted
+        self.activate()
+        removeWatchPages()
+        internal[:] = snapshot['internal']
+        ioReg[:] = snapshot['ioReg']
+        programPages[:] = snapshot['programPages']
+        dataPages[:] = snapshot['dataPages']
+        for page, (words, programBase, codeBase) in snapshot['pages'].items():
+            if page.words is not words:
+                # Written since the snapshot: code cached from it is gone too
+                for base in set([page.programBase, codeBase]) - set([None]):
+                    invalidateProgramPage(base)
+                page.words = words
+            page.owned = False
+            page.programBase = programBase
+        globals().update(copy.deepcopy(snapshot['globals']))
+        installWatchpoints()
+        blockInterrupted = False
+
+    def save_checkpoint(self, path):
+        """Write the machine state to a checkpoint file, which load_checkpoint() can start from later"""
+        self.activate()
+        removeWatchPages()
+        regions = []
+        ramPages = []
+        for (space, pages) in [('data', dataPages), ('program', programPages)]:
+            for index, page in enumerate(pages):
+                # Pages never written are recreated from the ROM (or zeroes) when loading
+                if type(page) is RAMPage and page.written and page not in ramPages:
+                    regions.append((space, index))
+                    ramPages.append(page)
+        installWatchpoints()
+        header = marshal.dumps(dict([
+            ('version', CHECKPOINT_VERSION),
+            ('rom', romHash(self.romPath)),
+            ('chip', chipName()),
+            ('internal', internal.tolist()),
+            ('ioReg', ioReg.tolist()),
+            ('globals', dict([(name, globals()[name]) for name in snapshotGlobals])),
+            ('regions', regions),
+        ]))
+        start = len(CHECKPOINT_MAGIC) + 4 + len(header)
+        start += -start % CHECKPOINT_ALIGNMENT
+        with open(path + '.%d.tmp' % os.getpid(), 'wb') as f:
+            f.write(CHECKPOINT_MAGIC + struct.pack('<I', len(header)) + header)
+            f.write(bytes(start - f.tell()))
+            for page in ramPages:
+                words = array('H', page.words)
+                if sys.byteorder != 'little':
+                    words.byteswap()
+                f.write(words.tobytes())
+        os.replace(path + '.%d.tmp' % os.getpid(), path)
+        if traceLevel >= TRACE_FULL:
+            print_execution('Saved checkpoint to %s (%d pages of RAM).' % (path, len(ramPages)))
+
+    def load_checkpoint(self, path):
+        """Restore the machine state from a checkpoint file, saved from the same ROM (already loaded) and chip.
+        RAM pages are mapped copy-on-write from the file, not read."""
+        self.activate()
+        with open(path, 'rb') as f:
+            if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+                raise ValueError('%s is not a checkpoint file' % path)
+            (length,) = struct.unpack('<I', f.read(4))
+            header = marshal.loads(f.read(length))
+            if header['version'] != CHECKPOINT_VERSION:
+                raise ValueError('Unsupported checkpoint version %d' % header['version'])
+            if header['rom'] != romHash(self.romPath):
+                raise ValueError('Checkpoint %s was not saved from ROM %s' % (path, self.romPath))
+            if header['chip'] != chipName():
+                # Compiled routines and the memory layout belong to the chip of the machine
+                raise ValueError('Checkpoint %s was saved on chip %s, not %s' % (path, header['chip'], chipName()))
+            start = len(CHECKPOINT_MAGIC) + 4 + length
+            start += -start % CHECKPOINT_ALIGNMENT
+            if header['regions']:
+                words = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))[start:].cast('H')
+                if sys.byteorder != 'little':
+                    # Checkpoint words are little-endian: big-endian hosts need a swapped copy
+                    words = array('H', words.tobytes())
+                    words.byteswap()
+        self.reset()
+        internal[:] = array('H', header['internal'])
+        ioReg[:] = array('H', header['ioReg'])
+        globals().update(header['globals'])
+        # Program RAM shared with the WRAM depends on SYSCONF
+        mapMemory(chip)
+        removeWatchPages()
+        for index, (space, page) in enumerate(header['regions']):
+            ramPage = (dataPages if space == 'data' else programPages)[page]
+            if space == 'program':
+                invalidateProgramPage(page << PAGE_BITS)
+            elif ramPage.programBase is not None:
+                invalidateProgramPage(ramPage.programBase)
+            # The mapping is private: writes can go straight to it
+            ramPage.words = words[index * PAGE_SIZE:(index + 1) * PAGE_SIZE]
+            ramPage.owned = True
+            ramPage.written = True
+        installWatchpoints()
+        if traceLevel >= TRACE_FULL:
+            print_execution('Loaded checkpoint from %s (%d pages of RAM), PC=%s' % (path, len(header['regions']), hex(self.pc, 6)))
+
+    def fork(self):
+        """os.fork() the process: the child goes on with a copy-on-write copy of the machine.
+        Returns 0 in the child, the pid of the child in the parent."""
+        sys.stdout.flush()
+        return os.fork()
+
+    def step(self):
+        """Interpret a single instruction, returns the new PC"""
+        global instructionCount
+        global cycleCount
+        self.activate()
+        if cycleCount >= nextEventCycle:
+            runEvents()
+        PC = (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]
+        # Decode (once per opcode value) and execute
+        instruction = decodeAt(PC)
+        if traceWriter is not None:
+            internalBefore = array('H', internal)
+            ioBefore = array('H', ioReg)
+        instruction.handler(PC, *instruction.args)
+        if not instruction.flow:
+            incrementPC()
+        instructionCount += 1
+        cost = instructionCost(PC, instruction)
+        cycleCount += cost
+        if profiler is not None:
+            profiler.count(PC, instruction, cost)
+        if traceWriter is not None:
+            traceInstruction(PC, internalBefore, ioBefore)
+        return (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]
+
+    def run(self, max_instructions=None):
+        """Run until a breakpoint (other than the current PC) is reached, stop() is called or max_instructions
+        were executed. Returns the number of instructions executed."""
+        global instructionCount
+        global instructionLimit
+        global stopReason
+        self.activate()
+        first = instructionCount
+        instructionLimit = float('inf') if max_instructions is None else first + max_instructions
+        stopReason = None
+        # The state may have been changed since the last run
+        idleStates.clear()
+        PC = (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]
+        while instructionCount < instructionLimit:
+            if cycleCount >= nextEventCycle:
+                # Devices may request an interrupt, which changes PC
+                runEvents()
+                PC = (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]
+            # Run compiled routines or whole basic blocks, unless they could go past the limit (or are traced or profiled)
+            if instructionLimit - instructionCount >= BLOCK_MAX_LENGTH and traceWriter is None and profiler is None:
+                if PC in aotEntries and not watchpoints:
+                    if aotEntries[PC](PC) != BLOCK_STEP:
+                        PC = (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]
+                        if PC in breakpoints and breakpointHit(PC):
+                            break
+                        continue
+                else:
+                    if PC in blockCache:
+                        block = blockCache[PC]
+                    else:
+                        block = translateBlock(PC)
+                    if block is not None and block() != BLOCK_STEP:
+                        PC = (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]
+                        if PC in breakpoints and breakpointHit(PC):
+                            break
+                        continue
+            PC = self.step()
+            if PC in breakpoints and breakpointHit(PC):
+                break
+        instructionLimit = 0
+        return instructionCount - first
+
+    def start_trace(self, path):
+        """Record every instruction executed from now on to a binary trace file (see trace.py)"""
+        global traceWriter
+        self.stop_trace()
+        traceWriter = TraceWriter(path)
+
+    def stop_trace(self):
+        global traceWriter
+        self.activate()
+        if traceWriter is not None:
+            traceWriter.close()
+            traceWriter = None
+
+    def open_dac(self, path, channels=1, sample_rate=None):
+        """Capture the DAC output (DAOL, or DAOL and DAOR when stereo) to a WAV file, at the sample rate of the
+        ADC input by default"""
+        global dacOutput
+        self.close_dac()
+        if sample_rate is None:
+            sample_rate = adcInput.sampleRate if adcInput is not None else AUDIO_SAMPLE_RATE
+        dacOutput = DACOutput(path, channels, sample_rate)
+
+    def close_dac(self):
+        global dacOutput
+        self.activate()
+        if dacOutput is not None:
+            dacOutput.close()
+            dacOutput = None
+
+    def open_adc(self, path):
+        """Feed the ADC (ADC_DATA, ADR) with the samples of a WAV file, from now on"""
+        global adcInput
+        self.close_adc()
+        adcInput = ADCInput(path)
+        adcInput.scheduleFull()
+
+    def close_adc(self):
+        global adcInput
+        self.activate()
+        if adcInput is not None:
+            adcInput.close()
+            adcInput = None
+
+    def open_flash(self, path):
+        """Connect an SPI flash backed by an image file, which programming and erasing write to"""
+        global spiFlash
+        self.close_flash()
+        spiFlash = SPIFlash(path)
+
+    def close_flash(self):
+        global spiFlash
+        self.activate()
+        if spiFlash is not None:
+            spiFlash.close()
+            spiFlash = None
+
+    def request_interrupt(self, channel):
+        """Request an interrupt, by channel number or name (see interruptChannels)"""
+        self.activate()
+        if not isinstance(channel, int):
+            channel = interruptChannels[channel]
+        requestInterrupt(channel)
+
+    def timer_event(self, timer):
+        """Signal an external event to timer 0, 1 or 2 (counted when the timer is in event mode)"""
+        self.activate()
+        timerEvent(timer)
+
+    def start_profile(self):
+        """Count executions and cycles per PC and per routine from now on (see Profiler)"""
+        global profiler
+        self.activate()
+        profiler = Profiler(self.pc)
+
+    def stop_profile(self):
+        """Stop profiling, returns the Profiler (report() and collapsed() give the results)"""
+        global profiler
+        self.activate()
+        stopped = profiler
+        profiler = None
+        return stopped
+
+    def run_until(self, pc, max_instructions=None):
+        """Run until PC reaches pc (see run), returns whether it did"""
+        self.activate()
+        temporary = pc not in breakpoints
+        if temporary:
+            self.add_breakpoint(pc)
+        self.run(max_instructions)
+        if temporary:
+            breakpoints.pop(pc)
+        return self.pc == pc
+
+    def stop(self):
+        """Make run() return as soon as possible (can be called from a signal handler)"""
+        if Emulator.active is self:
+            globals()['instructionLimit'] = 0
+        else:
+            self.state['instructionLimit'] = 0
+
+    def add_breakpoint(self, address, condition=None, ignore=0):
+        """Stop run() before executing address, if condition (a Python expression of the registers, I/O
+        registers, wram(address) and pram(address), or a function of the Emulator) is met. The first ignore
+        hits do not stop."""
+        self.activate()
+        breakpoints[address] = Breakpoint(address, condition, ignore)
+        # Cached blocks cannot stop in the middle, compiled routines cannot stop between blocks
+        for start in [start for start in blockCache if start < address < blockEnds.get(start, start)]:
+            del blockCache[start]
+            del blockEnds[start]
+        for start in [start for start in aotEntries if start <= address < aotBlockEnds[start]]:
+            disableAOTBlock(start)
+
+    def remove_breakpoint(self, address):
+        self.activate()
+        breakpoints.pop(address, None)
+
+    def add_watchpoint(self, space, address, access='w', condition=None, ignore=0):
+        """Stop run() after an instruction reads ('r') or writes ('w') a data or program memory word, or an
+        I/O register ('data', 'program' or 'io'). Conditions can also use address and value (see add_breakpoint)."""
+        self.activate()
+        if space not in ['data', 'program', 'io']:
+            raise ValueError('Unknown address space: %s' % space)
+        if not watchpoints:
+            flushBlocks()
+        removeWatchPages()
+        watchpoints[(space, address)] = Watchpoint(space, address, access, condition, ignore)
+        installWatchpoints()
+
+    def remove_watchpoint(self, space, address):
+        self.activate()
+        removeWatchPages()
+        watchpoints.pop((space, address), None)
+        installWatchpoints()
+        if not watchpoints:
+            flushBlocks()
+
+    @property
+    def watchpoints(self):
+        self.activate()
+        return watchpoints
+
+    @property
+    def stop_reason(self):
+        """Breakpoint, or (Watchpoint, access, value), which stopped the last run() (None otherwise)"""
+        self.activate()
+        return stopReason
+
+    # State accessors
+    @property
+    def pc(self):
+        self.activate()
+        return (ioReg[IO_PCH] << 16) | ioReg[IO_PCL]
+
+    @pc.setter
+    def pc(self, value):
+        self.activate()
+        setPC(value)
+
+    @property
+    def breakpoints(self):
+        self.activate()
+        return breakpoints
+
+    @property
+    def instruction_count(self):
+        self.activate()
+        return instructionCount
+
+    @property
+    def cycle_count(self):
+        """Cycles taken by the instructions executed so far (see instructionCycles)"""
+        self.activate()
+        return cycleCount
+
+    @property
+    def clock_frequency(self):
+        """System clock frequency (Hz), from the PLL configuration"""
+        self.activate()
+        return clockFrequency
+
+    @property
+    def emulated_time(self):
+        """Seconds of emulated time elapsed so far, at the successive system clock frequencies"""
+        self.activate()
+        return emulatedTime()
+
+    def registers(self):
+        self.activate()
+        return dict(zip(registers_reg, internal))
+
+    def get_register(self, name):
+        self.activate()
+        return internal[registers_reg.index(name)]
+
+    def set_register(self, name, value):
+        self.activate()
+        internal[registers_reg.index(name)] = value & 0xffff
+
+    def get_io(self, io):
+        """Read an I/O register, by address or label"""
+        self.activate()
+        if not isinstance(io, int):
+            io = ioAddresses[io]
+        if ioReadHooks[io] is not None:
+            unwatched(ioReadHooks[io])
+        return ioReg[io]
+
+    def set_io(self, io, value):
+        self.activate()
+        if not isinstance(io, int):
+            io = ioAddresses[io]
+        ioReg[io] = value & 0xffff
+        if ioWriteHooks[io] is not None:
+            unwatched(ioWriteHooks[io])
+
+    def read_data(self, address):
+        self.activate()
+        return unwatched(readData, address)
+
+    def write_data(self, address, value):
+        self.activate()
+        unwatched(writeData, address, value & 0xffff)
+
+    def read_program(self, address):
+        self.activate()
+        return unwatched(readProgram, address)
+
+    def read_data_words(self, address, count):
+        """count consecutive words of data memory, as an array (copied one RAM page at a time)"""
+        self.activate()
+        words = dataWords(address, 1, count)
+        if words is None:
+            words = array('H', [unwatched(readData, address + offset) for offset in range(count)])
+        return words
+
+    def write_data_words(self, address, words):
+        self.activate()
+        unwatched(writeDataWords, address, array('H', [word & 0xffff for word in words]))
+
+    def read_program_words(self, address, count):
+        """count consecutive words of program memory, as an array (copied one page at a time)"""
+        self.activate()
+        return unwatched(programWords, address, count)
+
+    def write_program_words(self, address, words):
+        """Write Program RAM words (ROM cannot be written)"""
+        self.activate()
+        unwatched(writeProgramWords, address, array('H', [word & 0xffff for word in words]))
+
+
+# Command line
+# Debugger: execution stops on these breakpoints, then runs step-by-step until continued
+initialBreakpoints = [0x000000, 0x0004e5, 0x000100, 0x001ec5]
+stepByStep = False
+ioRegex = re.compile('^io (.+)$')
+wramRegex = re.compile('^wram (.+)$')
+pramRegex = re.compile('^pram (.+)$')
+romRegex = re.compile('^rom (.+)$')
+traceRegex = re.compile('^trace (.+)$')
+saveRegex = re.compile('^save (.+)$')
+breakRegex = re.compile('^break (\\S+)(?: if (.+))?$')
+deleteRegex = re.compile('^delete (\\S+)$')
+watchRegex = re.compile('^watch (r|w|rw) (wram|pram|io) (\\S+)(?: if (.+))?$')
+unwatchRegex = re.compile('^unwatch (wram|pram|io) (\\S+)$')
+watchSpaces = dict([('wram', 'data'), ('pram', 'program'), ('io', 'io')])
+
+def debug(emulator):
+    global stepByStep
+    global traceLevel
+    # Stop on Ctrl+C
+    def sigint_handler(sig, frame):
+        global stepByStep
+        if stepByStep:
+            sys.exit(1)
+        else:
+            stepByStep = True
+            emulator.stop()
+    signal.signal(signal.SIGINT, sigint_handler)
+    quit = False
+    while not quit:
+        PC = emulator.pc
+        # TODO Dump registers / stack / ram ?
+        # run() only stops at breakpoints whose condition is met, the ones at the start PC are checked here
+        if stepByStep or emulator.stop_reason is not None or (PC in emulator.breakpoints and breakpointHit(PC)):
+            while True:
+                command = input(f"{bcolors.CONTROL}> {bcolors.ENDC}")
+                try:
+                    ioMatch = ioRegex.match(command)
+                    wramMatch = wramRegex.match(command)
+                    pramMatch = pramRegex.match(command)
+                    romMatch = romRegex.match(command)
+                    traceMatch = traceRegex.match(command)
+                    saveMatch = saveRegex.match(command)
+                    breakMatch = breakRegex.match(command)
+                    deleteMatch = deleteRegex.match(command)
+                    watchMatch = watchRegex.match(command)
+                    unwatchMatch = unwatchRegex.match(command)
+                    if 'q' == command:  # Stop emulator
+                        print_control('Stopping emulator.')
+                        quit = True
+                        break
+                    elif 'c' == command:    # Continue execution
+                        stepByStep = False
+                        break
+                    elif 's' == command or '' == command:   # Step-by-step, next instruction
+                        stepByStep = True
+                        break
+                    elif 'reg' == command:
+                        print_control("Internal registers:\t%s" % ("\t".join("{}={}".format(k, hex(v, 4)) for k, v in emulator.registers().items())))
+                    elif ioMatch:
+                        if ioMatch.group(1).startswith('0x'):
+                            ioAddr = int(ioMatch.group(1), 16)
+                            print_control("I/O register: %s(%s)=%s" % (hex(ioAddr, 2), ioRegisterLabel(ioAddr), hex(emulator.get_io(ioAddr), 4)))
+                        else:
+                            print_control("I/O register: %s=%s" % (ioMatch.group(1), hex(emulator.get_io(ioMatch.group(1)), 4)))
+                    elif wramMatch:
+                        wramAddr = int(wramMatch.group(1), 16)
+                        print_control("WRAM word: %s=%s" % (hex(wramAddr, 6), hex(emulator.read_data(wramAddr), 4)))
+                    elif pramMatch:
+                        pramAddr = int(pramMatch.group(1), 16)
+                        pramWord = emulator.read_program(pramAddr)
+                        print_control("PRAM word: %s=%s" % (hex(pramAddr, 6), hex(pramWord, 4)))
+                    elif romMatch:
+                        romAddr = int(romMatch.group(1), 16)
+                        print_control("ROM word: %s=%s" % (hex(romAddr, 6), hex(emulator.read_program(CS1ROM_BASE + romAddr), 4)))
+                    elif traceMatch:
+                        traceLevel = traceLevels.index(traceMatch.group(1))
+                        print_control("Trace level: %s" % traceLevels[traceLevel])
+                    elif saveMatch:
+                        emulator.save_checkpoint(saveMatch.group(1))
+                        print_control("Checkpoint saved to %s" % saveMatch.group(1))
+                    elif breakMatch:
+                        emulator.add_breakpoint(int(breakMatch.group(1), 16), breakMatch.group(2))
+                        print_control("Breakpoint at %s" % hex(int(breakMatch.group(1), 16), 6))
+                    elif deleteMatch:
+                        emulator.remove_breakpoint(int(deleteMatch.group(1), 16))
+                    elif watchMatch:
+                        (access, space, address, condition) = watchMatch.groups()
+                        address = ioAddresses[address] if space == 'io' and address in ioAddresses else int(address, 16)
+                        emulator.add_watchpoint(watchSpaces[space], address, access, condition)
+                        print_control("Watchpoint on %s %s" % (space, hex(address, 6)))
+                    elif unwatchMatch:
+                        (space, address) = unwatchMatch.groups()
+                        address = ioAddresses[address] if space == 'io' and address in ioAddresses else int(address, 16)
+                        emulator.remove_watchpoint(watchSpaces[space], address)
+                    elif 'clock' == command:
+                        print_control("Instructions: %d\tCycles: %d\tSystem clock: %.6f MHz\tEmulated time: %.6f s" % (emulator.instruction_count, emulator.cycle_count, emulator.clock_frequency / 1000000, emulator.emulated_time))
+                    elif 'info' == command:
+                        for breakpoint in emulator.breakpoints.values():
+                            print_control("Breakpoint %s\thits=%d" % (hex(breakpoint.address, 6), breakpoint.hits))
+                        for watchpoint in emulator.watchpoints.values():
+                            print_control("Watchpoint %s %s %s\thits=%d" % (watchpoint.access, watchpoint.space, hex(watchpoint.address, 6), watchpoint.hits))
+                    else:
+                        print_control(f'{bcolors.ERROR}Invalid command.{bcolors.ENDC}')
+                        print_control("""Usage:
+\tc:                    Continue execution
+\ts or <enter>:         Step-by-step / Next instruction
+\treg:                  Print internal registers
+\tio <addr>|<label>:    Print I/O register
+\twram <addr>:          Print WRAM word
+\tpram <addr>:          Print PRAM word
+\trom <addr>:           Print ROM word
+\ttrace <level>:        Set trace level (off, instructions, full)
+\tsave <file>:          Save a checkpoint of the machine state
+\tbreak <addr> [if <condition>]:                    Set a breakpoint
+\tdelete <addr>:                                    Delete a breakpoint
+\twatch r|w|rw wram|pram|io <addr> [if <condition>]: Set a read and/or write watchpoint
+\tunwatch wram|pram|io <addr>:                      Delete a watchpoint
+\tinfo:                 List breakpoints and watchpoints
+\tclock:                Print instruction and cycle counts, system clock and emulated time
+\tq:                    Quit""")
+                except:
+                    print_control(f'{bcolors.ERROR}Oops! Something bad occurred. Try again!{bcolors.ENDC}')
+            if quit:
+                continue
+
+        # Run until the next breakpoint, unless executing step-by-step
+        if stepByStep:
+            emulator.step()
+        else:
+            emulator.run()
+            reason = emulator.stop_reason
+            if isinstance(reason, Breakpoint):
+                print_control("Breakpoint at %s (hit %d)" % (hex(reason.address, 6), reason.hits))
+            elif reason is not None:
+                (watchpoint, access, value) = reason
+                print_control("Watchpoint: %s %s %s (%s), PC=%s" % (watchpoint.space, hex(watchpoint.address, 6), 'read' if access == 'r' else 'written', hex(value, 4), hex(emulator.pc, 6)))
+
+def main():
+    global traceLevel
+    parser = argparse.ArgumentParser(description='S9KE DSP Core emulator')
+    parser.add_argument('rom', nargs='?', default=FW, help='ROM file (default: %(default)s)')
+    parser.add_argument('--trace', choices=traceLevels, default=traceLevels[TRACE_FULL], help='trace level (default: %(default)s)')
+    parser.add_argument('--chip', choices=list(chipProfiles), default='SNC7001A', help='chip memory layout (default: %(default)s)')
+    parser.add_argument('--aot', action='store_true', help='run routines from a compiled translation of the ROM (cached in %s)' % AOT_CACHE)
+    parser.add_argument('--trace-file', help='record a binary trace of the execution to this file (see trace.py)')
+    parser.add_argument('--profile', help='profile the execution, write the report to this file (and collapsed stacks to <file>.folded)')
+    parser.add_argument('--checkpoint', help='start from a checkpoint file (see the save command) instead of reset')
+    parser.add_argument('--flash', help='SPI flash image file (written by programming and erasing)')
+    parser.add_argument('--adc-wav', help='feed the ADC with the samples of this WAV file')
+    parser.add_argument('--dac-wav', help='capture the DAC output to this WAV file')
+    parser.add_argument('--dac-channels', type=int, choices=[1, 2], default=1, help='1: DAOL, 2: DAOL and DAOR (default: %(default)s)')
+    args = parser.parse_args()
+    traceLevel = traceLevels.index(args.trace)
+    emulator = Emulator(args.chip)
+    for address in initialBreakpoints:
+        emulator.add_breakpoint(address)
+    emulator.load_rom(args.rom, args.aot)
+    if args.checkpoint:
+        emulator.load_checkpoint(args.checkpoint)
+    if args.trace_file:
+        emulator.start_trace(args.trace_file)
+    if args.profile:
+        emulator.start_profile()
+    if args.flash:
+        emulator.open_flash(args.flash)
+    if args.adc_wav:
+        emulator.open_adc(args.adc_wav)
+    if args.dac_wav:
+        emulator.open_dac(args.dac_wav, args.dac_channels)
+    try:
+        debug(emulator)
+    finally:
+        emulator.stop_trace()
+        emulator.close_dac()
+        emulator.close_adc()
+        emulator.close_flash()
+        if args.profile:
+            profile = emulator.stop_profile()
+            with open(args.profile, 'w') as f:
+                f.write(profile.report())
+            with open(args.profile + '.folded', 'w') as f:
+                f.write(profile.collapsed())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import argparse
+import select
+import socket
+import sys
+from array import array
+
+import emulator
+from emulator import Emulator, chipProfiles, ioRegisterLabel, registers_reg, print_error, print_execution
+
+
+# GDB remote serial protocol
+# GDB addresses bytes, the DSP addresses 16-bit words: program memory word n is at byte address 2 * n, data
+# memory word n at DATA_BASE + 2 * n (PC is a byte address too). Words are little-endian. Registers are the
+# internal registers, PC, then the 128 I/O registers (see the target description).
+DATA_BASE = 0x10000000
+PACKET_SIZE = 0x20000          # bytes of a packet, so that m/M transfer up to 64K bytes at once
+RUN_CHUNK = 100000             # instructions run between checks for an interrupt from GDB
+SIGINT = 0x02
+SIGTRAP = 0x05
+IO_REGISTERS = 0x80
+PC_REGISTER = len(registers_reg)
+
+def registerNames():
+    names = list(registers_reg) + ['pc']
+    for io in range(IO_REGISTERS):
+        label = ioRegisterLabel(io)
+        names.append(label if label != 'NOT FOUND' and label not in names else 'io%02x' % io)
+    return names
+
+def targetDescription():
+    registers = []
+    for number, name in enumerate(registerNames()):
+        if number == PC_REGISTER:
+            registers.append('<reg name="pc" bitsize="32" type="code_ptr" regnum="%d"/>' % number)
+        else:
+            registers.append('<reg name="%s" bitsize="16" type="uint16" regnum="%d"/>' % (name, number))
+    return ('<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd"><target version="1.0">'
+        '<feature name="org.s9ke.core">%s</feature></target>' % ''.join(registers))
+
+def checksum(payload):
+    return sum(payload) & 0xff
+
+def hexWord(value, size=2):
+    return value.to_bytes(size, 'little').hex()
+
+def wordsToBytes(words):
+    words = array('H', words)
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words.tobytes()
+
+def bytesToWords(data):
+    words = array('H', data)
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words
+
+class GDBConnection:
+    """Packets of one GDB client"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffer = bytearray()
+        self.acknowledge = True
+
+    def receive(self):
+        data = self.connection.recv(PACKET_SIZE)
+        if not data:
+            raise ConnectionError('GDB disconnected')
+        self.buffer += data
+
+    def interrupted(self):
+        """Whether GDB sent an interrupt (^C), without waiting"""
+        while select.select([self.connection], [], [], 0)[0]:
+            self.receive()
+            if 0x03 in self.buffer:
+                self.buffer = self.buffer[self.buffer.index(0x03) + 1:]
+                return True
+        return False
+
+    def readPacket(self):
+        """Payload of the next packet, or '\\x03' for an interrupt"""
+        while True:
+            # Acknowledgements and garbage before the start of a packet are skipped
+            while self.buffer and self.buffer[0] not in b'$\x03':
+                del self.buffer[0]
+            if self.buffer[:1] == b'\x03':
+                del self.buffer[0]
+                return '\x03'
+            end = self.buffer.find(b'#')
+            if self.buffer and end >= 0 and len(self.buffer) >= end + 3:
+                payload = bytes(self.buffer[1:end])
+                expected = self.buffer[end + 1:end + 3]
+                del self.buffer[:end + 3]
+                if not self.acknowledge:
+                    return payload.decode('latin-1')
+                if int(expected, 16) == checksum(payload):
+                    self.connection.sendall(b'+')
+                    return payload.decode('latin-1')
+                self.connection.sendall(b'-')
+                continue
+            self.receive()
+
+    def sendPacket(self, payload):
+        payload = payload.encode('latin-1')
+        self.connection.sendall(b'$' + payload + b'#' + ('%02x' % checksum(payload)).encode())
+        if self.acknowledge:
+            # Resent until GDB acknowledges it
+            while True:
+                while not self.buffer:
+                    self.receive()
+                acknowledgement = self.buffer[0]
+                if acknowledgement in b'+-':
+                    del self.buffer[0]
+                    if acknowledgement == ord('+'):
+                        return
+                    self.connection.sendall(b'$' + payload + b'#' + ('%02x' % checksum(payload)).encode())
+                else:
+                    return
+
+class GDBStub:
+    """Serves the commands of a GDB client on an Emulator"""
+
+    def __init__(self, machine, connection):
+        self.machine = machine
+        self.connection = connection
+        self.description = targetDescription().encode()
+
+    # Memory
+    def space(self, address):
+        if address >= DATA_BASE:
+            return ('data', (address - DATA_BASE) >> 1)
+        return ('program', address >> 1)
+
+    def readMemory(self, address, length):
+        # Whole words covering the bytes, in one transfer
+        (space, first) = self.space(address)
+        count = ((address & 1) + length + 1) >> 1
+        if space == 'data':
+            words = self.machine.read_data_words(first, count)
+        else:
+            words = self.machine.read_program_words(first, count)
+        return wordsToBytes(words)[address & 1:(address & 1) + length]
+
+    def writeMemory(self, address, data):
+        if address & 1 or len(data) & 1:
+            # Partial words are merged with the words around them
+            start = address & ~1
+            words = bytearray(self.readMemory(start, ((address + len(data) + 1) & ~1) - start))
+            words[address - start:address - start + len(data)] = data
+            (address, data) = (start, bytes(words))
+        (space, first) = self.space(address)
+        if space == 'data':
+            self.machine.write_data_words(first, bytesToWords(data))
+        else:
+            self.machine.write_program_words(first, bytesToWords(data))
+
+    # Registers
+    def readRegister(self, number):
+        if number < PC_REGISTER:
+            return hexWord(self.machine.get_register(registers_reg[number]))
+        if number == PC_REGISTER:
+            return hexWord(self.machine.pc * 2, 4)
+        return hexWord(self.machine.get_io(number - PC_REGISTER - 1))
+
+    def writeRegister(self, number, value):
+        value = int.from_bytes(bytes.fromhex(value), 'little')
+        if number < PC_REGISTER:
+            self.machine.set_register(registers_reg[number], value)
+        elif number == PC_REGISTER:
+            self.machine.pc = value >> 1
+        else:
+            self.machine.set_io(number - PC_REGISTER - 1, value)
+
+    def registerCount(self):
+        return PC_REGISTER + 1 + IO_REGISTERS
+
+    # Execution
+    def stopReply(self, signal):
+        reason = self.machine.stop_reason
+        if isinstance(reason, tuple):
+            (watchpoint, access, _) = reason
+            kind = dict([('r', 'rwatch'), ('w', 'watch')]).get(access, 'awatch')
+            return 'T%02x%s:%x;' % (SIGTRAP, kind, DATA_BASE + 2 * watchpoint.address)
+        if reason is not None:
+            return 'T%02xswbreak:;' % SIGTRAP
+        return 'S%02x' % signal
+
+    def step(self):
+        self.machine.step()
+        return 'S%02x' % SIGTRAP
+
+    def resume(self):
+        # Run in chunks, to notice ^C from GDB
+        while True:
+            executed = self.machine.run(RUN_CHUNK)
+            if self.machine.stop_reason is not None or executed < RUN_CHUNK:
+                return self.stopReply(SIGTRAP)
+            if self.connection.interrupted():
+                return self.stopReply(SIGINT)
+
+    # Breakpoints and watchpoints: Z0/Z1 at program addresses, Z2 (write), Z3 (read), Z4 (access) at data addresses
+    def setPoint(self, packet):
+        (kind, address, length) = packet[1:].split(';')[0].split(',')
+        (kind, address, length) = (int(kind), int(address, 16), int(length, 16))
+        (space, word) = self.space(address)
+        if kind in [0, 1]:
+            if space != 'program':
+                return 'E01'
+            if packet[0] == 'Z':
+                self.machine.add_breakpoint(word)
+            else:
+                self.machine.remove_breakpoint(word)
+            return 'OK'
+        if space != 'data' or kind not in [2, 3, 4]:
+            return ''
+        words = range(word, word + max(((address & 1) + length + 1) >> 1, 1))
+        access = dict([(2, 'w'), (3, 'r'), (4, 'rw')])[kind]
+        for watched in words:
+            if packet[0] == 'Z':
+                self.machine.add_watchpoint('data', watched, access)
+            else:
+                self.machine.remove_watchpoint('data', watched)
+        return 'OK'
+
+    def query(self, packet):
+        if packet.startswith('qSupported'):
+            return 'PacketSize=%x;qXfer:features:read+;QStartNoAckMode+;swbreak+;vContSupported+' % PACKET_SIZE
+        if packet.startswith('qXfer:features:read:target.xml:'):
+            (offset, length) = [int(field, 16) for field in packet.split(':')[4].split(',')]
+            chunk = self.description[offset:offset + length]
+            return ('l' if offset + length >= len(self.description) else 'm') + chunk.decode()
+        if packet == 'qAttached':
+            return '1'
+        if packet == 'qC':
+            return 'QC1'
+        if packet == 'qfThreadInfo':
+            return 'm1'
+        if packet == 'qsThreadInfo':
+            return 'l'
+        return ''
+
+    def handle(self, packet):
+        """Reply to a packet, or None when the session is over"""
+        command = packet[:1]
+        if packet == '\x03':
+            return 'S%02x' % SIGINT
+        if command == '?':
+            return 'S%02x' % SIGTRAP
+        if command == 'q':
+            return self.query(packet)
+        if packet == 'QStartNoAckMode':
+            return 'OK'
+        if command == 'H':
+            return 'OK'
+        if command == 'g':
+            return ''.join(self.readRegister(number) for number in range(self.registerCount()))
+        if command == 'G':
+            position = 0
+            for number in range(self.registerCount()):
+                size = 8 if number == PC_REGISTER else 4
+                self.writeRegister(number, packet[1 + position:1 + position + size])
+                position += size
+            return 'OK'
+        if command == 'p':
+            number = int(packet[1:], 16)
+            return self.readRegister(number) if number < self.registerCount() else 'E01'
+        if command == 'P':
+            (number, value) = packet[1:].split('=')
+            if int(number, 16) >= self.registerCount():
+                return 'E01'
+            self.writeRegister(int(number, 16), value)
+            return 'OK'
+        if command == 'm':
+            (address, length) = [int(field, 16) for field in packet[1:].split(',')]
+            return self.readMemory(address, min(length, PACKET_SIZE // 2 - 8)).hex()
+        if command == 'M':
+            (location, data) = packet[1:].split(':')
+            address = int(location.split(',')[0], 16)
+            self.writeMemory(address, bytes.fromhex(data))
+            return 'OK'
+        if command in ['Z', 'z']:
+            return self.setPoint(packet)
+        if command == 's':
+            return self.step()
+        if command == 'c':
+            return self.resume()
+        if packet == 'vCont?':
+            return 'vCont;c;C;s;S'
+        if packet.startswith('vCont;'):
+            action = packet[6:7]
+            return self.step() if action in 'sS' else self.resume()
+        if command in ['k', 'D']:
+            return None
+        return ''
+
+    def serve(self):
+        while True:
+            packet = self.connection.readPacket()
+            try:
+                reply = self.handle(packet)
+            except Exception as e:
+                # Unmapped memory, ROM writes, malformed packets...
+                print_error('GDB packet %s failed: %s: %s' % (packet[:32], type(e).__name__, e))
+                reply = 'E01'
+            if reply is None:
+                if packet[:1] == 'D':
+                    self.connection.sendPacket('OK')
+                return
+            self.connection.sendPacket(reply)
+            if packet == 'QStartNoAckMode':
+                self.connection.acknowledge = False
+
+def main():
+    parser = argparse.ArgumentParser(description='GDB remote protocol stub for the S9KE emulator')
+    parser.add_argument('rom', help='ROM file')
+    parser.add_argument('--port', type=int, default=1234, help='TCP port to listen on, on localhost (default: %(default)s)')
+    parser.add_argument('--chip', choices=list(chipProfiles), default='SNC7001A', help='chip memory layout (default: %(default)s)')
+    parser.add_argument('--aot', action='store_true', help='run routines from a compiled translation of the ROM')
+    parser.add_argument('--checkpoint', help='start from a checkpoint file instead of reset')
+    parser.add_argument('--flash', help='SPI flash image file')
+    parser.add_argument('--trace', choices=emulator.traceLevels, default=emulator.traceLevels[emulator.TRACE_OFF], help='trace level (default: %(default)s)')
+    args = parser.parse_args()
+    emulator.traceLevel = emulator.traceLevels.index(args.trace)
+    machine = Emulator(args.chip)
+    machine.load_rom(args.rom, args.aot)
+    if args.checkpoint:
+        machine.load_checkpoint(args.checkpoint)
+    if args.flash:
+        machine.open_flash(args.flash)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', args.port))
+    server.listen(1)
+    try:
+        while True:
+            print_execution('Waiting for GDB on localhost:%d (target remote :%d)' % (args.port, args.port))
+            (connection, _) = server.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                GDBStub(machine, GDBConnection(connection)).serve()
+            except ConnectionError:
+                pass
+            finally:
+                connection.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        machine.close_flash()
+
+if __name__ == '__main__':
+    main()
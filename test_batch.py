@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import tempfile
+import unittest
+
+import batch
+import emulator
+from test_emulator import assemble
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        emulator.traceLevel = emulator.TRACE_OFF
+        self.directory = tempfile.TemporaryDirectory()
+        batch.machines.clear()
+
+    def tearDown(self):
+        batch.machines.clear()
+        self.directory.cleanup()
+
+    def testJobsOnTheSameMachine(self):
+        # Jobs reuse the machines of their worker, which start over from reset
+        rom = assemble(self.directory.name, dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000080, ['.reset_handler:', 'X1.l = 0x01', 'X1.h = 0x00', 'IO(0x10) = X1', '.loop:', 'R0 = R0 + 1', 'X0 = IO(0x47)', 'Jmp .loop']),
+        ]))
+        job = dict([('rom', rom), ('max_instructions', 500), ('collect', ['pc', 'instructions', 'cycles', 'time', 'registers'])])
+        records = [batch.runJob((index, job)) for index in range(2)]
+        self.assertEqual(len(batch.machines), 1)
+        for record in records:
+            del record['job']
+            del record['seconds']
+        self.assertEqual(records[0]['instructions'], 500)
+        self.assertEqual(records[1], records[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,771 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import contextlib
+import io
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import wave
+from unittest import mock
+
+import emulator
+from emulator import Emulator
+
+
+# Fast paths (blocks, compiled routines, MAC loops, hardware loops, idle loops) must end in the same state as
+# interpreting every instruction with step(). Programs are written for assembler.py, raw opcodes (which it
+# cannot assemble) are given as integers, in place of a Nop.
+ASSEMBLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assembler.py')
+DO0 = 0xfc00            # Do0 n: DO0 | n
+DO1 = 0xfc40
+LOOP0 = 0xfffc
+LOOP1 = 0xfffe
+
+def assemble(directory, sections):
+    """Assemble sections ({word address: [instruction or raw opcode]}) to a ROM file, returns its path"""
+    lines = []
+    patches = []
+    for address, instructions in sections.items():
+        lines.append('seek(%s)' % emulator.hex(address, 6))
+        for instruction in instructions:
+            if isinstance(instruction, int):
+                patches.append((address, instruction))
+                instruction = 'Nop'
+            lines.append(instruction if instruction.endswith(':') else '    ' + instruction)
+            if not instruction.endswith(':'):
+                address += 2 if instruction.lower().split()[0] in ['jmpff', 'callff'] else 1
+    source = os.path.join(directory, 'test.asm')
+    rom = os.path.join(directory, 'test.bin')
+    with open(source, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    subprocess.run([sys.executable, ASSEMBLER, source, rom], check=True, stdout=subprocess.DEVNULL)
+    with open(rom, 'r+b') as f:
+        for (address, opcode) in patches:
+            f.seek(address * 2)
+            f.write(struct.pack('<H', opcode))
+    return rom
+
+def opcodes(directory, instructions):
+    """Opcodes of instructions, as assembled by assembler.py"""
+    with open(assemble(directory, dict([(0x000000, instructions)])), 'rb') as f:
+        data = f.read()
+    return list(struct.unpack('<%dH' % (len(data) // 2), data))
+
+def writeWAV(directory, name, samples):
+    """Write 16-bit mono samples to a WAV file, returns its path"""
+    path = os.path.join(directory, name)
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(emulator.AUDIO_SAMPLE_RATE)
+        f.writeframes(struct.pack('<%dh' % len(samples), *samples))
+    return path
+
+def state(machine):
+    return (machine.registers(), [machine.get_io(io) for io in range(0x80)], machine.instruction_count, machine.cycle_count,
+        machine.pc, list(machine.read_data_words(0x0000, 0x400)))
+
+class MachineTest(unittest.TestCase):
+
+    def setUp(self):
+        emulator.traceLevel = emulator.TRACE_OFF
+        self.directory = tempfile.TemporaryDirectory()
+        self.aotCache = emulator.AOT_CACHE
+        emulator.AOT_CACHE = os.path.join(self.directory.name, 'cache')
+
+    def tearDown(self):
+        emulator.AOT_CACHE = self.aotCache
+        self.directory.cleanup()
+
+    def assertEquivalent(self, sections, instructions, setup=None, limits=()):
+        """Compare step() with run() (interpreted blocks and compiled routines), in one run and in runs of limits
+        instructions"""
+        rom = assemble(self.directory.name, sections)
+        machines = []
+        for aot in [False, True]:
+            for chunks in [[instructions], list(limits) + [instructions - sum(limits)]]:
+                machine = Emulator()
+                machine.load_rom(rom, aot)
+                if setup is not None:
+                    setup(machine)
+                for chunk in chunks:
+                    machine.run(chunk)
+                machines.append(machine)
+        reference = Emulator()
+        reference.load_rom(rom)
+        if setup is not None:
+            setup(reference)
+        for _ in range(instructions):
+            reference.step()
+        expected = state(reference)
+        for machine in machines:
+            self.assertEqual(state(machine), expected)
+        return reference
+
+    def countSkipped(self, skipped):
+        """Patch skipIdleLoop() to append the number of instructions it skipped to a list"""
+        skipIdleLoop = emulator.skipIdleLoop
+        def countSkipped(start, length, cycles):
+            count = emulator.instructionCount
+            skipIdleLoop(start, length, cycles)
+            skipped.append(emulator.instructionCount - count)
+        return mock.patch('emulator.skipIdleLoop', countSkipped)
+
+    def machine(self, sections, chipName='SNC7001A', aot=False):
+        machine = Emulator(chipName)
+        machine.load_rom(assemble(self.directory.name, sections), aot)
+        return machine
+
+class EquivalenceTest(MachineTest):
+
+    def testLoopWithInterruptRequests(self):
+        # The body of the loop requests the T0 interrupt, taken at every iteration
+        sections = dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000018, ['jmpff .t0_handler']),
+            (0x000080, ['.reset_handler:', 'X1.l = 0x02', 'X1.h = 0x00', 'IO(0x20) = X1', DO0 | 50, 'R0 = R0 + 1', 'IO(0x21) = X1', LOOP0,
+                '.end:', 'Jmp .end', '.t0_handler:', 'Y0 = Y0 + 1', 'IO(0x23) = X1', 'Reti']),
+        ])
+        reference = self.assertEquivalent(sections, 1000, limits=[77, 100])
+        self.assertEqual(reference.get_register('Y0'), 50)
+        self.assertEqual(reference.get_register('R0'), 50)
+
+    def testNestedLoopsWithTimerInterrupts(self):
+        # Do1 (64 iterations) nested in Do0, the T0 interrupt being taken in the middle of both
+        sections = dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000018, ['jmpff .t0_handler']),
+            (0x000080, ['.reset_handler:', 'X1.l = 0x80', 'X1.h = 0xff', 'IO(0x45) = X1', 'X1.l = 0x02', 'X1.h = 0x00', 'IO(0x20) = X1',
+                'X1.l = 0x01', 'IO(0x10) = X1', '.loop:', DO0 | 20, 'R0 = R0 + 1', DO1 | 0, 'R1 = R1 + 1', 'X0 = X0 + 1', LOOP1, 'Y0 = Y0 + 1',
+                LOOP0, 'Jmp .loop', '.t0_handler:', 'Y1 = Y1 + 1', 'X1.l = 0x02', 'IO(0x23) = X1', 'Reti']),
+        ])
+        reference = self.assertEquivalent(sections, 20000, limits=[1000, 77, 5000])
+        self.assertGreater(reference.get_register('Y1'), 10)
+        self.assertIn(reference.get_register('R1') - 64 * reference.get_register('Y0'), range(65))
+        self.assertIn(reference.get_register('R0') - reference.get_register('Y0'), [0, 1])
+
+    def testTimerAccessesInsideBlocks(self):
+        # Timer reads and writes in the middle of a block see the cycles of the instructions before them
+        sections = dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000080, ['.reset_handler:', 'X1.l = 0x00', 'X1.h = 0xff', 'IO(0x45) = X1', 'X1.l = 0x01', 'X1.h = 0x00', 'IO(0x10) = X1',
+                '.loop:', 'R0 = R0 + 1', 'R0 = R0 + 1', 'R0 = R0 + 1', 'R0 = R0 + 1', 'R0 = R0 + 1', 'R0 = R0 + 1', 'X0 = IO(0x47)',
+                'R1 = X0 + R1', 'Y0 = Y0 + 1', 'Y0 = Y0 + 1', 'Y0 = Y0 + 1', 'X0 = IO(0x47)', 'R1 = X0 + R1', 'IO(0x45) = R0',
+                'Y0 = Y0 + 1', 'Y0 = Y0 + 1', 'Y0 = Y0 + 1', 'X0 = IO(0x47)', 'R1 = X0 + R1', 'Jmp .loop']),
+        ])
+        # Read values are summed in R1
+        self.assertEquivalent(sections, 1000, limits=[5, 333])
+
+    def testMacLoop(self):
+        # Fractional products summed into MR saturate, then go on from the saturated value. Y0 is loaded with a
+        # negative modifier, X0 by the MAC for the next iteration.
+        xs = [0x7fff] * 600 + [0x8000] * 400
+        ys = [(0x7fff - 19 * index) & 0xffff for index in range(2001)]
+        def setup(machine):
+            machine.write_data_words(0x0100, xs + [0x0000])
+            machine.write_data_words(0x0800, ys[::-1])
+            machine.set_io('Ix0', 0x0101)
+            machine.set_io('Ix1', 0x0800 + 2000)
+            machine.set_io('Im11', -2 & 0xffff)
+            machine.set_register('X0', xs[0])
+        sections = dict([(0x000000, ['R0.l = 0xe8', 'R0.h = 0x03', '.loop:', 'Y0 = RAM(IX1, m)', 0xf5a0, 'R0 = R0 - 1', 'Jne .loop', '.end:',
+            'Jmp .end'])])
+        with mock.patch('emulator.accumulateMac', wraps=emulator.accumulateMac) as accumulateMac:
+            reference = self.assertEquivalent(sections, 4100, setup, limits=[500, 1, 999])
+        self.assertTrue(accumulateMac.called)
+        mr = 0
+        for (x, y) in zip(xs, ys[::2]):
+            mr = emulator.saturateMR(mr + 2 * emulator.signed16(x) * emulator.signed16(y))
+        self.assertEqual(reference.get_register('R0'), 0)
+        self.assertEqual((reference.get_io('MR2') << 32) | (reference.get_register('MR1') << 16) | reference.get_register('MR0'), mr & 0xffffffffff)
+        self.assertNotEqual(mr, emulator.MR_MAX)
+
+    def testDoubleFetchMacLoop(self):
+        # EMAC fetching X0 and Y0 through Ix2 (forwards) and Iy2 (backwards)
+        def setup(machine):
+            machine.write_data_words(0x0100, [(index * 0x1234) & 0xffff for index in range(0x400)])
+            machine.set_io('MMR', emulator.MMR_DOUBLE_FETCH)
+            machine.set_io(0x1e, 0x0100)
+            machine.set_io(0x1f, 0x04ff)
+            machine.set_io(0x2c, 0x0001)
+            machine.set_io(0x2e, 0xffff)
+        sections = dict([(0x000000, ['R0.l = 0x00', 'R0.h = 0x02', '.loop:', 0xf1c0, 'R0 = R0 - 1', 'Jne .loop', '.end:', 'Jmp .end'])])
+        with mock.patch('emulator.accumulateMac', wraps=emulator.accumulateMac) as accumulateMac:
+            reference = self.assertEquivalent(sections, 2000, setup, limits=[100, 2])
+        self.assertTrue(accumulateMac.called)
+        self.assertEqual(reference.get_io(0x1e), 0x0300)
+
+    def testMacLoopWithTimerInterrupts(self):
+        # The kernel stops before the iteration where the T0 interrupt is taken
+        def setup(machine):
+            machine.write_data_words(0x0100, [(index * 0x3579) & 0xffff for index in range(0x1000)])
+            machine.set_io('Ix0', 0x0100)
+            machine.set_io('Ix1', 0x0100)
+        sections = dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000018, ['jmpff .t0_handler']),
+            (0x000080, ['.reset_handler:', 'X1.l = 0xc0', 'X1.h = 0xff', 'IO(0x45) = X1', 'X1.l = 0x02', 'X1.h = 0x00', 'IO(0x20) = X1',
+                'X1.l = 0x01', 'IO(0x10) = X1', 'R0.l = 0x00', 'R0.h = 0x0c', '.loop:', 'Y0 = RAM(IX1, 1)', 0xf1a0, 'R0 = R0 - 1', 'Jne .loop',
+                '.end:', 'Jmp .end', '.t0_handler:', 'Y1 = Y1 + 1', 'X1.l = 0x02', 'IO(0x23) = X1', 'Reti']),
+        ])
+        reference = self.assertEquivalent(sections, 15000, setup, limits=[1000, 3333])
+        self.assertGreater(reference.get_register('Y1'), 10)
+
+    def testCompiledROMWords(self):
+        # Only code in the words of the ROM file is compiled, not the rest of the Program RAM
+        rom = assemble(self.directory.name, dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'Jmp .loop'])]))
+        machine = Emulator()
+        machine.load_rom(rom, True)
+        self.assertEqual(sorted(emulator.aotEntries), [0x000000])
+
+    def testCompiledCallsWithoutReturn(self):
+        # Routines calling each other without returning go back to the interpreter instead of nesting Python calls
+        sections = dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000080, ['.reset_handler:', 'R0 = R0 + 1', 'Call .other', '.other:', 'R1 = R1 + 1', 'Call .reset_handler']),
+        ])
+        self.assertEquivalent(sections, 5000, limits=[300])
+
+    def testCompiledROMPerChip(self):
+        # Code compiled for a chip must not be run on another one, which maps other pages
+        rom = assemble(self.directory.name, dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'Jmp .loop'])]))
+        for chipName in ['SNC7001A', 'SNP70032', 'SNC7001A']:
+            Emulator(chipName).load_rom(rom, True)
+        self.assertEqual(len([name for name in os.listdir(emulator.AOT_CACHE) if name.endswith('.code')]), 2)
+
+    def testCheckpoint(self):
+        # Going on from a checkpoint ends in the same state as not stopping, on the chip it was saved on only
+        rom = assemble(self.directory.name, dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000018, ['jmpff .t0_handler']),
+            (0x000080, ['.reset_handler:', 'X1.l = 0x02', 'X1.h = 0x00', 'IO(0x20) = X1', 'X1.l = 0x01', 'IO(0x10) = X1', '.loop:',
+                'R0 = R0 + 1', 'RAM(IX0, 1) = R0', 'Jmp .loop', '.t0_handler:', 'Y0 = Y0 + 1', 'X0.l = 0x02', 'IO(0x23) = X0', 'Reti']),
+        ]))
+        checkpoint = os.path.join(self.directory.name, 'test.ckpt')
+        machine = Emulator()
+        machine.load_rom(rom)
+        machine.run(200000)
+        machine.save_checkpoint(checkpoint)
+        machine.run(100000)
+        restored = Emulator()
+        restored.load_rom(rom)
+        restored.load_checkpoint(checkpoint)
+        restored.run(100000)
+        self.assertEqual(state(restored), state(machine))
+        self.assertGreater(machine.get_register('Y0'), 0)
+        other = Emulator('SNP70032')
+        other.load_rom(rom)
+        self.assertRaises(ValueError, other.load_checkpoint, checkpoint)
+
+    def testDebuggerConditionalBreakpoint(self):
+        # The debugger only prompts at a conditional breakpoint once its condition is met, including at start
+        rom = assemble(self.directory.name, dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'Jmp .loop'])]))
+        machine = Emulator()
+        machine.load_rom(rom)
+        machine.add_breakpoint(0x000000, 'R0 == 5')
+        registers = []
+        def command(prompt):
+            registers.append(machine.get_register('R0'))
+            return 'q'
+        with mock.patch('builtins.input', command), mock.patch('signal.signal'):
+            emulator.debug(machine)
+        self.assertEqual(registers, [5])
+
+    def testIdleLoopWithTimerInterrupts(self):
+        # Loops polling a word written by the T0 interrupt handler are skipped up to the next interrupt
+        sections = dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000018, ['jmpff .t0_handler']),
+            (0x000080, ['.reset_handler:', 'X1.l = 0x00', 'X1.h = 0xf0', 'IO(0x45) = X1', 'X1.l = 0x02', 'X1.h = 0x00', 'IO(0x20) = X1',
+                'X1.l = 0x01', 'IO(0x10) = X1', '.loop:', 'Y0 = Y0 + 1', '.wait:', 'X0 = DM(0x010)', 'R0 = X0 - Y0', 'Jlt .wait', 'Jmp .loop',
+                '.t0_handler:', 'R1 = DM(0x010)', 'R1 = R1 + 1', 'DM(0x010) = R1', 'X1.l = 0x02', 'IO(0x23) = X1', 'Reti']),
+        ])
+        skipped = []
+        with self.countSkipped(skipped):
+            reference = self.assertEquivalent(sections, 30000, limits=[1000, 99])
+        self.assertGreater(reference.read_data(0x010), 2)
+        self.assertGreater(max(skipped), 1000)
+
+    def testADCStatusPolling(self):
+        # Loops waiting for 8 samples in the ADC FIFO are skipped up to the conversion which makes them available
+        path = writeWAV(self.directory.name, 'adc.wav', range(4000))
+        sections = dict([
+            (0x000000, ['.reset_handler:', 'Y1.l = 0x08', 'Y1.h = 0x00', '.wait:', 'X0 = IO(0x26)', 'R0 = X0 AND Y1', 'Jeq .wait']
+                + ['X0 = IO(0x28)', 'R1 = X0 + R1'] * 8 + ['Jmp .wait']),
+        ])
+        def setup(machine):
+            # 2048 cycles per sample
+            machine.write_data(emulator.PLL_BASE, 1000)
+            machine.open_adc(path)
+        skipped = []
+        with self.countSkipped(skipped):
+            reference = self.assertEquivalent(sections, 30000, setup=setup, limits=[1000])
+        self.assertGreater(reference.get_register('R1'), 0)
+        self.assertGreater(max(skipped), 1000)
+
+    def testDACStatusPolling(self):
+        # Loops waiting for room in the DAC FIFO are skipped up to the sample which makes room
+        sections = dict([
+            (0x000000, ['.reset_handler:', 'Y1.l = 0x00', 'Y1.h = 0x01', '.wait:', 'X0 = IO(0x4b)', 'R0 = X0 AND Y1', 'Jne .wait',
+                'IO(0x55) = R1', 'R1 = R1 + 1', 'Jmp .wait']),
+        ])
+        paths = []
+        def setup(machine):
+            machine.write_data(emulator.PLL_BASE, 1000)
+            paths.append(os.path.join(self.directory.name, 'dac%d.wav' % len(paths)))
+            machine.open_dac(paths[-1])
+        skipped = []
+        with self.countSkipped(skipped):
+            reference = self.assertEquivalent(sections, 30000, setup=setup, limits=[1000])
+        self.assertGreater(reference.get_register('R1'), emulator.AUDIO_FIFO_DEPTH)
+        self.assertGreater(max(skipped), 100)
+
+class DecodeTest(MachineTest):
+
+    def testDecodeTable(self):
+        # Opcodes are decoded once, into the instruction decodeOpCode() returns, shared by every address holding them
+        machine = self.machine(dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'X0 = R0', 'R0 = R0 + 1', 'DM(0x010) = X0', 'Jmp .loop'])]))
+        for _ in range(20):
+            machine.step()
+        for PC in range(5):
+            opcode = emulator.getOpCode(PC)
+            instruction = emulator.decodeAt(PC)
+            expected = emulator.decodeOpCode(opcode)
+            self.assertIs(emulator.opcodeTable[opcode], instruction)
+            self.assertEqual((instruction.handler, instruction.args, instruction.cycles), (expected.handler, expected.args, expected.cycles))
+        self.assertIs(emulator.decodeAt(0), emulator.decodeAt(2))
+        # Decoding is keyed by opcode: rewritten code runs the new instruction
+        machine.write_program_words(0x000002, [emulator.getOpCode(1)])
+        machine.run(25)
+        self.assertEqual(machine.get_register('R0'), 8 + 5)
+
+class BlockCacheTest(MachineTest):
+
+    def testSelfModifyingCode(self):
+        # Code written to WRAM shared with the Program RAM window replaces the cached blocks it overwrites
+        (increment0, increment1, ret) = opcodes(self.directory.name, ['R0 = R0 + 1', 'R1 = R1 + 1', 'Retff'])
+        def load(register, opcode):
+            return ['%s.l = %s' % (register, emulator.hex(opcode & 0xff, 2)), '%s.h = %s' % (register, emulator.hex(opcode >> 8, 2))]
+        sections = dict([
+            (0x000000, ['.reset_handler:', 'X1.l = 0x04', 'X1.h = 0x00', 'IO(0x7c) = X1', 'Ix0.l = 0x01', 'Ix0.h = 0x30'] + load('X0', ret) +
+                ['RAM(Ix0) = X0', 'Ix0.l = 0x00', '.loop:'] + load('X0', increment0) + ['RAM(Ix0) = X0', 'Callff 0x200000'] +
+                load('X0', increment1) + ['RAM(Ix0) = X0', 'Callff 0x200000', 'Jmp .loop']),
+        ])
+        reference = self.assertEquivalent(sections, 3000, limits=[100, 7])
+        self.assertGreater(reference.get_register('R0'), 100)
+        self.assertIn(reference.get_register('R0') - reference.get_register('R1'), [0, 1])
+
+class TraceLevelTest(MachineTest):
+
+    def runTraced(self, level, sections, instructions):
+        machine = self.machine(sections)
+        emulator.traceLevel = level
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            machine.run(instructions)
+        return output.getvalue()
+
+    def testTraceLevels(self):
+        sections = dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'Jmp .loop'])])
+        with mock.patch('emulator.print_instruction') as printInstruction, mock.patch('emulator.print_execution') as printExecution:
+            self.assertEqual(self.runTraced(emulator.TRACE_OFF, sections, 1000), '')
+        # Messages of disabled levels are not even formatted
+        printInstruction.assert_not_called()
+        printExecution.assert_not_called()
+        output = self.runTraced(emulator.TRACE_INSTRUCTIONS, sections, 10)
+        self.assertEqual(output.count('R0 = R0 + 1'), 5)
+        self.assertNotIn('set to', output)
+        output = self.runTraced(emulator.TRACE_FULL, sections, 10)
+        self.assertEqual(output.count('R0 = R0 + 1'), 5)
+        self.assertIn('set to', output)
+
+class InstanceTest(MachineTest):
+
+    def testInterleavedMachines(self):
+        # Machines run in turns keep their own state, the same as run alone
+        sections = dict([(0x000000, ['X1.l = 0x01', 'IO(0x10) = X1', '.loop:', 'R0 = R0 + 1', 'X0 = IO(0x47)', 'R1 = X0 + R1',
+            'RAM(IX0, 1) = R0', 'Jmp .loop'])])
+        alone = [self.machine(sections, chipName) for chipName in ['SNC7001A', 'SNP70032']]
+        for machine in alone:
+            machine.run(3000)
+        machines = [self.machine(sections, chipName) for chipName in ['SNC7001A', 'SNP70032']]
+        for _ in range(10):
+            for machine in machines:
+                machine.run(300)
+        for (machine, expected) in zip(machines, alone):
+            self.assertEqual(state(machine), state(expected))
+
+    def testRunUntil(self):
+        # run_until() stops at the first time PC reaches the address, without leaving a breakpoint
+        machine = self.machine(dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'R1 = R1 + 1', '.target:', 'Y0 = Y0 + 1', 'Jmp .loop'])]))
+        self.assertTrue(machine.run_until(0x000002))
+        self.assertEqual((machine.instruction_count, machine.get_register('Y0')), (2, 0))
+        machine.run_until(0x000002)
+        self.assertEqual((machine.instruction_count, machine.get_register('Y0')), (6, 1))
+        self.assertFalse(machine.run_until(0x000100, 1000))
+        self.assertEqual(machine.instruction_count, 1006)
+        self.assertEqual(machine.breakpoints, dict())
+
+class SnapshotTest(MachineTest):
+
+    def testRestore(self):
+        # Running again from a restored snapshot ends in the same state, including after code was overwritten
+        sections = dict([
+            (0x000000, ['jmpff .reset_handler']),
+            (0x000018, ['jmpff .t0_handler']),
+            (0x000080, ['.reset_handler:', 'X1.l = 0x02', 'X1.h = 0x00', 'IO(0x20) = X1', 'X1.l = 0x01', 'IO(0x10) = X1', '.loop:',
+                'R0 = R0 + 1', 'RAM(IX0, 1) = R0', 'Jmp .loop', '.t0_handler:', 'Y0 = Y0 + 1', 'X0.l = 0x02', 'IO(0x23) = X0', 'Reti']),
+        ])
+        machine = self.machine(sections)
+        machine.run(100000)
+        snapshot = machine.snapshot()
+        machine.run(100000)
+        expected = state(machine)
+        machine.restore(snapshot)
+        machine.write_program_words(0x000086, opcodes(self.directory.name, ['R0 = R0 - 1']))
+        machine.run(100000)
+        self.assertNotEqual(state(machine), expected)
+        for _ in range(2):
+            machine.restore(snapshot)
+            machine.run(100000)
+            self.assertEqual(state(machine), expected)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'os.fork() is not available')
+    def testFork(self):
+        # The child goes on from the state of the parent, without changing it
+        machine = self.machine(dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'RAM(IX0, 1) = R0', 'Jmp .loop'])]))
+        machine.run(1000)
+        (read, write) = os.pipe()
+        pid = machine.fork()
+        if pid == 0:
+            os.close(read)
+            machine.run(1000)
+            os.write(write, struct.pack('<H', machine.read_data(0x0200)))
+            os._exit(0)
+        os.close(write)
+        with os.fdopen(read, 'rb') as f:
+            (child, ) = struct.unpack('<H', f.read())
+        os.waitpid(pid, 0)
+        self.assertEqual(child, 0x0201)
+        self.assertEqual(machine.read_data(0x0200), 0x0000)
+        self.assertEqual(machine.instruction_count, 1000)
+
+class TimingTest(MachineTest):
+
+    def testCycles(self):
+        # Flow instructions take more cycles, and fetching from the SPI flash on CS1 waits for every word
+        sections = dict([
+            (0x000000, ['R1 = R1 + 1', 'Jmpff 0x400100']),
+            (0x000100, ['R0 = R0 + 1', 'Jmpff 0x000000']),
+        ])
+        reference = self.assertEquivalent(sections, 1000, limits=[1, 2, 3])
+        self.assertEqual(reference.cycle_count, 250 * ((1 + 3) + (1 + 4) + (3 + 2 * 4)))
+
+    def testEmulatedTime(self):
+        # Emulated time goes on at the system clock frequency set in the PLL
+        machine = self.machine(dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'Jmp .loop'])]))
+        machine.run(1000)
+        self.assertEqual(machine.clock_frequency, emulator.PLL_REFERENCE)
+        self.assertAlmostEqual(machine.emulated_time, 1500 / emulator.PLL_REFERENCE)
+        machine.write_data(emulator.PLL_BASE, 1000)
+        machine.write_data(emulator.PLL_BASE + 1, 0x8000)
+        machine.run(1000)
+        self.assertEqual(machine.clock_frequency, emulator.PLL_REFERENCE * 1000.5)
+        self.assertAlmostEqual(machine.emulated_time, 1500 / emulator.PLL_REFERENCE + 1500 / (emulator.PLL_REFERENCE * 1000.5))
+        machine.reset()
+        self.assertEqual((machine.cycle_count, machine.emulated_time, machine.clock_frequency), (0, 0.0, emulator.PLL_REFERENCE))
+
+class ProfilerTest(MachineTest):
+
+    def testRoutines(self):
+        # Cycles of the routines, exclusive and including the routines they call, the same with step() and run()
+        sections = dict([(0x000000, ['.loop:', 'Call .a', 'Call .b', 'Jmp .loop', '.a:', 'R0 = R0 + 1', 'Call .b', 'Ret', '.b:', 'R1 = R1 + 1',
+            'Ret'])])
+        profilers = []
+        for aot in [False, True]:
+            machine = self.machine(sections, aot=aot)
+            machine.start_profile()
+            machine.run(1000)
+            profilers.append(machine.stop_profile())
+        machine = self.machine(sections)
+        machine.start_profile()
+        for _ in range(1000):
+            machine.step()
+        profilers.append(machine.stop_profile())
+        for profiler in profilers:
+            self.assertEqual(profiler.routines(), dict([(0x000000, (0, 600, 1700)), (0x000003, (100, 500, 800)), (0x000006, (200, 600, 600))]))
+            self.assertEqual(profiler.collapsed(), '0x000000 600\n0x000000;0x000003 500\n0x000000;0x000003;0x000006 300\n0x000000;0x000006 300\n')
+            self.assertEqual((profiler.executions[0x000006], profiler.cycles[0x000007]), (200, 400))
+        report = profilers[0].report(2).splitlines()
+        self.assertEqual([line.split()[0] for line in report[1:3]], ['0x000000', '0x000003'])
+
+class BreakpointTest(MachineTest):
+
+    sections = dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'DM(0x010) = R0', 'Y0 = Y0 + 1', 'X0 = IO(0x47)', 'Jmp .loop'])])
+
+    def testBreakpoints(self):
+        # run() stops before the instruction in the middle of blocks and compiled routines, once the condition is met
+        # and the ignored hits are over
+        for aot in [False, True]:
+            machine = self.machine(self.sections, aot=aot)
+            machine.add_breakpoint(0x000002, 'R0 == 10')
+            machine.run(10000)
+            self.assertEqual((machine.pc, machine.instruction_count, machine.get_register('Y0')), (0x000002, 5 * 9 + 2, 9))
+            self.assertIs(machine.stop_reason, machine.breakpoints[0x000002])
+            machine.remove_breakpoint(0x000002)
+            machine.add_breakpoint(0x000003, lambda machine: machine.get_register('R0') % 100 == 0, ignore=2)
+            machine.run(10000)
+            self.assertEqual((machine.pc, machine.get_register('R0')), (0x000003, 300))
+            machine.remove_breakpoint(0x000003)
+            machine.run(10000)
+            self.assertIsNone(machine.stop_reason)
+            self.assertEqual(machine.instruction_count, 5 * 299 + 3 + 10000)
+
+    def testWatchpoints(self):
+        # run() stops after the instruction which accessed the word or I/O register
+        for aot in [False, True]:
+            machine = self.machine(self.sections, aot=aot)
+            machine.add_watchpoint('data', 0x010, condition='value == 20')
+            machine.run(10000)
+            (watchpoint, access, value) = machine.stop_reason
+            self.assertEqual((watchpoint.address, access, value), (0x010, 'w', 20))
+            self.assertEqual((machine.pc, machine.instruction_count), (0x000002, 5 * 19 + 2))
+            machine.remove_watchpoint('data', 0x010)
+            machine.add_watchpoint('io', 0x47, 'r', ignore=4)
+            machine.run(10000)
+            self.assertEqual((machine.pc, machine.get_register('R0')), (0x000004, 24))
+            self.assertEqual(machine.stop_reason[1], 'r')
+            machine.remove_watchpoint('io', 0x47)
+            self.assertEqual(machine.watchpoints, dict())
+
+class FlagsTest(MachineTest):
+
+    def testLazyFlags(self):
+        # Flags computed when tested end in the same state as flags computed after every ALU instruction
+        sections = dict([(0x000000, ['X0.l = 0xfe', 'X0.h = 0x7f', 'Y0.l = 0x01', '.loop:', 'R0 = X0 + Y0', 'Jav .overflow', 'Y1 = Y1 + 1',
+            '.overflow:', 'R0 = R0 - Y0', 'Jlt .negative', 'Y1 = Y1 + 1', '.negative:', 'X0 = X0 + 1', 'Jac .carry', 'Y1 = Y1 + 1', '.carry:',
+            'R0 = X0 AND Y1', 'Jeq .zero', 'Y1 = Y1 + 1', '.zero:', 'X1 = IO(0x00)', 'R1 = X1 + R1', 'Jmp .loop'])])
+        reference = self.assertEquivalent(sections, 2000, limits=[3, 500])
+        recordFlags = emulator.recordFlags
+        def eagerFlags(kind, result, first, second):
+            recordFlags(kind, result, first, second)
+            emulator.materializeFlags()
+        with mock.patch('emulator.recordFlags', eagerFlags):
+            eager = self.machine(sections)
+            for _ in range(2000):
+                eager.step()
+        self.assertEqual(state(eager), state(reference))
+        self.assertNotEqual(reference.get_register('Y1'), 0)
+        self.assertNotEqual(reference.get_register('R1'), 0)
+
+class RegisterFileTest(MachineTest):
+
+    def testRegisters(self):
+        # Registers and I/O registers by name, label or address, as the instructions see them
+        machine = self.machine(dict([(0x000000, ['X0.l = 0x34', 'X0.h = 0x12', 'IO(0x30) = X0', 'R1 = IO(0x30)', 'Ix0.l = 0x56', 'R0 = IO(0x02)',
+            '.end:', 'Jmp .end'])]))
+        for (label, value) in emulator.ioRegResetValues.items():
+            self.assertEqual(machine.get_io(label), value)
+        self.assertEqual(machine.get_io('Im03'), machine.get_io(0x07))
+        machine.run(6)
+        self.assertEqual(machine.registers(), dict([('X0', 0x1234), ('X1', 0), ('R0', 0x0056), ('R1', 0x1234), ('Y0', 0), ('Y1', 0),
+            ('MR0', 0), ('MR1', 0)]))
+        self.assertEqual(machine.get_io('P0WKUPEN'), 0x1234)
+        self.assertEqual(machine.get_io('Ix0'), 0x0056)
+        machine.set_register('Y1', 0x12345)
+        machine.set_io('Im11', 0x1fffe)
+        self.assertEqual(machine.get_register('Y1'), 0x2345)
+        self.assertEqual(machine.get_io(0x09), 0xfffe)
+
+class ROMTest(MachineTest):
+
+    def testLoadROM(self):
+        # ROM words are mapped from the file (a trailing odd byte is ignored), copied to Program RAM when written
+        words = [(index * 0x9e37) & 0xffff for index in range(0x1234)]
+        path = os.path.join(self.directory.name, 'test.bin')
+        with open(path, 'wb') as f:
+            f.write(struct.pack('<%dH' % len(words), *words) + b'\xff')
+        self.assertEqual(list(emulator.loadROM(path)), words)
+        machine = Emulator()
+        machine.load_rom(path)
+        self.assertEqual(list(machine.read_program_words(emulator.CS1ROM_BASE, len(words) + 16)), words + [0x0000] * 16)
+        self.assertEqual(list(machine.read_program_words(0x000000, len(words) + 16)), words + [0x0000] * 16)
+        machine.write_program_words(0x000010, [0x1234])
+        self.assertEqual(machine.read_program(0x000010), 0x1234)
+        self.assertEqual(list(emulator.loadROM(path)), words)
+        empty = os.path.join(self.directory.name, 'empty.bin')
+        open(empty, 'wb').close()
+        self.assertEqual(len(emulator.loadROM(empty)), 0)
+
+class MemoryTest(MachineTest):
+
+    def testChipProfiles(self):
+        # Program RAM and WRAM sizes, and the end of the WRAM shared with the Program RAM window, by chip
+        sections = dict([(0x000000, ['.end:', 'Jmp .end'])])
+        for (chipName, pram, wram, shared) in [('SNC7001A', 0x8000, 0x4000, 0x1000), ('SNP70032', 0x4000, 0x2000, 0x0800)]:
+            machine = self.machine(sections, chipName)
+            with contextlib.redirect_stdout(io.StringIO()):
+                machine.read_program(pram - 1)
+                self.assertRaises(RuntimeError, machine.read_program, pram)
+                self.assertRaises(RuntimeError, machine.read_program, emulator.PRAM_WINDOW)
+                machine.write_data(wram - 1, 0x1234)
+                self.assertEqual(machine.read_data(wram - 1), 0x1234)
+                # Memory mapped devices after the WRAM, unimplemented ones read as 0
+                machine.write_data(wram, 0x1234)
+                self.assertEqual(machine.read_data(wram), 0x0000)
+                machine.set_io('SYSCONF', 0x0004)
+                machine.write_data(wram - shared, 0x5678)
+                self.assertEqual(machine.read_program(emulator.PRAM_WINDOW), 0x5678)
+                machine.write_program_words(emulator.PRAM_WINDOW + shared - 1, [0x9abc])
+                self.assertEqual(machine.read_data(wram - 1), 0x9abc)
+                self.assertRaises(RuntimeError, machine.read_program, emulator.PRAM_WINDOW + shared)
+
+class AudioTest(MachineTest):
+
+    def testLoopback(self):
+        # Samples read from the ADC FIFO and written to the DAC end up in the output WAV file unchanged
+        samples = [(index * 1237) % 65536 - 32768 for index in range(3000)]
+        machine = self.machine(dict([(0x000000, ['Y1.l = 0x00', 'Y1.h = 0x02', '.wait:', 'X0 = IO(0x26)', 'R0 = X0 AND Y1', 'Jne .wait',
+            'X0 = IO(0x28)', 'IO(0x55) = X0', 'Jmp .wait'])]))
+        machine.write_data(emulator.PLL_BASE, 1000)
+        path = os.path.join(self.directory.name, 'dac.wav')
+        with mock.patch('emulator.AUDIO_CHUNK', 256):
+            machine.open_adc(writeWAV(self.directory.name, 'adc.wav', samples))
+            machine.open_dac(path)
+            # Skipped polling loop iterations count as instructions
+            machine.run(2000000)
+            machine.close_dac()
+            machine.close_adc()
+        with wave.open(path, 'rb') as f:
+            self.assertEqual(f.getframerate(), emulator.AUDIO_SAMPLE_RATE)
+            frames = f.readframes(f.getnframes())
+        output = list(struct.unpack('<%dh' % (len(frames) // 2), frames))
+        self.assertGreater(len(output), 1000)
+        self.assertEqual(output, samples[:len(output)])
+
+    def testADCChunks(self):
+        # FIFO reads of frames from the chunk before the one a SAR ADC read loaded
+        path = writeWAV(self.directory.name, 'adc.wav', range(1000))
+        with mock.patch('emulator.AUDIO_CHUNK', 64):
+            adc = emulator.ADCInput(path)
+            self.assertEqual(adc.sample(100), 100)
+            self.assertEqual(adc.sample(60), 60)
+            self.assertEqual(adc.sample(200), 200)
+            self.assertEqual(adc.sample(150), 150)
+            self.assertEqual(adc.sample(10), 0x0000)
+            self.assertEqual(adc.sample(1000), 0x0000)
+            adc.close()
+
+class FlashTest(MachineTest):
+
+    def flashCommand(self, machine, opcode, address=0, buffer=0, length=0):
+        for (register, value) in [(emulator.FLASH_ADDRESSL, address & 0xffff), (emulator.FLASH_ADDRESSH, address >> 16),
+                (emulator.FLASH_BUFFER, buffer), (emulator.FLASH_LENGTH, length), (emulator.FLASH_COMMAND, opcode)]:
+            machine.write_data(emulator.SPI_FLASH_BASE + register, value)
+
+    def spiTransfer(self, machine, data):
+        # Bytes sent back by the flash, selected for this transfer only
+        machine.set_io(emulator.IO_SPICSC, 0x0001)
+        for index in range(0, len(data), 2):
+            machine.set_io(emulator.IO_SPIDADA0 + index // 2, data[index] | (data[index + 1] << 8 if index + 1 < len(data) else 0))
+        machine.set_io(emulator.IO_SPITRANSFER, len(data))
+        response = b''.join(struct.pack('<H', machine.get_io(emulator.IO_SPIDADA0 + index)) for index in range(emulator.SPI_DATA_BYTES // 2))
+        machine.set_io(emulator.IO_SPICSC, 0x0000)
+        return response[:len(data)]
+
+    def testController(self):
+        # Commands of the controller at 0xf800 between the flash image and WRAM, busy for the time of the transfer
+        path = os.path.join(self.directory.name, 'flash.bin')
+        image = bytes((index * 7) & 0xff for index in range(0x10000))
+        with open(path, 'wb') as f:
+            f.write(image)
+        machine = self.machine(dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'Jmp .loop'])]))
+        machine.open_flash(path)
+        self.flashCommand(machine, emulator.FLASH_READ, 0x00fffe, 0x0200, 16)
+        self.assertEqual(machine.read_data_words(0x0200, 16).tobytes(), image[0xfffe:] + image[:30])
+        self.assertTrue(machine.read_data(emulator.SPI_FLASH_BASE + emulator.FLASH_STATUS) & emulator.FLASH_BUSY)
+        machine.run(1000)
+        self.assertFalse(machine.read_data(emulator.SPI_FLASH_BASE + emulator.FLASH_STATUS) & emulator.FLASH_BUSY)
+        machine.write_data_words(0x0300, [0x0f0f, 0x0000])
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.flashCommand(machine, emulator.FLASH_PAGE_PROGRAM, 0x001000, 0x0300, 2)
+        self.assertIn('not enabled', output.getvalue())
+        self.flashCommand(machine, emulator.FLASH_WRITE_ENABLE)
+        self.assertTrue(machine.read_data(emulator.SPI_FLASH_BASE + emulator.FLASH_STATUS) & emulator.FLASH_WEL)
+        self.flashCommand(machine, emulator.FLASH_PAGE_PROGRAM, 0x0010fe, 0x0300, 2)
+        self.flashCommand(machine, emulator.FLASH_WRITE_ENABLE)
+        self.flashCommand(machine, 0x20, 0x002345)
+        machine.close_flash()
+        with open(path, 'rb') as f:
+            written = f.read()
+        # Programming only clears bits, and wraps around at the end of the page
+        expected = bytearray(image)
+        expected[0x10fe:0x1100] = bytes([image[0x10fe] & 0x0f, image[0x10ff] & 0x0f])
+        expected[0x1000:0x1002] = b'\x00\x00'
+        expected[0x2000:0x3000] = b'\xff' * 0x1000
+        self.assertEqual(written, bytes(expected))
+
+    def testSPIMaster(self):
+        # Commands exchanged byte by byte through SPIDADA0-5
+        path = os.path.join(self.directory.name, 'flash.bin')
+        with open(path, 'wb') as f:
+            f.write(bytes(range(256)) * 0x400)
+        machine = self.machine(dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'Jmp .loop'])]))
+        machine.open_flash(path)
+        self.assertEqual(self.spiTransfer(machine, bytes([emulator.FLASH_READ_ID, 0, 0, 0])), bytes([0x00, 0xef, 0x40, 18]))
+        self.assertEqual(self.spiTransfer(machine, bytes([emulator.FLASH_READ, 0x01, 0x02, 0x03] + [0] * 8)),
+            bytes(4) + bytes(range(3, 11)))
+        self.spiTransfer(machine, bytes([emulator.FLASH_WRITE_ENABLE]))
+        self.spiTransfer(machine, bytes([emulator.FLASH_PAGE_PROGRAM, 0x00, 0x00, 0x10, 0x0f, 0xf1]))
+        self.assertEqual(self.spiTransfer(machine, bytes([emulator.FLASH_READ_STATUS, 0])), bytes([0x00, 0x00]))
+        self.assertEqual(self.spiTransfer(machine, bytes([emulator.FLASH_READ, 0x00, 0x00, 0x10, 0, 0])), bytes(4) + bytes([0x00, 0x11]))
+        machine.close_flash()
+
+class DMATest(MachineTest):
+
+    def testTransferEvent(self):
+        # Words are copied when the transfer is done, which firmware polling the done flag waits for
+        words = [(index * 0x2345) & 0xffff for index in range(0x40)]
+        def setup(machine):
+            machine.write_data_words(0x0100, words)
+        store = lambda value: ['X0.l = %s' % emulator.hex(value & 0xff, 2), 'X0.h = %s' % emulator.hex(value >> 8, 2), 'RAM(IX0, 1) = X0']
+        sections = dict([(0x000000, ['Ix0.l = 0x00', 'Ix0.h = 0xf1'] + store(0x0100) + store(0x0200) + store(len(words)) + store(0x0000)
+            + store(0x0000) + store(emulator.DMA_START) + ['Ix1.l = 0x05', 'Ix1.h = 0xf1', 'Y1.l = 0x02', 'Y1.h = 0x00', '.wait:', 'X0 = RAM(IX1)',
+            'R0 = X0 AND Y1', 'Jeq .wait', '.end:', 'R1 = R1 + 1', 'Jmp .end'])])
+        reference = self.assertEquivalent(sections, 1000, setup, limits=[25, 2])
+        self.assertEqual(list(reference.read_data_words(0x0200, len(words))), words)
+        self.assertGreater(reference.get_register('R1'), 0)
+        machine = self.machine(sections)
+        setup(machine)
+        machine.run(30)
+        self.assertEqual(machine.read_data(0xf105), emulator.DMA_BUSY)
+        self.assertEqual(list(machine.read_data_words(0x0200, len(words))), [0x0000] * len(words))
+        machine.run(len(words))
+        self.assertEqual(machine.read_data(0xf105), emulator.DMA_DONE)
+        channel = emulator.interruptChannels['DMA_DEV_RW']
+        self.assertTrue(machine.get_io(emulator.interruptRegisters[channel >> 4][1]) & (1 << (channel & 0xf)))
+
+    def testFlashToProgram(self):
+        # DMA1 copying flash bytes to Program RAM, then code run from there
+        path = os.path.join(self.directory.name, 'flash.bin')
+        code = opcodes(self.directory.name, ['R0 = R0 + 1', 'Ret'])
+        with open(path, 'wb') as f:
+            f.write(bytes(0x100) + struct.pack('<%dH' % len(code), *code) + bytes(0x100))
+        machine = self.machine(dict([(0x000000, ['.loop:', 'Y0 = Y0 + 1', 'Jmp .loop'])]))
+        machine.open_flash(path)
+        for (register, value) in [(emulator.DMA_SOURCE, 0x0100), (emulator.DMA_DESTINATION, 0x1000), (emulator.DMA_LENGTH, len(code)),
+                (emulator.DMA_MODE, emulator.DMA_FLASH | emulator.DMA_PROGRAM << 2), (emulator.DMA_CONTROL, emulator.DMA_START)]:
+            machine.write_data(0xfe27 + register, value)
+        machine.run(200)
+        self.assertEqual(list(machine.read_program_words(0x1000, len(code))), code)
+        machine.close_flash()
+
+if __name__ == '__main__':
+    unittest.main()
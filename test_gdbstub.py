@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import contextlib
+import io
+import socket
+import threading
+import unittest
+from unittest import mock
+
+import gdbstub
+from gdbstub import DATA_BASE, GDBConnection, GDBStub, checksum
+from test_emulator import MachineTest
+
+
+class GDBClient:
+    """The GDB side of a connection to the stub"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffer = bytearray()
+
+    def receive(self, end):
+        while end not in self.buffer:
+            data = self.connection.recv(4096)
+            if not data:
+                raise ConnectionError('stub disconnected')
+            self.buffer += data
+
+    def send(self, payload):
+        """Reply of the stub to a packet"""
+        data = payload.encode('latin-1')
+        self.connection.sendall(b'$' + data + b'#' + ('%02x' % checksum(data)).encode())
+        self.receive(b'+')
+        del self.buffer[:self.buffer.index(b'+') + 1]
+        return self.reply()
+
+    def reply(self):
+        self.receive(b'#')
+        while len(self.buffer) < self.buffer.index(b'#') + 3:
+            self.buffer += self.connection.recv(4096)
+        end = self.buffer.index(b'#')
+        payload = bytes(self.buffer[self.buffer.index(b'$') + 1:end])
+        if int(self.buffer[end + 1:end + 3], 16) != checksum(payload):
+            raise ValueError('bad checksum')
+        del self.buffer[:end + 3]
+        self.connection.sendall(b'+')
+        return payload.decode('latin-1')
+
+class GDBStubTest(MachineTest):
+
+    def setUp(self):
+        super().setUp()
+        machine = self.machine(dict([(0x000000, ['.loop:', 'R0 = R0 + 1', 'DM(0x010) = R0', 'Y0 = Y0 + 1', 'Jmp .loop'])]))
+        (server, client) = socket.socketpair()
+        self.output = io.StringIO()
+        def serve():
+            with contextlib.redirect_stdout(self.output):
+                try:
+                    GDBStub(machine, GDBConnection(server)).serve()
+                except ConnectionError:
+                    pass
+                finally:
+                    server.close()
+        self.thread = threading.Thread(target=serve)
+        self.thread.start()
+        self.client = GDBClient(client)
+
+    def tearDown(self):
+        self.client.connection.close()
+        self.thread.join()
+        super().tearDown()
+
+    def testSession(self):
+        # Registers, memory, breakpoints and watchpoints as a GDB session uses them, then detach
+        client = self.client
+        self.assertIn('qXfer:features:read+', client.send('qSupported:swbreak+'))
+        self.assertTrue(client.send('qXfer:features:read:target.xml:0,10000').endswith('</target>'))
+        registers = client.send('g')
+        self.assertEqual(len(registers), 4 * (gdbstub.PC_REGISTER + gdbstub.IO_REGISTERS) + 8)
+        self.assertEqual(client.send('M%x,4:34127856' % (DATA_BASE + 0x40)), 'OK')
+        self.assertEqual(client.send('M%x,1:ab' % (DATA_BASE + 0x43)), 'OK')
+        self.assertEqual(client.send('m%x,4' % (DATA_BASE + 0x40)), '341278ab')
+        self.assertEqual(client.send('Z0,4,2'), 'OK')
+        self.assertEqual(client.send('c'), 'T05swbreak:;')
+        self.assertEqual(client.send('p%x' % gdbstub.PC_REGISTER), '04000000')
+        self.assertEqual(client.send('p2'), '0100')
+        self.assertEqual(client.send('z0,4,2'), 'OK')
+        self.assertEqual(client.send('Z2,%x,2' % (DATA_BASE + 0x20)), 'OK')
+        self.assertEqual(client.send('c'), 'T05watch:%x;' % (DATA_BASE + 0x20))
+        self.assertEqual(client.send('m%x,2' % (DATA_BASE + 0x20)), '0200')
+        self.assertEqual(client.send('z2,%x,2' % (DATA_BASE + 0x20)), 'OK')
+        self.assertEqual(client.send('s'), 'S05')
+        self.assertEqual(client.send('P2=3412'), 'OK')
+        self.assertEqual(client.send('p2'), '3412')
+        self.assertEqual(client.send('p%x' % (gdbstub.PC_REGISTER + 1 + 0x20)), '0000')
+        self.assertEqual(client.send('D'), 'OK')
+        self.thread.join()
+
+    def testInterrupt(self):
+        # ^C stops a running machine
+        client = self.client
+        with mock.patch('gdbstub.RUN_CHUNK', 1000):
+            client.connection.sendall(b'$c#63')
+            client.receive(b'+')
+            del client.buffer[:1]
+            client.connection.sendall(b'\x03')
+            self.assertEqual(client.reply(), 'S02')
+            self.assertEqual(client.send('?'), 'S05')
+
+    def testErrors(self):
+        # Failed commands reply E01 and the session goes on
+        client = self.client
+        self.assertEqual(client.send('m%x,2' % (2 * 0x100000)), 'E01')
+        self.assertEqual(client.send('Z0,%x,2' % DATA_BASE), 'E01')
+        self.assertEqual(client.send('p%x' % 0x1000), 'E01')
+        self.assertEqual(client.send('vMustReplyEmpty'), '')
+        self.assertIn('failed', self.output.getvalue())
+        self.assertEqual(client.send('QStartNoAckMode'), 'OK')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import emulator
+import trace
+from emulator import Emulator, TRACE_DATA, TRACE_REGISTER
+from test_emulator import assemble
+
+
+TRACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trace.py')
+
+class TraceTest(unittest.TestCase):
+
+    def setUp(self):
+        emulator.traceLevel = emulator.TRACE_OFF
+        self.directory = tempfile.TemporaryDirectory()
+        self.rom = assemble(self.directory.name, dict([
+            (0x000000, ['.loop:', 'R0 = R0 + 1', 'DM(0x010) = R0', 'Y0 = Y0 + 1', 'Jmp .loop']),
+        ]))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, name, instructions, change=None):
+        path = os.path.join(self.directory.name, name)
+        machine = Emulator()
+        machine.load_rom(self.rom)
+        machine.start_trace(path)
+        if change is None:
+            machine.run(instructions)
+        else:
+            # Change the state of the machine in the middle of the trace
+            machine.run(instructions // 2)
+            change(machine)
+            machine.run(instructions - instructions // 2)
+        machine.stop_trace()
+        return path, machine
+
+    def runTrace(self, *args):
+        return subprocess.run([sys.executable, TRACE] + list(args), capture_output=True, text=True)
+
+    def testRecords(self):
+        # Every instruction is recorded with the registers and data words it wrote
+        path, machine = self.record('test.trc', 1000)
+        records = list(trace.instructions(trace.openTrace(path)))
+        self.assertEqual(len(records), 1000)
+        self.assertEqual([(PC, deltas) for (_, PC, _, deltas) in records[4:8]], [
+            (0x000000, [(TRACE_REGISTER, 2, 2, 0)]),
+            (0x000001, [(TRACE_DATA, 0, 2, 0x010)]),
+            (0x000002, [(TRACE_REGISTER, 4, 2, 0)]),
+            (0x000003, []),
+        ])
+        result = self.runTrace('dump', path, '--count', '3')
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(len(result.stdout.splitlines()), 3)
+
+    def testDiff(self):
+        # The first instruction where the traces differ is reported
+        first, _ = self.record('first.trc', 1000)
+        second, _ = self.record('second.trc', 1000)
+        result = self.runTrace('diff', first, second)
+        self.assertEqual(result.returncode, 0)
+        self.assertIn('identical', result.stdout)
+        third, _ = self.record('third.trc', 1000, lambda machine: machine.set_register('Y0', 0x1234))
+        result = self.runTrace('diff', first, third)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn('#502', result.stdout)
+        self.assertIn('Y0=0x1235', result.stdout)
+        shorter, _ = self.record('shorter.trc', 900)
+        result = self.runTrace('diff', first, shorter)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn('end of trace', result.stdout)
+
+    def testQuery(self):
+        # The last write to a data word or register is the value the machine ends with
+        path, machine = self.record('test.trc', 1000)
+        index = trace.loadIndex(path)
+        self.assertEqual(index[0], 1000)
+        writes = trace.query(index, TRACE_DATA, 0x010)
+        self.assertEqual(len(writes), 250)
+        self.assertEqual(writes[-1][1], machine.read_data(0x010))
+        self.assertEqual(trace.query(index, TRACE_REGISTER, 2, 0, 500)[-1][1], 125)
+        result = self.runTrace('query', path, 'register', 'R0', '--last')
+        self.assertEqual(result.returncode, 0)
+        self.assertIn('R0=0x00fa', result.stdout)
+
+    def testInvalidQueryTargets(self):
+        path, _ = self.record('test.trc', 10)
+        for arguments in [['register', 'BOGUS'], ['io', 'BOGUS'], ['data', '0x1000000'], ['pc', '0', '--before-pc', 'x']]:
+            result = self.runTrace('query', path, *arguments)
+            self.assertEqual(result.returncode, 2)
+            self.assertNotIn('Traceback', result.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from emulator import TRACE_MAGIC, TRACE_RECORD, TRACE_INSTRUCTION, TRACE_REGISTER, TRACE_IO, TRACE_DATA
+from emulator import bcolors, print_error, hex, ioAddresses, ioRegisterLabel, registers_reg
+
+
+# Binary traces (see emulator.py --trace-file): the magic, then fixed-size records
+COMPARE_CHUNK_SIZE = 0x100000
+
+def openTrace(path):
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError('%s is not a trace file' % path)
+        if f.seek(0, 2) == len(TRACE_MAGIC):
+            return memoryview(b'')
+        trace = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # Ignore a partial record at the end of a trace being written
+    size = (len(trace) - len(TRACE_MAGIC)) // TRACE_RECORD.size * TRACE_RECORD.size
+    return memoryview(trace)[len(TRACE_MAGIC):len(TRACE_MAGIC) + size]
+
+def instructions(trace, start=0):
+    """Yield (record offset, PC, opcode, list of deltas) of every instruction from the one at offset start"""
+    current = None
+    offset = start
+    for (kind, index, value, address) in TRACE_RECORD.iter_unpack(trace[start:]):
+        if kind == TRACE_INSTRUCTION:
+            if current is not None:
+                yield current
+            current = (offset, address, value, [])
+        elif current is not None:
+            current[3].append((kind, index, value, address))
+        offset += TRACE_RECORD.size
+    if current is not None:
+        yield current
+
+def formatDelta(delta):
+    (kind, index, value, address) = delta
+    if kind == TRACE_REGISTER:
+        name = registers_reg[index]
+    elif kind == TRACE_IO:
+        name = 'IO(%s)' % ioRegisterLabel(index)
+    elif kind == TRACE_DATA:
+        name = 'RAM(%s)' % hex(address, 6)
+    else:
+        name = 'UNKNOWN(%d)' % kind
+    return '%s=%s' % (name, hex(value, 4))
+
+def formatInstruction(number, PC, opcode, deltas):
+    return f"{bcolors.ADDRESS}#{number}\t{hex(PC, 6)}:{bcolors.ENDC}\t{hex(opcode, 4)}\t{bcolors.EXECUTION}{' '.join(formatDelta(delta) for delta in deltas)}{bcolors.ENDC}"
+
+def dump(args):
+    trace = openTrace(args.trace)
+    for number, (offset, PC, opcode, deltas) in enumerate(instructions(trace)):
+        if args.count is not None and number >= args.count:
+            break
+        print(formatInstruction(number, PC, opcode, deltas))
+
+def firstDifference(first, second):
+    # Compare large chunks (in C) before looking for the differing byte
+    size = min(len(first), len(second))
+    for chunk in range(0, size, COMPARE_CHUNK_SIZE):
+        end = min(chunk + COMPARE_CHUNK_SIZE, size)
+        if first[chunk:end] != second[chunk:end]:
+            for offset in range(chunk, end):
+                if first[offset] != second[offset]:
+                    return offset
+    return size if len(first) != len(second) else None
+
+def recordKind(trace, offset):
+    return trace[offset] if offset < len(trace) else None
+
+def diff(args):
+    first = openTrace(args.first)
+    second = openTrace(args.second)
+    difference = firstDifference(first, second)
+    if difference is None:
+        print('Traces are identical (%d records)' % (len(first) // TRACE_RECORD.size))
+        return 0
+    # Back to the instruction the first differing record belongs to (records before it are the same in both)
+    offset = difference - difference % TRACE_RECORD.size
+    if TRACE_INSTRUCTION not in (recordKind(first, offset), recordKind(second, offset)):
+        offset -= TRACE_RECORD.size
+        while offset > 0 and first[offset] != TRACE_INSTRUCTION:
+            offset -= TRACE_RECORD.size
+    number = sum(1 for record in TRACE_RECORD.iter_unpack(first[:offset]) if record[0] == TRACE_INSTRUCTION)
+    print(f"{bcolors.ERROR}Traces diverge at instruction #{number}{bcolors.ENDC}")
+    for trace, name in [(first, args.first), (second, args.second)]:
+        instruction = next(instructions(trace, offset), None)
+        if instruction is None:
+            print('%s:\tend of trace' % name)
+        else:
+            (_, PC, opcode, deltas) = instruction
+            print('%s:' % name)
+            print(formatInstruction(number, PC, opcode, deltas))
+    return 1
+
+# Indexes (<trace>.idx): sorted 64-bit keys (kind, target, instruction number), where the target is the PC of
+# TRACE_INSTRUCTION records, the register, I/O address or data address of the others, and the value of every
+# record in the same order. A query is a binary search for the range of keys of one target.
+INDEX_MAGIC = b'S9KEIDX1'
+INDEX_HEADER = struct.Struct('<QQQ')       # trace size, number of instructions, number of keys
+INDEX_KINDS = dict([('pc', TRACE_INSTRUCTION), ('register', TRACE_REGISTER), ('io', TRACE_IO), ('data', TRACE_DATA)])
+
+def indexKey(kind, target, number):
+    return (kind << 56) | (target << 32) | number
+
+def buildIndex(trace):
+    # Keys of each target are appended in order: sorting the targets sorts the whole index
+    targets = dict()
+    number = -1
+    for (kind, index, value, address) in TRACE_RECORD.iter_unpack(trace):
+        if kind == TRACE_INSTRUCTION:
+            number += 1
+            target = address
+        elif kind == TRACE_DATA:
+            target = address
+        else:
+            target = index
+        entries = targets.get((kind, target))
+        if entries is None:
+            entries = targets[(kind, target)] = (array('Q'), array('H'))
+        entries[0].append(indexKey(kind, target, number))
+        entries[1].append(value)
+    keys = array('Q')
+    values = array('H')
+    for target in sorted(targets):
+        keys.extend(targets[target][0])
+        values.extend(targets[target][1])
+    return (number + 1, keys, values)
+
+def writeIndex(path, traceSize, instructions, keys, values):
+    if sys.byteorder != 'little':
+        keys.byteswap()
+        values.byteswap()
+    with open(path + '.%d.tmp' % os.getpid(), 'wb') as f:
+        f.write(INDEX_MAGIC + INDEX_HEADER.pack(traceSize, instructions, len(keys)))
+        f.write(keys.tobytes())
+        f.write(values.tobytes())
+    os.replace(path + '.%d.tmp' % os.getpid(), path)
+
+def loadIndex(tracePath, rebuild=False):
+    """Map the index of a trace, (re)building it first when needed. Returns (instructions, keys, values)."""
+    trace = openTrace(tracePath)
+    path = tracePath + '.idx'
+    if not rebuild:
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+                    (traceSize, instructions, count) = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                    # The trace is still being written, or was written again
+                    rebuild = traceSize != len(trace)
+                else:
+                    rebuild = True
+                if not rebuild and count > 0:
+                    index = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except FileNotFoundError:
+            rebuild = True
+    if rebuild:
+        (instructions, keys, values) = buildIndex(trace)
+        writeIndex(path, len(trace), instructions, keys, values)
+        return loadIndex(tracePath)
+    if count == 0:
+        return (instructions, array('Q'), array('H'))
+    start = len(INDEX_MAGIC) + INDEX_HEADER.size
+    keys = index[start:start + count * 8].cast('Q')
+    values = index[start + count * 8:start + count * 10].cast('H')
+    if sys.byteorder != 'little':
+        keys = array('Q', keys.tobytes())
+        keys.byteswap()
+        values = array('H', values.tobytes())
+        values.byteswap()
+    return (instructions, keys, values)
+
+def query(index, kind, target, first=0, last=None):
+    """(instruction number, value) of the records of a target, from instruction first to instruction last (excluded)"""
+    (instructions, keys, values) = index
+    last = instructions if last is None else min(last, instructions)
+    if first >= last:
+        return []
+    start = bisect.bisect_left(keys, indexKey(kind, target, first))
+    end = bisect.bisect_left(keys, indexKey(kind, target, last), start)
+    return [(keys[position] & 0xffffffff, values[position]) for position in range(start, end)]
+
+def index(args):
+    (instructions, keys, values) = loadIndex(args.trace, rebuild=True)
+    print('Indexed %d instructions (%d keys) to %s.idx' % (instructions, len(keys), args.trace))
+
+def parseTarget(kind, target):
+    """Index of a register, or address (None if invalid)"""
+    if kind == 'register':
+        return registers_reg.index(target) if target in registers_reg else None
+    if kind == 'io' and target in ioAddresses:
+        return ioAddresses[target]
+    try:
+        address = int(target, 0)
+    except ValueError:
+        return None
+    if address < 0 or address >= (0x80 if kind == 'io' else 0x1000000):
+        return None
+    return address
+
+def runQuery(args):
+    kind = INDEX_KINDS[args.kind]
+    target = parseTarget(args.kind, args.target)
+    if target is None:
+        print_error('Invalid %s: %s' % (args.kind, args.target))
+        return 2
+    index = loadIndex(args.trace)
+    last = None if args.to is None else args.to + 1
+    if args.before_pc is not None:
+        # Up to the next execution of an address
+        beforePC = parseTarget('pc', args.before_pc)
+        if beforePC is None:
+            print_error('Invalid address: %s' % args.before_pc)
+            return 2
+        executions = query(index, TRACE_INSTRUCTION, beforePC, args.first, last)
+        if len(executions) == 0:
+            print_error('%s is not executed in this range' % args.before_pc)
+            return 1
+        last = executions[0][0]
+    results = query(index, kind, target, args.first, last)
+    if args.last:
+        results = results[-1:]
+    for (number, value) in results:
+        if kind == TRACE_INSTRUCTION:
+            print(f"{bcolors.ADDRESS}#{number}\t{hex(target, 6)}:{bcolors.ENDC}\t{hex(value, 4)}")
+        else:
+            print(f"{bcolors.ADDRESS}#{number}:{bcolors.ENDC}\t{bcolors.EXECUTION}{args.target}={hex(value, 4)}{bcolors.ENDC}")
+    return 0 if results else 1
+
+def main():
+    parser = argparse.ArgumentParser(description='S9KE emulator binary traces')
+    commands = parser.add_subparsers(dest='command', required=True)
+    dumpParser = commands.add_parser('dump', help='print the instructions of a trace')
+    dumpParser.add_argument('trace')
+    dumpParser.add_argument('-n', '--count', type=int, help='number of instructions to print')
+    dumpParser.set_defaults(function=dump)
+    diffParser = commands.add_parser('diff', help='report the first instruction where two traces diverge')
+    diffParser.add_argument('first')
+    diffParser.add_argument('second')
+    diffParser.set_defaults(function=diff)
+    indexParser = commands.add_parser('index', help='(re)build the index of a trace (queries build it when needed)')
+    indexParser.add_argument('trace')
+    indexParser.set_defaults(function=index)
+    queryParser = commands.add_parser('query', help='list the executions of an address, or the writes to a register or data word')
+    queryParser.add_argument('trace')
+    queryParser.add_argument('kind', choices=list(INDEX_KINDS))
+    queryParser.add_argument('target', help='address, register name or I/O register label')
+    queryParser.add_argument('--from', dest='first', type=int, default=0, help='first instruction number')
+    queryParser.add_argument('--to', type=int, help='last instruction number')
+    queryParser.add_argument('--before-pc', help='stop at the next execution of this address')
+    queryParser.add_argument('--last', action='store_true', help='only print the last result')
+    queryParser.set_defaults(function=runQuery)
+    args = parser.parse_args()
+    sys.exit(args.function(args))
+
+if __name__ == '__main__':
+    main()